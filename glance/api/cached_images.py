@@ -77,6 +77,45 @@ class Controller(controller.BaseController):
         self._enforce(req)
         return dict(num_deleted=self.cache.delete_all_cached_images())
 
+    def get_cache_stats(self, req):
+        """
+        GET /cache_stats
+
+        Returns a mapping of statistics about the image cache in the
+        API server process that handled the request.
+        """
+        self._enforce(req)
+        return dict(cache_stats=self.cache.get_stats())
+
+    def get_cache_inventory(self, req):
+        """
+        GET /cache_inventory
+
+        Returns the generation of the image cache and the sorted IDs of
+        the cached images, or a Bloom filter of them if the 'format'
+        query parameter is 'bloom'. If the 'since' query parameter gives
+        a generation the caller already has the inventory at, only the
+        images added and removed since then are returned, as long as
+        those changes are still known.
+        """
+        self._enforce(req)
+        since = req.params.get('since')
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                msg = _("Generation must be an integer")
+                raise webob.exc.HTTPBadRequest(explanation=msg)
+
+        inventory_format = req.params.get('format', 'ids')
+        if inventory_format not in ('ids', 'bloom'):
+            msg = _("Format must be 'ids' or 'bloom'")
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+
+        inventory = self.cache.get_inventory(since,
+                                             inventory_format == 'bloom')
+        return dict(cache_inventory=inventory)
+
     def get_queued_images(self, req):
         """
         GET /queued_images
@@ -87,16 +126,33 @@ class Controller(controller.BaseController):
         images = self.cache.get_queued_images()
         return dict(queued_images=images)
 
+    def get_queued_images_detail(self, req):
+        """
+        GET /queued_images/detail
+
+        Returns a mapping of records about queued images, including
+        their priority and the progress of any being prefetched.
+        """
+        self._enforce(req)
+        entries = self.cache.get_queue_entries()
+        return dict(queued_images=entries)
+
     def queue_image(self, req, image_id):
         """
         PUT /queued_images/<IMAGE_ID>
 
-        Queues an image for caching. We do not check to see if
-        the image is in the registry here. That is done by the
+        Queues an image for caching, with the prefetching priority given
+        by the optional 'priority' query parameter. We do not check to
+        see if the image is in the registry here. That is done by the
         prefetcher...
         """
         self._enforce(req)
-        self.cache.queue_image(image_id)
+        try:
+            priority = int(req.params.get('priority', 0))
+        except ValueError:
+            msg = _("Priority must be an integer")
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        self.cache.queue_image(image_id, priority)
 
     def delete_queued_image(self, req, image_id):
         """
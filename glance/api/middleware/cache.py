@@ -22,23 +22,88 @@ this middleware caches the returned image file to local filesystem.
 
 When subsequent requests for the same image file are received,
 the local cached copy of the image file is returned.
+
+Image data is cached for both the v1 API, at /v1/images/<IMAGE_ID>, and
+the v2 API, at /v2/images/<IMAGE_ID>/file.
 """
 
 import httplib
 import logging
-import re
 
+import eventlet
+import routes
 import webob
+import webob.exc
 
+from glance.api import policy
 from glance.api.v1 import images
+from glance.api.v2 import image_data
 from glance.common import exception
 from glance.common import utils
 from glance.common import wsgi
 from glance import image_cache
+from glance.image_cache import peers
 from glance import registry
 
 logger = logging.getLogger(__name__)
-get_images_re = re.compile(r'^(/v\d+)*/images/([^\/]+)$')
+CHUNK_SIZE = 65536
+
+
+def make_image_mapper():
+    """
+    Returns a mapper that matches the requests the cache is interested
+    in, in every API version: downloads of image data, and updates and
+    deletions of images. Each match gives the image ID, the API version
+    and which of 'download', 'update' or 'delete' the request is.
+    """
+    mapper = routes.Mapper()
+    # Requests for /images/<IMAGE_ID> are taken to be for the v1 API
+    for path in ('/images/{image_id}', '/v1/images/{image_id}'):
+        mapper.connect(path, version='1', action='download',
+                       conditions=dict(method=['GET']))
+        mapper.connect(path, version='1', action='update',
+                       conditions=dict(method=['PUT']))
+        mapper.connect(path, version='1', action='delete',
+                       conditions=dict(method=['DELETE']))
+
+    mapper.connect('/v2/images/{image_id}/file', version='2',
+                   action='download', conditions=dict(method=['GET']))
+    mapper.connect('/v2/images/{image_id}', version='2', action='update',
+                   conditions=dict(method=['PUT']))
+    mapper.connect('/v2/images/{image_id}', version='2', action='delete',
+                   conditions=dict(method=['DELETE']))
+    return mapper
+
+
+class CachedImageFile(object):
+
+    """
+    A cached image file that can be iterated over, or read at arbitrary
+    offsets to serve ranges of it. The cache records the read as a hit
+    once the file is closed.
+    """
+
+    def __init__(self, cache, image_id):
+        self._reader = cache.open_for_read(image_id)
+        self.fp = self._reader.__enter__()
+
+    def __iter__(self):
+        try:
+            for chunk in utils.chunkiter(self.fp, CHUNK_SIZE):
+                yield chunk
+        finally:
+            self.close()
+
+    def seek(self, offset):
+        self.fp.seek(offset)
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+    def close(self):
+        if self._reader is not None:
+            reader, self._reader = self._reader, None
+            reader.__exit__(None, None, None)
 
 
 class CacheFilter(wsgi.Middleware):
@@ -47,6 +112,11 @@ class CacheFilter(wsgi.Middleware):
         self.conf = conf
         self.cache = image_cache.ImageCache(conf)
         self.serializer = images.ImageSerializer(conf)
+        self.data_serializer = image_data.ResponseSerializer()
+        self.mapper = make_image_mapper()
+        self.policy = policy.Enforcer(conf)
+        self.peers = peers.PeerCache(conf)
+        self.revalidating = set()
         logger.info(_("Initialized image cache middleware"))
         super(CacheFilter, self).__init__(app)
 
@@ -57,72 +127,254 @@ class CacheFilter(wsgi.Middleware):
         the image metadata in headers. If not present, we pass
         the request on to the next application in the pipeline.
         """
-        if request.method != 'GET':
-            return None
-
-        match = get_images_re.match(request.path)
-        if not match:
+        route = self.match_route(request)
+        if route is None or route['action'] != 'download':
             return None
 
-        image_id = match.group(2)
-
-        # /images/detail is unfortunately supported, so here we
-        # cut out those requests and anything with a query
-        # parameter...
-        # See LP Bug #879136
-        if '?' in image_id or image_id == 'detail':
-            return None
+        image_id = route['image_id']
+        version = route['version']
 
         if self.cache.is_cached(image_id):
             logger.debug(_("Cache hit for image '%s'"), image_id)
-            image_iterator = self.get_from_cache(image_id)
-            context = request.context
             try:
-                image_meta = registry.get_image_metadata(context, image_id)
+                self.policy.enforce(request.context, 'get_image', {})
+            except exception.Forbidden:
+                return webob.exc.HTTPForbidden(request=request)
 
-                if not image_meta['size']:
-                    # override image size metadata with the actual cached
-                    # file size, see LP Bug #900959
-                    image_meta['size'] = self.cache.get_image_size(image_id)
-
-                response = webob.Response(request=request)
-                return self.serializer.show(response, {
-                    'image_iterator': image_iterator,
-                    'image_meta': image_meta})
+            try:
+                image_meta = self.get_image_meta(request, image_id)
             except exception.NotFound:
                 msg = _("Image cache contained image file for image '%s', "
                         "however the registry did not contain metadata for "
                         "that image!" % image_id)
                 logger.error(msg)
-        return None
+                return None
+
+            if not image_meta['size']:
+                # override image size metadata with the actual cached
+                # file size, see LP Bug #900959
+                image_meta['size'] = self.cache.get_image_size(image_id)
+
+            if version == '1' and request.headers.get('Range'):
+                # Ranges are served by seeking within the cached file
+                image_iterator = CachedImageFile(self.cache, image_id)
+            else:
+                image_iterator = self.get_from_cache(
+                        image_id, request.environ.get('wsgi.file_wrapper'))
+            return self.serve_image(request, version, image_meta,
+                                    image_iterator)
+        elif self.cache.is_being_fetched(image_id):
+            return self.join_fetch(request, version, image_id)
+        return self.fetch_from_peer(request, image_id)
+
+    def match_route(self, request):
+        """
+        Returns the routing match for a request the cache is interested
+        in, see `make_image_mapper`, or None for any other request.
+        """
+        route = self.mapper.match(request.path_info, request.environ)
+        if route is None:
+            return None
+        # /images/detail is unfortunately supported, so here we
+        # cut out those requests...
+        # See LP Bug #879136
+        if route['version'] == '1' and route['image_id'] == 'detail':
+            return None
+        return route
+
+    def serve_image(self, request, version, image_meta, image_iterator):
+        """
+        Returns the response to a download of image data in the supplied
+        API version.
+        """
+        response = webob.Response(request=request)
+        if version == '1':
+            return self.serializer.show(response, {
+                'image_iterator': image_iterator,
+                'image_meta': image_meta})
+        self.data_serializer.download(response, {
+            'data': image_iterator,
+            'size': image_meta['size']})
+        return response
+
+    def get_image_meta(self, request, image_id):
+        """
+        Returns the metadata of a cached image. While the snapshot stored
+        with the image is younger than `image_cache_metadata_ttl` seconds
+        and shows the image to be visible to the requester, it is used
+        instead of asking the registry, and once it is past half that age
+        it is refreshed from the registry in the background. Otherwise the
+        metadata comes from the registry, and the snapshot is replaced.
+
+        :raises `exception.NotFound` if the registry has no such image
+        """
+        context = request.context
+        refresh = True
+        snapshot = self.cache.get_metadata_snapshot(image_id)
+        if snapshot is not None:
+            image_meta, age = snapshot
+            ttl = self.conf.image_cache_metadata_ttl
+            if age < ttl:
+                if self.is_visible(context, image_meta):
+                    if age >= ttl / 2.0:
+                        self.revalidate(context, image_id)
+                    return image_meta
+                # NOTE: access through image membership is only known to
+                # the registry, but a fresh snapshot needs no refreshing
+                refresh = False
+
+        image_meta = registry.get_image_metadata(context, image_id)
+        if refresh:
+            self.save_metadata_snapshot(image_id, image_meta)
+        return image_meta
+
+    def is_visible(self, context, image_meta):
+        """
+        Returns True if the metadata snapshot of an image shows it to be
+        active and visible in the supplied context.
+        """
+        if image_meta.get('status') != 'active' or image_meta.get('deleted'):
+            return False
+        if context.is_admin:
+            return True
+        if image_meta.get('is_public') or image_meta.get('owner') is None:
+            return True
+        return (context.owner is not None and
+                context.owner == image_meta['owner'])
+
+    def revalidate(self, context, image_id):
+        """
+        Refreshes the metadata snapshot of an image from the registry in
+        the background, unless that is already under way.
+        """
+        if image_id in self.revalidating:
+            return
+        self.revalidating.add(image_id)
+        eventlet.spawn_n(self._revalidate, context, image_id)
+
+    def _revalidate(self, context, image_id):
+        try:
+            image_meta = registry.get_image_metadata(context, image_id)
+        except exception.NotFound:
+            self.cache.delete_metadata_snapshot(image_id)
+        except Exception:
+            logger.exception(_("Failed to revalidate metadata snapshot of "
+                               "image '%s'") % image_id)
+        else:
+            self.save_metadata_snapshot(image_id, image_meta)
+        finally:
+            self.revalidating.discard(image_id)
+
+    def save_metadata_snapshot(self, image_id, image_meta):
+        """
+        Snapshots the metadata of an image, or removes its snapshot if the
+        image is no longer active.
+        """
+        if (image_meta.get('status') == 'active' and
+            not image_meta.get('deleted')):
+            self.cache.save_metadata_snapshot(image_id, image_meta)
+        else:
+            self.cache.delete_metadata_snapshot(image_id)
+
+    def join_fetch(self, request, version, image_id):
+        """
+        Serves an image that another request is currently fetching into
+        the cache, instead of fetching it from the backend a second time.
+        """
+        logger.debug(_("Joining shared fetch of image '%s'"), image_id)
+        try:
+            self.policy.enforce(request.context, 'get_image', {})
+        except exception.Forbidden:
+            return webob.exc.HTTPForbidden(request=request)
+
+        # NOTE: the reader is created before talking to the registry,
+        # since the fetch may complete while we wait for the metadata
+        image_iterator = self.cache.join_fetch(image_id)
+        try:
+            image_meta = registry.get_image_metadata(request.context,
+                                                     image_id)
+        except exception.NotFound:
+            image_iterator.close()
+            return None
+
+        # Without a known size we have nothing to verify the bytes sent
+        # against, so let the request go to the backend as usual
+        if not image_meta['size']:
+            image_iterator.close()
+            return None
+
+        return self.serve_image(request, version, image_meta,
+                                image_iterator)
+
+    def fetch_from_peer(self, request, image_id):
+        """
+        Serves an image owned by another API server from that server,
+        which caches it, instead of fetching it from the backend here.
+        Requests from peers, and for images owned by this server, are
+        left to go to the backend, as are requests the owner fails.
+        """
+        if peers.PEER_HEADER in request.headers:
+            return None
+
+        owner = self.peers.get_owner(image_id)
+        if owner is None:
+            return None
+
+        try:
+            status, headers, body = self.peers.fetch(owner, request.path,
+                                                     request.headers)
+        except peers.PeerFetchError, e:
+            logger.warn(_("Fetching image '%(image_id)s' from the backend "
+                          "instead: %(e)s") % locals())
+            return None
+
+        logger.debug(_("Serving image '%(image_id)s' from peer %(owner)s"),
+                     locals())
+        return webob.Response(request=request, status=status,
+                              headerlist=headers, app_iter=body)
 
     def process_response(self, resp):
         """
         We intercept the response coming back from the main
         images Resource, caching image files to the cache
         """
-        if not self.get_status_code(resp) == httplib.OK:
+        status = self.get_status_code(resp)
+        if status not in (httplib.OK, httplib.NO_CONTENT):
             return resp
 
         request = resp.request
-        if request.method not in ('GET', 'DELETE'):
+        route = self.match_route(request)
+        if route is None:
             return resp
 
-        match = get_images_re.match(request.path)
-        if match is None:
+        image_id = route['image_id']
+
+        if route['action'] == 'delete':
+            if self.cache.is_cached(image_id):
+                logger.info(_("Removing image %s from cache"), image_id)
+                self.cache.delete_cached_image(image_id)
             return resp
 
-        image_id = match.group(2)
-        if '?' in image_id or image_id == 'detail':
+        if route['action'] == 'update':
+            # The image metadata has changed, so the snapshot is stale
+            self.cache.delete_metadata_snapshot(image_id)
             return resp
 
-        if self.cache.is_cached(image_id):
-            if request.method == 'DELETE':
-                logger.info(_("Removing image %s from cache"), image_id)
-                self.cache.delete_cached_image(image_id)
+        if status != httplib.OK or self.cache.is_cached(image_id):
             return resp
 
-        resp.app_iter = self.cache.get_caching_iter(image_id, resp.app_iter)
+        if route['version'] == '1':
+            image_meta = utils.get_image_meta_from_headers(resp)
+        else:
+            # v2 downloads carry no image metadata, which the cache needs
+            # to verify the image data and snapshot its metadata
+            try:
+                image_meta = registry.get_image_metadata(request.context,
+                                                         image_id)
+            except exception.NotFound:
+                return resp
+        resp.app_iter = self.cache.get_caching_iter(image_id, resp.app_iter,
+                                                    image_meta)
         return resp
 
     def get_status_code(self, response):
@@ -134,9 +386,16 @@ class CacheFilter(wsgi.Middleware):
             return response.status_int
         return response.status
 
-    def get_from_cache(self, image_id):
-        """Called if cache hit"""
+    def get_from_cache(self, image_id, file_wrapper=None):
+        """
+        Called if cache hit. When the server supplies a wsgi.file_wrapper,
+        the cached file is handed to it, so that the server can send it
+        without copying it through Python where it knows how to.
+        """
         with self.cache.open_for_read(image_id) as cache_file:
-            chunks = utils.chunkiter(cache_file)
+            if file_wrapper is not None:
+                chunks = file_wrapper(cache_file, CHUNK_SIZE)
+            else:
+                chunks = utils.chunkiter(cache_file, CHUNK_SIZE)
             for chunk in chunks:
                 yield chunk
@@ -59,6 +59,11 @@ class CacheManageFilter(wsgi.Middleware):
                       action="get_queued_images",
                       conditions=dict(method=["GET"]))
 
+        mapper.connect("/v1/queued_images/detail",
+                      controller=resource,
+                      action="get_queued_images_detail",
+                      conditions=dict(method=["GET"]))
+
         mapper.connect("/v1/queued_images/{image_id}",
                       controller=resource,
                       action="delete_queued_image",
@@ -69,6 +74,16 @@ class CacheManageFilter(wsgi.Middleware):
                       action="delete_queued_images",
                       conditions=dict(method=["DELETE"]))
 
+        mapper.connect("/v1/cache_stats",
+                      controller=resource,
+                      action="get_cache_stats",
+                      conditions=dict(method=["GET"]))
+
+        mapper.connect("/v1/cache_inventory",
+                      controller=resource,
+                      action="get_cache_inventory",
+                      conditions=dict(method=["GET"]))
+
         self._mapper = mapper
         self._resource = resource
 
@@ -37,9 +37,11 @@ from glance.api import policy
 import glance.api.v1
 from glance.api.v1 import controller
 from glance.api.v1 import filters
+from glance.common import byteranges
 from glance.common import exception
 from glance.common import wsgi
 from glance.common import utils
+from glance.image_cache import warmer
 from glance.openstack.common import cfg
 import glance.store
 import glance.store.filesystem
@@ -97,6 +99,7 @@ class Controller(controller.BaseController):
         self.notifier = notifier.Notifier(conf)
         registry.configure_registry_client(conf)
         self.policy = policy.Enforcer(conf)
+        self.warmer = warmer.ActivationWarmer(conf)
 
     def _enforce(self, req, action):
         """Authorize an action against our policies"""
@@ -465,10 +468,16 @@ class Controller(controller.BaseController):
             self.notifier.error('image.upload', msg)
             raise HTTPBadRequest(msg, request=req)
 
+        finally:
+            # Stops reading the source image if the copy failed part way
+            if copy_from and hasattr(image_data, 'close'):
+                image_data.close()
+
     def _activate(self, req, image_id, location):
         """
         Sets the image status to `active` and the image's location
-        attribute.
+        attribute, then queues the image for caching if the cache is
+        warmed on activation.
 
         :param req: The WSGI/Webob Request object
         :param image_id: Opaque image identifier
@@ -479,9 +488,9 @@ class Controller(controller.BaseController):
         image_meta['status'] = 'active'
 
         try:
-            return registry.update_image_metadata(req.context,
-                                                  image_id,
-                                                  image_meta)
+            image_meta = registry.update_image_metadata(req.context,
+                                                        image_id,
+                                                        image_meta)
         except exception.Invalid, e:
             msg = (_("Failed to activate image. Got error: %(e)s")
                    % locals())
@@ -490,6 +499,9 @@ class Controller(controller.BaseController):
             self.notifier.error('image.update', msg)
             raise HTTPBadRequest(msg, request=req, content_type="text/plain")
 
+        self.warmer.image_activated(image_meta)
+        return image_meta
+
     def _kill(self, req, image_id):
         """
         Marks the image status to `killed`.
@@ -887,6 +899,24 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
                     " notification: %(err)s") % locals()
             logger.error(msg)
 
+    def _get_ranges(self, request, image_meta, image_size):
+        """
+        Returns the ranges of the image asked for by the Range header of
+        the request, an empty list if none of them can be satisfied, or
+        None if the whole image should be returned.
+        """
+        if request is None or image_size <= 0:
+            return None
+        range_header = request.headers.get('Range')
+        if not range_header:
+            return None
+        # A Range made conditional on another version of the image
+        # gets the whole of the current one
+        if_range = request.headers.get('If-Range')
+        if if_range and if_range.strip('"') != image_meta['checksum']:
+            return None
+        return byteranges.parse_range_header(range_header, image_size)
+
     def show(self, response, result):
         image_meta = result['image_meta']
         image_id = image_meta['id']
@@ -918,6 +948,10 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
                         "for image %(image_id)s: %(err)s") % locals()
                 logger.error(msg)
                 raise
+            finally:
+                # Stops reading from the backend if the client went away
+                if hasattr(image_iter, 'close'):
+                    image_iter.close()
 
             if expected_size != bytes_written:
                 msg = _("Backend storage for image %(image_id)s "
@@ -929,11 +963,30 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
 
         image_iter = result['image_iterator']
         # image_meta['size'] is a str
-        expected_size = int(image_meta['size'])
+        image_size = int(image_meta['size'])
+        expected_size = image_size
+        response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['Accept-Ranges'] = 'bytes'
+
+        ranges = self._get_ranges(response.request, image_meta, image_size)
+        if ranges is not None and not ranges:
+            if hasattr(image_iter, 'close'):
+                image_iter.close()
+            response.status = 416
+            response.headers['Content-Range'] = 'bytes */%d' % image_size
+            response.headers['Content-Length'] = '0'
+            return response
+        elif ranges:
+            ranged = byteranges.RangedResponse(ranges, image_size,
+                                               'application/octet-stream')
+            response.status = 206
+            response.headers.update(ranged.headers)
+            image_iter = ranged.iter_body(image_iter)
+            expected_size = ranged.content_length
+
         response.app_iter = checked_iter(image_id, expected_size, image_iter)
         # Using app_iter blanks content-length, so we set it here...
-        response.headers['Content-Length'] = image_meta['size']
-        response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['Content-Length'] = str(expected_size)
 
         self._inject_image_meta_headers(response, image_meta)
         self._inject_location_header(response, image_meta)
@@ -219,6 +219,40 @@ class V1Client(base_client.BaseClient):
         data = json.loads(res.read())['queued_images']
         return data
 
+    def get_queued_images_detail(self, **kwargs):
+        """
+        Returns a list of records about images queued for caching,
+        including the progress of any being prefetched
+        """
+        res = self.do_request("GET", "/queued_images/detail")
+        data = json.loads(res.read())['queued_images']
+        return data
+
+    def get_cache_stats(self, **kwargs):
+        """
+        Returns a mapping of statistics about the image cache
+        """
+        res = self.do_request("GET", "/cache_stats")
+        data = json.loads(res.read())['cache_stats']
+        return data
+
+    def get_cache_inventory(self, since=None, format=None):
+        """
+        Returns a mapping of the generation of the image cache and the
+        IDs of the cached images
+
+        :param since: Generation to return only the changes since
+        :param format: 'ids' for a list of IDs, 'bloom' for a Bloom filter
+        """
+        params = {}
+        if since is not None:
+            params['since'] = since
+        if format is not None:
+            params['format'] = format
+        res = self.do_request("GET", "/cache_inventory", params=params)
+        data = json.loads(res.read())['cache_inventory']
+        return data
+
     def delete_cached_image(self, image_id):
         """
         Delete a specified image from the cache
@@ -235,11 +269,17 @@ class V1Client(base_client.BaseClient):
         num_deleted = data['num_deleted']
         return num_deleted
 
-    def queue_image_for_caching(self, image_id):
+    def queue_image_for_caching(self, image_id, priority=None):
         """
         Queue an image for prefetching into cache
+
+        :param priority: Prefetching priority, higher goes first
         """
-        self.do_request("PUT", "/queued_images/%s" % image_id)
+        params = {}
+        if priority is not None:
+            params['priority'] = priority
+        self.do_request("PUT", "/queued_images/%s" % image_id,
+                        params=params)
         return True
 
     def delete_queued_image(self, image_id):
@@ -0,0 +1,231 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+"""
+Helpers for answering HTTP Range requests for image data.
+
+Ranges are parsed against the image size, sorted and merged, and then
+read either by seeking in the image data, for sources that are
+file-like, or by reading through the image data from the start and
+discarding everything outside the requested ranges for sources that
+can only be iterated over.
+"""
+
+import re
+import uuid
+
+CHUNK_SIZE = 65536
+
+# Requests asking for more ranges than this, after merging overlapping
+# and adjacent ones, are answered with the whole image instead
+MAX_RANGES = 64
+
+_RANGE_SPEC_RE = re.compile(r'^(\d*)-(\d*)$')
+
+
+def parse_range_header(header, length):
+    """
+    Returns the ranges of an image of `length` bytes requested by the
+    supplied Range header value, as a sorted list of non-overlapping
+    (start, stop) tuples, `stop` being exclusive.
+
+    Returns None when the header should be ignored and the whole image
+    returned, which is the case for headers that are malformed, use a
+    unit other than bytes, or ask for more than MAX_RANGES ranges. An
+    empty list means that none of the ranges can be satisfied.
+
+    :param header: Value of the Range header
+    :param length: Size of the image in bytes
+    """
+    unit, sep, specs = header.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+
+    if not specs.strip():
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        match = _RANGE_SPEC_RE.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            if last:
+                stop = int(last) + 1
+                if stop <= start:
+                    return None
+                stop = min(stop, length)
+            else:
+                stop = length
+        elif last:
+            # A suffix range asks for the last `last` bytes
+            start = max(length - int(last), 0)
+            stop = length
+        else:
+            return None
+        if start < stop:
+            ranges.append((start, stop))
+
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def content_range(start, stop, length):
+    """Returns the Content-Range header value for a range of an image"""
+    return 'bytes %d-%d/%d' % (start, stop - 1, length)
+
+
+class RangedResponse(object):
+
+    """
+    Describes the body of a 206 Partial Content response for a set of
+    ranges of an image: a single range is returned as-is, several are
+    returned as a multipart/byteranges document.
+    """
+
+    def __init__(self, ranges, length, content_type):
+        """
+        :param ranges: Sorted, non-overlapping list of (start, stop) tuples
+        :param length: Size of the image in bytes
+        :param content_type: Content type of the image data in each part
+        """
+        self.ranges = ranges
+        self.length = length
+        self.content_type = content_type
+        self.boundary = None
+        if len(ranges) > 1:
+            self.boundary = uuid.uuid4().hex
+
+    @property
+    def headers(self):
+        """Returns the headers describing the response body"""
+        if self.boundary is None:
+            start, stop = self.ranges[0]
+            return {'Content-Type': self.content_type,
+                    'Content-Range': content_range(start, stop,
+                                                   self.length)}
+        return {'Content-Type': ('multipart/byteranges; boundary=%s' %
+                                 self.boundary)}
+
+    def _part_header(self, start, stop):
+        return ('--%s\r\nContent-Type: %s\r\nContent-Range: %s\r\n\r\n' %
+                (self.boundary, self.content_type,
+                 content_range(start, stop, self.length)))
+
+    def _trailer(self):
+        return '--%s--\r\n' % self.boundary
+
+    @property
+    def content_length(self):
+        """Returns the size of the response body in bytes"""
+        size = sum(stop - start for start, stop in self.ranges)
+        if self.boundary is not None:
+            for start, stop in self.ranges:
+                size += len(self._part_header(start, stop)) + 2
+            size += len(self._trailer())
+        return size
+
+    def iter_body(self, image_iter):
+        """
+        Returns an iterator over the response body, reading the ranges
+        from the supplied image data. The image data is closed, if it
+        supports that, once the body has been produced.
+        """
+        current = None
+        try:
+            for start, stop, chunk in iter_ranges(image_iter, self.ranges):
+                if self.boundary is not None and start != current:
+                    if current is not None:
+                        yield '\r\n'
+                    current = start
+                    yield self._part_header(start, stop)
+                yield chunk
+            if self.boundary is not None:
+                if current is not None:
+                    yield '\r\n'
+                yield self._trailer()
+        finally:
+            if hasattr(image_iter, 'close'):
+                image_iter.close()
+
+
+def is_seekable(image_iter):
+    """Returns True if the image data can be read at arbitrary offsets"""
+    return hasattr(image_iter, 'seek') and hasattr(image_iter, 'read')
+
+
+def iter_ranges(image_iter, ranges, chunk_size=CHUNK_SIZE):
+    """
+    Returns an iterator over the data in the supplied ranges of the image,
+    as (start, stop, chunk) tuples naming the range each chunk belongs to.
+
+    :param image_iter: A file-like object, which is read by seeking to each
+                       range, or an iterator over the image data, which
+                       is read from the start, skipping ahead to each range
+    :param ranges: Sorted, non-overlapping list of (start, stop) tuples
+    :param chunk_size: Maximum size of the chunks read from file-like objects
+    """
+    if is_seekable(image_iter):
+        return _iter_seek(image_iter, ranges, chunk_size)
+    return _iter_skip(image_iter, ranges)
+
+
+def _iter_seek(fp, ranges, chunk_size):
+    for start, stop in ranges:
+        fp.seek(start)
+        offset = start
+        while offset < stop:
+            chunk = fp.read(min(chunk_size, stop - offset))
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield start, stop, chunk
+
+
+def _iter_skip(image_iter, ranges):
+    ranges = iter(ranges)
+    start, stop = ranges.next()
+    offset = 0
+    for chunk in image_iter:
+        chunk_start = offset
+        offset += len(chunk)
+        # A chunk may hold the end of one range and the start of the next
+        while start < offset:
+            begin = max(start, chunk_start) - chunk_start
+            end = min(stop, offset) - chunk_start
+            yield start, stop, chunk[begin:end]
+            if stop > offset:
+                break
+            try:
+                start, stop = ranges.next()
+            except StopIteration:
+                return
@@ -203,6 +203,11 @@ class BadDriverConfiguration(GlanceException):
                "Reason: %(reason)s")
 
 
+class ImageChecksumMismatch(GlanceException):
+    message = _("Checksum of image %(image_id)s is %(actual)s, expected "
+                "%(expected)s.")
+
+
 class StoreDeleteNotSupported(GlanceException):
     message = _("Deleting images from this store is not supported.")
 
@@ -0,0 +1,154 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Helpers for writing large image files.
+
+Image files written a chunk at a time end up scattered over the disk
+when several are written at once, and running out of space is only
+noticed once the disk fills up, possibly gigabytes into the image.
+`preallocate` reserves the space for a file of known size up front, so
+the file is laid out contiguously and a full disk is reported before
+anything is written. `DropBehind` keeps an image being streamed to disk
+from pushing everything else out of the page cache.
+
+Both use Linux system calls through ctypes where available, and degrade
+to a free space check and to doing nothing respectively elsewhere.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+
+from glance.common import exception
+
+logger = logging.getLogger(__name__)
+
+FALLOC_FL_KEEP_SIZE = 0x01
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+SYNC_FILE_RANGE_WRITE = 2
+
+# Errors meaning the file system or kernel cannot preallocate
+UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL)
+
+# Bytes of written data kept in the page cache behind a DropBehind writer
+DROP_BEHIND_WINDOW = 8 * 1024 * 1024
+
+
+def _load_libc_function(names, argtypes):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    for name in names:
+        func = getattr(libc, name, None)
+        if func is not None:
+            func.argtypes = argtypes
+            func.restype = ctypes.c_int
+            return func
+    return None
+
+
+_off_args = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+_fallocate = _load_libc_function(('fallocate64', 'fallocate'),
+                                 [ctypes.c_int] + _off_args)
+_fadvise = _load_libc_function(('posix_fadvise64', 'posix_fadvise'),
+                               _off_args + [ctypes.c_int])
+_sync_file_range = _load_libc_function(('sync_file_range',),
+                                       _off_args + [ctypes.c_uint])
+
+
+def preallocate(fd, size):
+    """
+    Reserves disk space for `size` bytes of the file open on `fd`,
+    without changing the file's apparent size. Raises StorageFull if
+    there is not enough space. Where space cannot be reserved, only
+    checks that there is enough free space.
+
+    :param fd: File descriptor of a file opened for writing
+    :param size: Number of bytes that will be written, 0 if not known
+    """
+    if not size or size <= 0:
+        return
+
+    if _fallocate is not None:
+        if _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) == 0:
+            return
+        err = ctypes.get_errno()
+        if err in (errno.ENOSPC, errno.EFBIG):
+            raise exception.StorageFull()
+        if err not in UNSUPPORTED_ERRNOS:
+            logger.warn(_("Failed to preallocate %(size)d bytes: %(error)s"),
+                        {'size': size, 'error': os.strerror(err)})
+
+    stats = os.fstatvfs(fd)
+    if stats.f_bavail * stats.f_frsize < size:
+        raise exception.StorageFull()
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Passes advice about the expected use of part of a file to the
+    kernel, if the platform supports it. Advice is only a hint, so
+    failures are ignored.
+    """
+    if _fadvise is not None:
+        _fadvise(fd, offset, length, advice)
+
+
+class DropBehind(object):
+
+    """
+    Keeps a file being written sequentially from filling the page cache.
+
+    Once a window's worth of data has been written, writeback of it is
+    started, and once the next window has been written the first is
+    dropped from the page cache, by which time it has normally reached
+    the disk. The most recently written data stays cached, so readers
+    following just behind the writer still find it in memory.
+    """
+
+    def __init__(self, fd, window=DROP_BEHIND_WINDOW):
+        """
+        :param fd: File descriptor of a file opened for writing
+        :param window: Number of bytes in each window
+        """
+        self.fd = fd
+        self.window = window
+        self.written = 0
+        self.flushed = 0
+        self.dropped = 0
+        fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+    def wrote(self, num_bytes):
+        """
+        Records that another `num_bytes` bytes were written, releasing
+        earlier windows as they fall behind.
+        """
+        self.written += num_bytes
+        while self.written - self.flushed >= self.window:
+            if self.flushed > self.dropped:
+                fadvise(self.fd, self.dropped, self.flushed - self.dropped,
+                        POSIX_FADV_DONTNEED)
+                self.dropped = self.flushed
+            if _sync_file_range is not None:
+                _sync_file_range(self.fd, self.flushed, self.window,
+                                 SYNC_FILE_RANGE_WRITE)
+            self.flushed += self.window
@@ -23,6 +23,7 @@ Utility methods for working with WSGI servers
 
 import datetime
 import errno
+import functools
 import json
 import logging
 import os
@@ -33,6 +34,7 @@ import time
 import eventlet
 import eventlet.greenio
 from eventlet.green import socket, ssl
+import eventlet.hubs
 import eventlet.wsgi
 from paste import deploy
 import routes
@@ -58,6 +60,15 @@ socket_opts = [
 
 workers_opt = cfg.IntOpt('workers', default=0)
 
+try:
+    import sendfile
+    SENDFILE_SUPPORTED = True
+except ImportError:
+    SENDFILE_SUPPORTED = False
+
+# Default block size for wsgi.file_wrapper
+FILE_WRAPPER_BLOCK_SIZE = 65536
+
 
 class WritableLogger(object):
     """A thin wrapper that responds to `write` and logs."""
@@ -70,6 +81,118 @@ class WritableLogger(object):
         self.logger.log(self.level, msg.strip("\n"))
 
 
+class SentChunk(str):
+    """
+    An empty chunk standing in for `length` bytes of a response that were
+    already written to the client with sendfile(2). Iterators wrapping the
+    response, and the server's access log, count those bytes through its
+    length, while the server itself has nothing left to write.
+    """
+
+    def __new__(cls, length):
+        chunk = str.__new__(cls, '')
+        chunk.length = length
+        return chunk
+
+    def __len__(self):
+        return self.length
+
+
+class FileWrapper(object):
+    """
+    Implements wsgi.file_wrapper for eventlet's WSGI server.
+
+    Iterating over the wrapper reads the file in blocks, like any other
+    response iterator. When sendfile(2) is available and the connection
+    is not SSL, only the first block is read that way. Once the server
+    has written it, along with the response headers, the rest of the
+    file goes straight from the file to the socket with sendfile(2), and
+    is accounted for with `SentChunk`s. This needs the response to have a
+    Content-Length, so that it is not sent with chunked encoding.
+    """
+
+    def __init__(self, filelike, blksize=FILE_WRAPPER_BLOCK_SIZE,
+                 sock=None, wfile=None):
+        """
+        :param filelike: File to send
+        :param blksize: Size of the blocks to read or send at a time
+        :param sock: Client socket to sendfile(2) to, or None
+        :param wfile: Buffered file over the client socket, flushed
+                      before using sendfile(2)
+        """
+        self.filelike = filelike
+        self.blksize = blksize
+        self.sock = sock
+        self.wfile = wfile
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+    def _sendable(self):
+        if not SENDFILE_SUPPORTED or self.sock is None:
+            return False
+        try:
+            self.filelike.fileno()
+            return True
+        except (AttributeError, IOError, OSError):
+            return False
+
+    def __iter__(self):
+        chunk = self.filelike.read(self.blksize)
+        if not chunk:
+            return
+        yield chunk
+
+        if len(chunk) < self.blksize or not self._sendable():
+            while True:
+                chunk = self.filelike.read(self.blksize)
+                if not chunk:
+                    return
+                yield chunk
+
+        # The server writes out each chunk of at least its minimum chunk
+        # size before asking for the next one, so the headers and the
+        # first block are on their way by now
+        if self.wfile is not None:
+            self.wfile.flush()
+        offset = self.filelike.tell()
+        in_fd = self.filelike.fileno()
+        out_fd = self.sock.fileno()
+        while True:
+            try:
+                sent = sendfile.sendfile(out_fd, in_fd, offset, self.blksize)
+            except OSError, e:
+                # Green sockets are non-blocking, so wait for the socket
+                # to become writable again without blocking the hub
+                if e.errno in (errno.EAGAIN, errno.EBUSY):
+                    eventlet.hubs.trampoline(out_fd, write=True)
+                    continue
+                raise
+            if not sent:
+                return
+            offset += sent
+            yield SentChunk(sent)
+
+
+class HttpProtocol(eventlet.wsgi.HttpProtocol):
+    """
+    eventlet's HTTP protocol with a wsgi.file_wrapper that can serve
+    files with sendfile(2).
+    """
+
+    def get_environ(self):
+        environ = eventlet.wsgi.HttpProtocol.get_environ(self)
+        # sendfile(2) would bypass SSL, so only use it on plain sockets
+        sock = self.connection
+        if hasattr(sock, 'getpeercert'):
+            sock = None
+        environ['wsgi.file_wrapper'] = functools.partial(FileWrapper,
+                                                         sock=sock,
+                                                         wfile=self.wfile)
+        return environ
+
+
 def get_bind_addr(conf, default_port=None):
     """Return the host and port to bind to."""
     conf.register_opts(bind_opts)
@@ -141,6 +264,7 @@ class Server(object):
         self.threads = threads
         self.children = []
         self.running = True
+        self.exiting = None
 
     def start(self, application, conf, default_port):
         """
@@ -225,18 +349,43 @@ class Server(object):
         pid = os.fork()
         if pid == 0:
             signal.signal(signal.SIGHUP, signal.SIG_DFL)
-            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, self._terminate_child)
             # ignore the interrupt signal to avoid a race whereby
             # a child worker receives the signal before the parent
             # and is respawned unneccessarily as a result
             signal.signal(signal.SIGINT, signal.SIG_IGN)
             self.run_server()
+            if self.exiting is not None:
+                # The server stops once the parent shuts the socket down,
+                # which must not race the exit handlers
+                self.exiting.wait()
             self.logger.info(_('Child %d exiting normally') % os.getpid())
             return
         else:
             self.logger.info(_('Started child %s') % pid)
             self.children.append(pid)
 
+    def _terminate_child(self, *args):
+        """
+        Ends a child worker on SIGTERM straight away, like the default
+        action does, but only once exit handlers such as the image cache's
+        flushing of buffered hits have run. The signal can interrupt the
+        eventlet hub, which must not switch to other green threads, so
+        the handlers are run from a green thread of their own.
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        self.exiting = eventlet.spawn(self._exit_child)
+
+    def _exit_child(self):
+        exitfunc = getattr(sys, 'exitfunc', None)
+        if exitfunc is not None:
+            try:
+                exitfunc()
+            except Exception:
+                self.logger.exception(_("Exit handlers of child %d failed")
+                                      % os.getpid())
+        os._exit(0)
+
     def run_server(self):
         """Run a WSGI server."""
         eventlet.wsgi.HttpProtocol.default_request_version = "HTTP/1.0"
@@ -249,7 +398,8 @@ class Server(object):
         self.pool = eventlet.GreenPool(size=self.threads)
         try:
             eventlet.wsgi.server(self.sock, self.application,
-                    log=WritableLogger(self.logger), custom_pool=self.pool)
+                    log=WritableLogger(self.logger), custom_pool=self.pool,
+                    protocol=HttpProtocol)
         except socket.error, err:
             if err[0] != errno.EINVAL:
                 raise
@@ -259,7 +409,8 @@ class Server(object):
         """Start a WSGI server in a new green thread."""
         self.logger.info(_("Starting single process server"))
         eventlet.wsgi.server(sock, application, custom_pool=self.pool,
-                             log=WritableLogger(self.logger))
+                             log=WritableLogger(self.logger),
+                             protocol=HttpProtocol)
 
 
 class Middleware(object):
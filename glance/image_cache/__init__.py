@@ -20,9 +20,17 @@ LRU Cache for Image Data
 """
 
 import logging
+import time
+
+import eventlet
 
 from glance.common import exception
 from glance.common import utils
+from glance.image_cache import admission
+from glance.image_cache import coalesce
+from glance.image_cache import inventory
+from glance.image_cache import space
+from glance.image_cache import writer
 from glance.openstack.common import cfg
 
 logger = logging.getLogger(__name__)
@@ -31,19 +39,32 @@ DEFAULT_MAX_CACHE_SIZE = 10 * 1024 * 1024 * 1024  # 10 GB
 
 class ImageCache(object):
 
-    """Provides an LRU cache for image data."""
+    """Provides a size-limited cache for image data."""
 
     opts = [
         cfg.StrOpt('image_cache_driver', default='sqlite'),
         cfg.IntOpt('image_cache_max_size', default=10 * (1024 ** 3)),  # 10 GB
         cfg.IntOpt('image_cache_stall_time', default=86400),  # 24 hours
         cfg.StrOpt('image_cache_dir'),
+        cfg.IntOpt('image_cache_dir_levels', default=0),
+        cfg.BoolOpt('image_cache_coalesce_fetches', default=False),
+        cfg.IntOpt('image_cache_hit_flush_count', default=100),
+        cfg.IntOpt('image_cache_hit_flush_interval', default=5),  # seconds
+        cfg.StrOpt('image_cache_eviction_policy', default='lru'),
+        cfg.IntOpt('image_cache_metadata_ttl', default=0),  # seconds
+        cfg.IntOpt('image_cache_inventory_history', default=10000),
         ]
 
     def __init__(self, conf):
         self.conf = conf
         self.conf.register_opts(self.opts)
+        self.fetches = {}
         self.init_driver()
+        self.init_policy()
+        self.admission = admission.get_filter(self.conf)
+        self.writers = writer.get_writers(self.conf)
+        self.space = space.get_space(self.conf, self)
+        self.inventory = inventory.Inventory(self.conf, self.driver)
 
     def init_driver(self):
         """
@@ -84,6 +105,26 @@ class ImageCache(object):
             self.driver = self.driver_class(self.conf)
             self.driver.configure()
 
+    def init_policy(self):
+        """
+        Create the eviction policy used when pruning the cache, falling
+        back to LRU if the configured policy cannot be loaded
+        """
+        policy_name = self.conf.image_cache_eviction_policy
+        policy_module = __name__ + '.policies.' + policy_name + '.Policy'
+        try:
+            policy_class = utils.import_class(policy_module)
+            logger.info(_("Image cache loaded eviction policy '%s'.") %
+                        policy_name)
+        except exception.ImportFailure, import_err:
+            logger.warn(_("Image cache eviction policy "
+                          "'%(policy_name)s' failed to load. "
+                          "Got error: '%(import_err)s.") % locals())
+            logger.info(_("Defaulting to LRU eviction policy."))
+            policy_module = __name__ + '.policies.lru.Policy'
+            policy_class = utils.import_class(policy_module)
+        self.policy = policy_class(self.conf)
+
     def is_cached(self, image_id):
         """
         Returns True if the image with the supplied ID has its image
@@ -107,6 +148,74 @@ class ImageCache(object):
         """
         return self.driver.get_cache_size()
 
+    def is_being_fetched(self, image_id):
+        """
+        Returns True if the image with the supplied ID is currently being
+        fetched into the cache by a shared fetch in this process.
+
+        :param image_id: Image ID
+        """
+        return image_id in self.fetches
+
+    def join_fetch(self, image_id):
+        """
+        Returns an iterator over the image data of an in-progress shared
+        fetch, or None if the image is not being fetched.
+
+        :param image_id: Image ID
+        """
+        fetch = self.fetches.get(image_id)
+        if fetch is None:
+            return None
+        return fetch.reader()
+
+    def admit(self, image_id):
+        """
+        Records a request for an image that is not cached, and returns
+        True if the admission filter lets the image into the cache.
+        Images explicitly queued for caching are always let in.
+
+        :param image_id: Image ID
+        """
+        queued = (self.admission.threshold > 1 and
+                  self.driver.is_queued(image_id))
+        return self.admission.admit(image_id, queued)
+
+    def get_stats(self):
+        """
+        Returns a dict of statistics about the image cache in this process.
+        """
+        return {'admission': self.admission.get_stats(),
+                'space': self.space.get_stats(),
+                'writes': self.writers.get_stats()}
+
+    def get_inventory(self, since=None, bloom_filter=False):
+        """
+        Returns a dict of the generation of the cache and either the
+        sorted IDs of the cached images, or a Bloom filter of them. If
+        `since` is a generation whose changes are still known, only the
+        IDs of the images added and removed since then are returned.
+
+        :param since: Generation the caller has the inventory at, if any
+        :param bloom_filter: Return a Bloom filter instead of the IDs
+        """
+        if since is not None:
+            delta = self.inventory.get_delta(since)
+            if delta is not None:
+                generation, added, removed = delta
+                return {'generation': generation,
+                        'since': since,
+                        'added': added,
+                        'removed': removed}
+
+        if bloom_filter:
+            generation, bloom = self.inventory.get_bloom_filter()
+            return {'generation': generation,
+                    'bloom_filter': bloom.to_dict()}
+
+        generation, images = self.inventory.get_images()
+        return {'generation': generation, 'images': images}
+
     def get_hit_count(self, image_id):
         """
         Return the number of hits that an image has
@@ -121,12 +230,20 @@ class ImageCache(object):
         """
         return self.driver.get_cached_images()
 
+    def flush_hits(self):
+        """
+        Writes out any buffered cache hit statistics.
+        """
+        self.driver.flush_hits()
+
     def delete_all_cached_images(self):
         """
         Removes all cached image files and any attributes about the images
         and returns the number of cached image files that were deleted.
         """
-        return self.driver.delete_all_cached_images()
+        deleted = self.driver.delete_all_cached_images()
+        self.driver.delete_stale_metadata_snapshots()
+        return deleted
 
     def delete_cached_image(self, image_id):
         """
@@ -135,6 +252,17 @@ class ImageCache(object):
         :param image_id: Image ID
         """
         self.driver.delete_cached_image(image_id)
+        self.driver.delete_metadata_snapshot(image_id)
+
+    def invalidate_cached_image(self, image_id):
+        """
+        Takes a corrupt image out of the cache, keeping its image file in
+        the invalid directory for inspection until it is reaped.
+
+        :param image_id: Image ID
+        """
+        self.driver.invalidate_cached_image(image_id)
+        self.driver.delete_metadata_snapshot(image_id)
 
     def delete_all_queued_images(self):
         """
@@ -168,43 +296,140 @@ class ImageCache(object):
                        "size. Starting prune to max size of %(max_size)d ") %
                      locals())
 
-        total_bytes_pruned = 0
-        total_files_pruned = 0
-        entry = self.driver.get_least_recently_accessed()
-        while entry and current_size > max_size:
-            image_id, size = entry
-            logger.debug(_("Pruning '%(image_id)s' to free %(size)d bytes"),
-                         {'image_id': image_id, 'size': size})
-            self.driver.delete_cached_image(image_id)
-            total_bytes_pruned = total_bytes_pruned + size
-            total_files_pruned = total_files_pruned + 1
-            current_size = current_size - size
-            entry = self.driver.get_least_recently_accessed()
+        # Work out everything that needs to go in one pass over the cache
+        # entries, then remove it all in a single batch
+        victims = self.select_victims(max_size, current_size)
+        image_ids = [image_id for image_id, size in victims]
+        total_bytes_pruned = sum(size for image_id, size in victims)
+
+        self.driver.delete_cached_images(image_ids)
+        total_files_pruned = len(image_ids)
 
         logger.debug(_("Pruning finished pruning. "
                        "Pruned %(total_files_pruned)d and "
                        "%(total_bytes_pruned)d.") % locals())
         return total_files_pruned, total_bytes_pruned
 
+    def select_victims(self, target_size, current_size=None):
+        """
+        Returns a list of (image_id, size) tuples of the cached images
+        the eviction policy would remove, in order, to bring the cache
+        down to `target_size` bytes.
+
+        :param target_size: Size in bytes to bring the cache down to
+        :param current_size: Current size of the cache, if already known
+        """
+        if current_size is None:
+            current_size = self.driver.get_cache_size()
+
+        self.policy.load(self.driver.get_cache_entries())
+        victims = []
+        while current_size > target_size:
+            victim = self.policy.evict()
+            if victim is None:
+                break
+            image_id, size = victim
+            logger.debug(_("Pruning '%(image_id)s' to free %(size)d bytes"),
+                         {'image_id': image_id, 'size': size})
+            victims.append(victim)
+            current_size = current_size - size
+        return victims
+
     def clean(self, stall_time=None):
         """
         Cleans up any invalid or incomplete cached images. The cache driver
         decides what that means...
+
+        Also finishes moving cache files into the layout set by
+        `image_cache_dir_levels` if it was changed.
         """
+        if self.driver.migrating:
+            self.driver.migrate_layout()
         self.driver.clean(stall_time)
+        self.driver.delete_stale_metadata_snapshots()
 
-    def queue_image(self, image_id):
+    def queue_image(self, image_id, priority=0):
         """
         This adds a image to be cache to the queue.
 
         If the image already exists in the queue or has already been
-        cached, we return False, True otherwise
+        cached, we return False, True otherwise. Queueing an image that
+        is already queued counts towards its popularity, and raises its
+        priority to the one supplied if that is higher.
+
+        :param image_id: Image ID
+        :param priority: Prefetching priority, higher goes first
+        """
+        return self.driver.queue_image(image_id, priority)
+
+    def get_queue_entries(self):
+        """
+        Returns a list of records about queued images, in the order they
+        were queued, including the progress of any being prefetched.
+        """
+        return self.driver.get_queue_entries()
+
+    def update_queue_entry(self, image_id, **values):
+        """
+        Updates the record about a queued image with the supplied values.
+
+        :param image_id: Image ID
+        """
+        self.driver.update_queue_entry(image_id, **values)
+
+    def get_queue_changed_time(self):
+        """
+        Returns the time the queue last gained an image or had an entry's
+        priority or request count raised.
+        """
+        return self.driver.get_queue_changed_time()
+
+    def save_metadata_snapshot(self, image_id, image_meta):
+        """
+        Stores a snapshot of the metadata of a cached image, so that hits
+        can be served without asking the registry for it, if snapshots
+        are enabled by `image_cache_metadata_ttl`.
+
+        :param image_id: Image ID
+        :param image_meta: Mapping of image metadata
+        """
+        if self.conf.image_cache_metadata_ttl > 0:
+            self.driver.save_metadata_snapshot(image_id, image_meta)
+
+    def _save_metadata_snapshot(self, image_id, image_meta):
+        # The image is cached by now, and can still be served without
+        # a snapshot, so failing to write one is not fatal
+        try:
+            self.save_metadata_snapshot(image_id, image_meta)
+        except Exception:
+            logger.exception(_("Failed to save metadata snapshot of "
+                               "image '%s'") % image_id)
+
+    def get_metadata_snapshot(self, image_id):
+        """
+        Returns a tuple of the metadata snapshot stored for an image and
+        its age in seconds, or None if there is no snapshot or snapshots
+        are disabled.
 
         :param image_id: Image ID
         """
-        return self.driver.queue_image(image_id)
+        if self.conf.image_cache_metadata_ttl <= 0:
+            return None
+        snapshot = self.driver.get_metadata_snapshot(image_id)
+        if snapshot is None:
+            return None
+        image_meta, saved_at = snapshot
+        return image_meta, time.time() - saved_at
 
-    def get_caching_iter(self, image_id, image_iter):
+    def delete_metadata_snapshot(self, image_id):
+        """
+        Removes the metadata snapshot stored for an image, if any.
+
+        :param image_id: Image ID
+        """
+        self.driver.delete_metadata_snapshot(image_id)
+
+    def get_caching_iter(self, image_id, image_iter, image_meta=None):
         """
         Returns an iterator that caches the contents of an image
         while the image contents are read through the supplied
@@ -212,48 +437,157 @@ class ImageCache(object):
 
         :param image_id: Image ID
         :param image_iter: Iterator that will read image contents
+        :param image_meta: Image metadata to verify the image data
+                           against, and to snapshot once the image is
+                           cached
         """
+        checksum = image_meta and image_meta.get('checksum')
+        size = image_meta and image_meta.get('size')
+        if self.conf.image_cache_metadata_ttl <= 0:
+            image_meta = None
+
+        if self.conf.image_cache_coalesce_fetches:
+            return self.get_coalescing_iter(image_id, image_iter, image_meta,
+                                            checksum, size)
+
+        if not self.admit(image_id):
+            return image_iter
+
         if not self.driver.is_cacheable(image_id):
             return image_iter
 
         logger.debug(_("Tee'ing image '%s' into cache"), image_id)
 
         def tee_iter(image_id):
+            reservation = self.space.reserve(size)
+            if reservation is None:
+                for chunk in image_iter:
+                    yield chunk
+                return
+
+            # NOTE: the image is written to the cache in the background,
+            # so a slow cache never holds up the response
+            cache_writer = self.writers.start(self.driver, image_id,
+                                             image_meta, checksum, size,
+                                             reservation)
+            completed = False
             try:
-                with self.driver.open_for_write(image_id) as cache_file:
-                    for chunk in image_iter:
-                        try:
-                            cache_file.write(chunk)
-                        finally:
-                            yield chunk
-                    cache_file.flush()
-            except Exception:
-                logger.exception(_("Exception encountered while tee'ing "
-                                   "image '%s' into cache. Continuing "
-                                   "with response.") % image_id)
-
-            # NOTE(markwash): continue responding even if caching failed
-            for chunk in image_iter:
-                yield chunk
+                for chunk in image_iter:
+                    cache_writer.write(chunk)
+                    yield chunk
+                completed = True
+            finally:
+                if completed:
+                    cache_writer.close()
+                else:
+                    cache_writer.stop('incomplete')
 
         return tee_iter(image_id)
 
-    def cache_image_iter(self, image_id, image_iter):
+    def get_coalescing_iter(self, image_id, image_iter, image_meta=None,
+                            checksum=None, size=None):
+        """
+        Returns an iterator over the image contents that is fed by a
+        single fetch shared between all concurrent requests for the
+        image. The first caller's iterator is drained into the cache by
+        a background greenthread, while every caller reads the image back
+        from the cache file as it is being written.
+
+        :param image_id: Image ID
+        :param image_iter: Iterator that will read image contents
+        :param image_meta: Image metadata to snapshot once the image
+                           is cached
+        :param checksum: Expected MD5 checksum of the image
+        :param size: Size of the image, if known
+        """
+        fetch = self.fetches.get(image_id)
+        if fetch is not None:
+            # Another request is already reading this image from the
+            # backend, so drop our own backend connection and follow it
+            if hasattr(image_iter, 'close'):
+                image_iter.close()
+            return fetch.reader()
+
+        if not self.admit(image_id):
+            return image_iter
+
+        if not self.driver.is_cacheable(image_id):
+            return image_iter
+
+        reservation = self.space.reserve(size)
+        if reservation is None:
+            return image_iter
+
+        logger.debug(_("Starting shared fetch of image '%s' into cache"),
+                     image_id)
+        fetch = coalesce.SharedFetch(
+                image_id,
+                self.driver.get_image_filepath(image_id, 'incomplete'),
+                self.driver.get_image_filepath(image_id))
+        self.fetches[image_id] = fetch
+        eventlet.spawn_n(self._run_fetch, fetch, image_iter, image_meta,
+                         checksum, size, reservation)
+        return fetch.reader()
+
+    def _run_fetch(self, fetch, image_iter, image_meta=None, checksum=None,
+                   size=None, reservation=None):
+        image_id = fetch.image_id
+        try:
+            with self.driver.open_for_write(image_id, checksum,
+                                            size) as cache_file:
+                for chunk in image_iter:
+                    cache_file.write(chunk)
+                    # Readers open the file separately, so they can
+                    # only see what has been flushed out to it
+                    cache_file.flush()
+                    fetch.notify(len(chunk))
+                    eventlet.sleep(0)
+        except Exception, e:
+            logger.exception(_("Exception encountered during shared fetch "
+                               "of image '%s' into cache.") % image_id)
+            fetch.finish(e)
+        else:
+            fetch.finish()
+            if image_meta is not None:
+                self._save_metadata_snapshot(image_id, image_meta)
+        finally:
+            del self.fetches[image_id]
+            if reservation is not None:
+                reservation.release()
+            if hasattr(image_iter, 'close'):
+                image_iter.close()
+
+    def cache_image_iter(self, image_id, image_iter, image_meta=None):
         """
         Cache an image with supplied iterator.
 
         :param image_id: Image ID
         :param image_file: Iterator retrieving image chunks
+        :param image_meta: Image metadata to verify the image data
+                           against, and to snapshot once the image is
+                           cached
 
         :retval True if image file was cached, False otherwise
+        :raises `exception.StorageFull` if there is no room for the image
         """
         if not self.driver.is_cacheable(image_id):
             return False
 
-        with self.driver.open_for_write(image_id) as cache_file:
-            for chunk in image_iter:
-                cache_file.write(chunk)
-            cache_file.flush()
+        checksum = image_meta and image_meta.get('checksum')
+        size = image_meta and image_meta.get('size')
+        reservation = self.space.reserve(size)
+        if reservation is None:
+            raise exception.StorageFull()
+        try:
+            with self.driver.open_for_write(image_id, checksum,
+                                            size) as cache_file:
+                for chunk in image_iter:
+                    cache_file.write(chunk)
+                cache_file.flush()
+        finally:
+            reservation.release()
+        if image_meta is not None:
+            self._save_metadata_snapshot(image_id, image_meta)
         return True
 
     def cache_image_file(self, image_id, image_file):
@@ -276,7 +610,8 @@ class ImageCache(object):
         with supplied identifier.
 
         :note Upon successful reading of the image file, the image's
-              hit count will be incremented.
+              hit count will be incremented. The increment is buffered
+              and written out in batches, see `flush_hits`.
 
         :param image_id: Image ID
         """
@@ -0,0 +1,186 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Frequency-based admission control for the image cache.
+
+Caching every image on its first download lets one-off downloads, such
+as snapshots pulled for export, push frequently used images out of the
+cache. The admission filter only lets an image into the cache once it has
+been requested `image_cache_admission_threshold` times, counted with a
+count-min sketch in the style of TinyLFU. Every
+`image_cache_admission_window` requests all counts are halved, so the
+counts reflect recent requests rather than all requests ever seen.
+"""
+
+import hashlib
+import logging
+import struct
+
+from glance.openstack.common import cfg
+
+logger = logging.getLogger(__name__)
+
+# One row per 32-bit word of an MD5 digest
+SKETCH_DEPTH = 4
+MAX_COUNT = 15
+
+_filters = {}
+
+
+class CountMinSketch(object):
+
+    """
+    Approximate counts of how often each key was seen, in a fixed amount
+    of memory. Counts can be overestimated because of hash collisions,
+    but never underestimated.
+    """
+
+    def __init__(self, width, depth=SKETCH_DEPTH):
+        self.width = max(width, 1)
+        self.depth = min(depth, SKETCH_DEPTH)
+        self.rows = [[0] * self.width for row in xrange(depth)]
+
+    def _indexes(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        digest = hashlib.md5(key).digest()
+        return [value % self.width for value in
+                struct.unpack('<4I', digest)[:self.depth]]
+
+    def add(self, key):
+        """
+        Counts another occurrence of `key` and returns its new estimated
+        count. Only the smallest counters are incremented (conservative
+        update), which reduces the overestimation from collisions.
+        """
+        indexes = self._indexes(key)
+        count = min(self.rows[row][index]
+                    for row, index in enumerate(indexes))
+        if count < MAX_COUNT:
+            count += 1
+            for row, index in enumerate(indexes):
+                if self.rows[row][index] < count:
+                    self.rows[row][index] = count
+        return count
+
+    def estimate(self, key):
+        """Returns the estimated count of `key`"""
+        return min(self.rows[row][index]
+                   for row, index in enumerate(self._indexes(key)))
+
+    def halve(self):
+        """Halves every count"""
+        for row in self.rows:
+            for index, value in enumerate(row):
+                if value:
+                    row[index] = value >> 1
+
+
+class AdmissionFilter(object):
+
+    """
+    Decides whether an image that missed the cache should be written into
+    it, and keeps counters of those decisions.
+    """
+
+    opts = [
+        cfg.IntOpt('image_cache_admission_threshold', default=1),
+        cfg.IntOpt('image_cache_admission_window', default=10000),
+        ]
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.conf.register_opts(self.opts)
+        self.threshold = self.conf.image_cache_admission_threshold
+        self.window = max(self.conf.image_cache_admission_window, 1)
+        if self.threshold > MAX_COUNT:
+            logger.warn(_("image_cache_admission_threshold of %(threshold)d "
+                          "is above the maximum of %(max)d, using "
+                          "%(max)d.") % {'threshold': self.threshold,
+                                         'max': MAX_COUNT})
+            self.threshold = MAX_COUNT
+        self.sketch = CountMinSketch(self.window)
+        self.samples = 0
+        self.counters = {'requests': 0,
+                         'admitted': 0,
+                         'admitted_queued': 0,
+                         'rejected': 0,
+                         'resets': 0}
+
+    def admit(self, image_id, queued=False):
+        """
+        Records a request for an image that is not cached, and returns
+        True if the image should now be written into the cache.
+
+        :param image_id: Image ID
+        :param queued: True if the image was explicitly queued for
+                       caching, which always admits it
+        """
+        self.counters['requests'] += 1
+        if self.threshold <= 1:
+            self.counters['admitted'] += 1
+            return True
+
+        count = self.sketch.add(image_id)
+        self.samples += 1
+        if self.samples >= self.window:
+            self.sketch.halve()
+            self.samples = 0
+            self.counters['resets'] += 1
+
+        if queued:
+            self.counters['admitted_queued'] += 1
+            return True
+        if count >= self.threshold:
+            self.counters['admitted'] += 1
+            return True
+        logger.debug(_("Not admitting image '%(image_id)s' into the cache "
+                       "after %(count)d of %(threshold)d requests") %
+                     {'image_id': image_id, 'count': count,
+                      'threshold': self.threshold})
+        self.counters['rejected'] += 1
+        return False
+
+    def get_stats(self):
+        """
+        Returns a dict of the filter's settings and counters.
+        """
+        stats = dict(self.counters)
+        stats['threshold'] = self.threshold
+        stats['window'] = self.window
+        return stats
+
+
+def get_filter(conf):
+    """
+    Returns the admission filter for the cache directory and settings in
+    `conf`. The filter is shared by everything in the process that uses
+    the same cache, so requests counted by the cache middleware are
+    reported by the cache management API.
+
+    :param conf: Configuration options for the image cache
+    """
+    conf.register_opts(AdmissionFilter.opts)
+    key = (conf.image_cache_dir,
+           conf.image_cache_admission_threshold,
+           conf.image_cache_admission_window)
+    admission_filter = _filters.get(key)
+    if admission_filter is None:
+        admission_filter = AdmissionFilter(conf)
+        _filters[key] = admission_filter
+    return admission_filter
@@ -0,0 +1,134 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Single-flight fetching of image data into the image cache.
+
+When fetch coalescing is enabled, the first request for an uncached image
+starts one background fetch that writes the image file into the cache.
+That request, and every request for the same image arriving while the
+fetch is still running, reads the image back from the growing cache file.
+The backend store is therefore read once per image, and since each reader
+keeps its own file offset, a slow client holds up neither the fetch nor
+the other readers.
+"""
+
+import errno
+import logging
+
+from eventlet import event
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 65536
+
+
+class SharedFetch(object):
+
+    """
+    Tracks the progress of a single image being written into the cache
+    and hands out readers that follow the writer.
+    """
+
+    def __init__(self, image_id, incomplete_path, final_path,
+                 chunk_size=CHUNK_SIZE):
+        """
+        :param image_id: Image ID
+        :param incomplete_path: Path the image file is written to
+        :param final_path: Path the image file is moved to on success
+        :param chunk_size: Maximum size of the chunks handed to readers
+        """
+        self.image_id = image_id
+        self.incomplete_path = incomplete_path
+        self.final_path = final_path
+        self.chunk_size = chunk_size
+        self.bytes_written = 0
+        self.finished = False
+        self.error = None
+        self._waiters = []
+
+    def notify(self, num_bytes):
+        """
+        Record that the writer has flushed another `num_bytes` bytes
+        to the cache file, and wake up any waiting readers.
+        """
+        self.bytes_written += num_bytes
+        self._wake()
+
+    def finish(self, error=None):
+        """
+        Record that the writer is done, either successfully or with the
+        supplied error, and wake up any waiting readers.
+        """
+        self.finished = True
+        self.error = error
+        self._wake()
+
+    def reader(self):
+        """
+        Returns an iterator over the image data that reads the cache file
+        as the writer fills it in, waiting for more data when it catches
+        up with the writer. Raises IOError if the fetch fails.
+        """
+        image_id = self.image_id
+        cache_file = None
+        offset = 0
+        try:
+            while True:
+                if self.error is not None:
+                    raise IOError(errno.EIO, _("Fetch of image %(image_id)s "
+                                               "into the cache failed") %
+                                  locals())
+                if offset < self.bytes_written:
+                    if cache_file is None:
+                        cache_file = self._open()
+                    size = min(self.chunk_size, self.bytes_written - offset)
+                    chunk = cache_file.read(size)
+                    if not chunk:
+                        raise IOError(errno.EIO, _("Cache file for image "
+                                                   "%(image_id)s was "
+                                                   "truncated") % locals())
+                    offset += len(chunk)
+                    yield chunk
+                elif self.finished:
+                    break
+                else:
+                    self._wait()
+        finally:
+            if cache_file is not None:
+                cache_file.close()
+
+    def _open(self):
+        try:
+            return open(self.incomplete_path, 'rb')
+        except IOError, e:
+            # The writer may already have committed the file, in which
+            # case it has been moved to its final location, possibly
+            # before the fetch is marked finished
+            if e.errno != errno.ENOENT:
+                raise
+            return open(self.final_path, 'rb')
+
+    def _wait(self):
+        waiter = event.Event()
+        self._waiters.append(waiter)
+        waiter.wait()
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.send()
@@ -19,15 +19,80 @@
 Base attribute driver class
 """
 
+import atexit
+import errno
+import hashlib
+import json
 import logging
-import os.path
+import os
+import re
+import time
+import weakref
+
+import eventlet
 
 from glance.common import exception
+from glance.common import fileutils
 from glance.common import utils
 
 
 logger = logging.getLogger(__name__)
 
+# Cached files may be spread over up to this many levels of shard
+# directories, each named after two hex digits of the MD5 of the image ID.
+# Image IDs are UUIDs, so they never clash with shard directory names.
+MAX_DIR_LEVELS = 2
+SHARD_RE = re.compile(r'^[0-9a-f]{2}$')
+
+# File in the base cache directory recording the layout the cache has
+# been migrated to
+LAYOUT_FILE = '.layout'
+
+# File in the queue directory touched whenever an image is queued, so the
+# prefetcher can tell that the queue changed without listing it
+QUEUE_CHANGED_FILE = '.changed'
+
+# Cache statuses whose files are moved when the layout changes. In-flight
+# incomplete files are left where their writers expect them, and like
+# invalid files are found wherever they are when they are reaped.
+MIGRATED_STATUSES = ('active', 'queue')
+
+# Drivers whose buffered hits are written out when the process exits
+_drivers = weakref.WeakSet()
+
+
+def _flush_all_hits():
+    for driver in list(_drivers):
+        driver.flush_hits()
+
+
+atexit.register(_flush_all_hits)
+
+
+class ChecksummingFile(object):
+
+    """
+    Wraps an image file opened for writing, computing the MD5 checksum
+    of the data as it is written, and dropping data that has reached
+    the disk from the page cache.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.md5 = hashlib.md5()
+        self.drop_behind = fileutils.DropBehind(cache_file.fileno())
+
+    def write(self, data):
+        self.md5.update(data)
+        self.cache_file.write(data)
+        self.drop_behind.wrote(len(data))
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.cache_file, name)
+
 
 class Driver(object):
 
@@ -41,6 +106,13 @@ class Driver(object):
         """
         self.conf = conf or {}
 
+        # Hits are buffered as a mapping of image ID to a tuple of
+        # (number of hits, time of last hit) until they are flushed
+        self.pending_hits = {}
+        self.num_pending_hits = 0
+        self.flush_timer = None
+        _drivers.add(self)
+
     def configure(self):
         """
         Configure the driver to use the stored configuration options
@@ -69,12 +141,92 @@ class Driver(object):
         self.incomplete_dir = os.path.join(self.base_dir, 'incomplete')
         self.invalid_dir = os.path.join(self.base_dir, 'invalid')
         self.queue_dir = os.path.join(self.base_dir, 'queue')
+        self.metadata_dir = os.path.join(self.base_dir, 'metadata')
 
-        dirs = [self.incomplete_dir, self.invalid_dir, self.queue_dir]
+        dirs = [self.incomplete_dir, self.invalid_dir, self.queue_dir,
+                self.metadata_dir]
 
         for path in dirs:
             utils.safe_mkdirs(path)
 
+        self.dir_levels = self.conf.image_cache_dir_levels
+        if not 0 <= self.dir_levels <= MAX_DIR_LEVELS:
+            msg = (_('image_cache_dir_levels must be between 0 and %d') %
+                   MAX_DIR_LEVELS)
+            logger.error(msg)
+            driver = self.__class__.__module__
+            raise exception.BadDriverConfiguration(driver_name=driver,
+                                                   reason=msg)
+        self.shard_dirs = set(dirs)
+        self.layout_path = os.path.join(self.base_dir, LAYOUT_FILE)
+        self.queue_changed_path = os.path.join(self.queue_dir,
+                                               QUEUE_CHANGED_FILE)
+        self.old_dir_levels = self.get_layout()
+        self.migrating = self.old_dir_levels != self.dir_levels
+
+    def get_layout(self):
+        """
+        Returns the number of shard directory levels the cache directory
+        was last fully migrated to. Caches that were never migrated use
+        the original flat layout.
+        """
+        try:
+            with open(self.layout_path) as layout_file:
+                return int(layout_file.read().strip())
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+        except ValueError:
+            logger.warn(_("Ignoring unreadable image cache layout file %s"),
+                        self.layout_path)
+            return 0
+
+    def migrate_layout(self):
+        """
+        Moves every cached and queued image file written under a different
+        layout to where the configured layout expects it, then records the
+        configured layout. Returns the number of files moved.
+
+        Lookups move the files they need themselves while a migration is
+        pending, so the cache stays usable while this runs.
+        """
+        moved = 0
+        for cache_status in MIGRATED_STATUSES:
+            if cache_status == 'active':
+                basepath = self.base_dir
+            else:
+                basepath = os.path.join(self.base_dir, cache_status)
+            for path in self.get_cache_files(basepath):
+                image_id = os.path.basename(path)
+                new_path = self.get_image_filepath(image_id, cache_status,
+                                                   migrate=False)
+                if path != new_path and self._move(path, new_path):
+                    moved += 1
+
+        with open(self.layout_path + '.tmp', 'w') as layout_file:
+            layout_file.write('%d\n' % self.dir_levels)
+        os.rename(self.layout_path + '.tmp', self.layout_path)
+        self.old_dir_levels = self.dir_levels
+        self.migrating = False
+        logger.info(_("Moved %(moved)d image cache files to a layout with "
+                      "%(levels)d levels of shard directories"),
+                    {'moved': moved, 'levels': self.dir_levels})
+        return moved
+
+    def _move(self, path, new_path):
+        """
+        Renames a cache file, returning False if another process got to
+        it first.
+        """
+        try:
+            os.rename(path, new_path)
+            return True
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
     def get_cache_size(self):
         """
         Returns the total size in bytes of the image cache.
@@ -156,12 +308,13 @@ class Driver(object):
         """
         raise NotImplementedError
 
-    def queue_image(self, image_id):
+    def queue_image(self, image_id, priority=0):
         """
         Puts an image identifier in a queue for caching. Return True
         on successful add to the queue, False otherwise...
 
         :param image_id: Image ID
+        :param priority: Prefetching priority, higher goes first
         """
 
     def clean(self, stall_time=None):
@@ -171,17 +324,182 @@ class Driver(object):
         """
         raise NotImplementedError
 
+    def delete_cached_images(self, image_ids):
+        """
+        Removes the cached image files and any attributes about the images
+        with the supplied IDs, as a single batch where the driver allows.
+
+        :param image_ids: List of image IDs
+        """
+        for image_id in image_ids:
+            self.delete_cached_image(image_id)
+
     def get_least_recently_accessed(self):
         """
         Return a tuple containing the image_id and size of the least recently
         accessed cached file, or None if no cached files.
         """
+        for entry in self.get_least_recently_accessed_images():
+            return entry
+        return None
+
+    def get_least_recently_accessed_images(self):
+        """
+        Return an iterator over tuples containing the image_id and size of
+        every cached file, least recently accessed first.
+        """
         raise NotImplementedError
 
-    def open_for_write(self, image_id):
+    def get_cache_entries(self):
+        """
+        Return an iterator over tuples of (image_id, size, hits,
+        last_accessed) for every cached file, for use by eviction policies.
+        Entries need not be in any particular order.
+        """
+        raise NotImplementedError
+
+    def get_generation(self):
+        """
+        Returns the generation number of the last change to the set of
+        cached images. Every image added to or removed from the cache
+        gets the next generation number.
+        """
+        raise NotImplementedError
+
+    def get_changes(self, since):
+        """
+        Returns a list of (generation, image_id, cached) tuples of the
+        changes to the set of cached images after generation `since`, in
+        order, where `cached` is True for an image that was added and
+        False for one that was removed. Returns None if some of those
+        changes have been trimmed from the history, or `since` is not a
+        generation of this cache.
+
+        :param since: Generation number
+        """
+        raise NotImplementedError
+
+    def trim_changes(self, keep):
+        """
+        Forgets all but the last `keep` changes to the set of cached
+        images.
+        """
+        raise NotImplementedError
+
+    def record_hit(self, image_id):
+        """
+        Buffers a hit on a cached image. Buffered hits are written out by
+        `flush_hits` once `image_cache_hit_flush_count` hits have been
+        buffered or `image_cache_hit_flush_interval` seconds have passed,
+        whichever comes first.
+
+        :param image_id: Image ID
+        """
+        hits, last_accessed = self.pending_hits.get(image_id, (0, None))
+        self.pending_hits[image_id] = (hits + 1, time.time())
+        self.num_pending_hits += 1
+
+        if self.num_pending_hits >= self.conf.image_cache_hit_flush_count:
+            self.flush_hits()
+        elif self.flush_timer is None:
+            self.flush_timer = eventlet.spawn_after(
+                    self.conf.image_cache_hit_flush_interval, self.flush_hits)
+
+    def flush_hits(self):
+        """
+        Writes out all buffered hits in a single batch.
+        """
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        hits, self.pending_hits = self.pending_hits, {}
+        self.num_pending_hits = 0
+        if not hits:
+            return
+
+        try:
+            self.write_hits(hits)
+        except Exception:
+            logger.exception(_("Failed to write %d buffered cache hits"),
+                             sum(count for count, last in hits.values()))
+
+    def discard_hits(self, image_id):
+        """
+        Drops any buffered hits on an image that is no longer cached.
+
+        :param image_id: Image ID
+        """
+        hits, last_accessed = self.pending_hits.pop(image_id, (0, None))
+        self.num_pending_hits -= hits
+
+    def write_hits(self, hits):
+        """
+        Persists a batch of buffered hits.
+
+        :param hits: Mapping of image ID to a tuple of the number of hits
+                     and the time of the last hit
+        """
+        raise NotImplementedError
+
+    def open_for_write(self, image_id, checksum=None, size=None):
         """
         Open a file for writing the image file for an image
-        with supplied identifier.
+        with supplied identifier. The MD5 checksum of the data written
+        is recorded with the cached image. If it does not match the
+        supplied checksum, the image file is moved to the invalid
+        directory instead of being committed, and ImageChecksumMismatch
+        is raised.
+
+        If the size of the image is supplied, disk space is reserved
+        for it before anything is written, and StorageFull is raised
+        straight away if there is not enough.
+
+        :param image_id: Image ID
+        :param checksum: Expected MD5 checksum of the image, if known
+        :param size: Size of the image in bytes, if known
+        """
+        raise NotImplementedError
+
+    def verify_checksum(self, image_id, cache_file, checksum):
+        """
+        Returns the checksum of the data written to a `ChecksummingFile`,
+        raising ImageChecksumMismatch if it is not the expected one.
+
+        :param image_id: Image ID
+        :param cache_file: `ChecksummingFile` the image was written to
+        :param checksum: Expected MD5 checksum, or None to skip the check
+        """
+        actual = cache_file.hexdigest()
+        if checksum is not None and actual != checksum:
+            raise exception.ImageChecksumMismatch(image_id=image_id,
+                                                  actual=actual,
+                                                  expected=checksum)
+        return actual
+
+    def get_checksum(self, image_id):
+        """
+        Returns the MD5 checksum recorded for a cached image, or None if
+        none was recorded, as for images cached by older releases.
+
+        :param image_id: Image ID
+        """
+        raise NotImplementedError
+
+    def set_checksum(self, image_id, checksum):
+        """
+        Records the MD5 checksum of a cached image.
+
+        :param image_id: Image ID
+        :param checksum: MD5 checksum of the image file
+        """
+        raise NotImplementedError
+
+    def invalidate_cached_image(self, image_id):
+        """
+        Moves a cached image file that turned out to be corrupt to the
+        invalid directory, where it is kept for inspection until it is
+        reaped, and forgets about the cached image.
 
         :param image_id: Image ID
         """
@@ -196,16 +514,73 @@ class Driver(object):
         """
         raise NotImplementedError
 
-    def get_image_filepath(self, image_id, cache_status='active'):
+    def get_image_filepath(self, image_id, cache_status='active',
+                           migrate=True):
         """
-        This crafts an absolute path to a specific entry
+        This crafts an absolute path to a specific entry, creating the
+        shard directories it goes in if needed. While a layout migration
+        is pending, a cached or queued file found where the old layout
+        put it is moved into place first.
 
         :param image_id: Image ID
         :param cache_status: Status of the image in the cache
-        """
+        :param migrate: Whether to move a file left by the old layout
+        """
+        path = self._get_image_filepath(image_id, cache_status,
+                                        self.dir_levels)
+        if self.dir_levels:
+            dirname = os.path.dirname(path)
+            if dirname not in self.shard_dirs:
+                utils.safe_mkdirs(dirname)
+                self.shard_dirs.add(dirname)
+
+        if (migrate and self.migrating and
+            cache_status in MIGRATED_STATUSES and not os.path.exists(path)):
+            old_path = self._get_image_filepath(image_id, cache_status,
+                                                self.old_dir_levels)
+            self._move(old_path, path)
+        return path
+
+    def _get_image_filepath(self, image_id, cache_status, levels):
+        image_id = str(image_id)
         if cache_status == 'active':
-            return os.path.join(self.base_dir, str(image_id))
-        return os.path.join(self.base_dir, cache_status, str(image_id))
+            parts = [self.base_dir]
+        else:
+            parts = [self.base_dir, cache_status]
+        if levels:
+            digest = hashlib.md5(image_id).hexdigest()
+            parts.extend(digest[level * 2:level * 2 + 2]
+                         for level in xrange(levels))
+        parts.append(image_id)
+        return os.path.join(*parts)
+
+    def get_cache_files(self, basepath):
+        """
+        Returns cache files in the supplied directory and in any shard
+        directories under it, whatever layout they were written with
+
+        :param basepath: Directory to look in for cache files
+        """
+        return self._walk_cache_files(basepath, 0)
+
+    def _walk_cache_files(self, dirpath, depth):
+        try:
+            fnames = os.listdir(dirpath)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for fname in fnames:
+            if fname.startswith('.'):
+                continue
+            path = os.path.join(dirpath, fname)
+            if depth < MAX_DIR_LEVELS and SHARD_RE.match(fname):
+                if os.path.isdir(path):
+                    for sub_path in self._walk_cache_files(path, depth + 1):
+                        yield sub_path
+                    continue
+            if os.path.isfile(path):
+                yield path
 
     def get_image_size(self, image_id):
         """
@@ -224,3 +599,204 @@ class Driver(object):
         into the queue.
         """
         raise NotImplementedError
+
+    def _add_queue_entry(self, image_id, priority):
+        """
+        Adds an image to the queue, or counts another request to prefetch
+        an image that is already queued. Returns True if it was added.
+        """
+        if self.is_queued(image_id):
+            entry = self.get_queue_entry(image_id)
+            self.update_queue_entry(image_id,
+                                    priority=max(entry['priority'], priority),
+                                    requests=entry['requests'] + 1)
+            self._touch_queue_changed()
+            return False
+        path = self.get_image_filepath(image_id, 'queue')
+        with open(path, 'w') as queue_file:
+            json.dump({'priority': priority}, queue_file)
+        self._touch_queue_changed()
+        return True
+
+    def _touch_queue_changed(self):
+        with open(self.queue_changed_path, 'a'):
+            os.utime(self.queue_changed_path, None)
+
+    def get_queue_changed_time(self):
+        """
+        Returns the time an image was last queued, or a priority or
+        request count bumped, or 0 if that never happened.
+        """
+        try:
+            return os.path.getmtime(self.queue_changed_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    def get_queue_entry(self, image_id):
+        """
+        Returns a dict describing a queued image, or None if the image is
+        not queued. Besides the image ID and the time it was queued at,
+        the entry holds the prefetching priority, the number of times the
+        image was queued, the number of failed attempts to fetch it, and
+        its state, either 'queued', 'fetching' or 'failed'. While an image
+        is being fetched, the entry also holds its size and the number of
+        bytes fetched so far.
+
+        :param image_id: Image ID
+        """
+        path = self.get_image_filepath(image_id, 'queue')
+        try:
+            with open(path) as queue_file:
+                contents = queue_file.read()
+            queued_at = os.path.getmtime(path)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        entry = {'priority': 0, 'requests': 1, 'attempts': 0,
+                 'state': 'queued', 'size': None}
+        # Queue files written before entries were recorded are empty
+        if contents:
+            try:
+                entry.update(json.loads(contents))
+            except ValueError:
+                logger.warn(_("Ignoring unreadable queue entry %s"), path)
+        entry['image_id'] = image_id
+        entry['queued_at'] = queued_at
+        entry['bytes_fetched'] = 0
+        if entry['state'] == 'fetching':
+            try:
+                entry['bytes_fetched'] = os.path.getsize(
+                        self.get_image_filepath(image_id, 'incomplete'))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return entry
+
+    def get_queue_entries(self):
+        """
+        Returns a list of entries describing the queued images, in the
+        order they were queued. See `get_queue_entry`.
+        """
+        entries = []
+        for image_id in self.get_queued_images():
+            entry = self.get_queue_entry(image_id)
+            if entry is not None:
+                entries.append(entry)
+        return entries
+
+    def update_queue_entry(self, image_id, **values):
+        """
+        Updates the entry of a queued image with the supplied values,
+        keeping its place in the queue. Does nothing if the image is no
+        longer queued.
+
+        :param image_id: Image ID
+        """
+        entry = self.get_queue_entry(image_id)
+        if entry is None:
+            return
+        entry.update(values)
+        for key in ('image_id', 'queued_at', 'bytes_fetched'):
+            del entry[key]
+
+        path = self.get_image_filepath(image_id, 'queue')
+        tmp_path = os.path.join(os.path.dirname(path),
+                                '.%s.tmp' % os.path.basename(path))
+        with open(tmp_path, 'w') as queue_file:
+            json.dump(entry, queue_file)
+        # The queue is ordered by modification time
+        queued_at = os.path.getmtime(path)
+        os.utime(tmp_path, (queued_at, queued_at))
+        os.rename(tmp_path, path)
+
+    def save_metadata_snapshot(self, image_id, image_meta):
+        """
+        Stores a snapshot of the metadata of a cached image alongside its
+        image file, replacing any earlier snapshot.
+
+        :param image_id: Image ID
+        :param image_meta: Mapping of image metadata
+        """
+        path = self.get_image_filepath(image_id, 'metadata')
+        # Written under a dotfile name, so it is never listed half-written
+        tmp_path = os.path.join(os.path.dirname(path),
+                                '.%s.tmp' % os.path.basename(path))
+        with open(tmp_path, 'w') as snapshot_file:
+            json.dump({'saved_at': time.time(), 'image_meta': image_meta},
+                      snapshot_file)
+        os.rename(tmp_path, path)
+
+    def get_metadata_snapshot(self, image_id):
+        """
+        Returns a tuple of the metadata snapshot stored for an image and
+        the time it was stored at, or None if there is no snapshot.
+
+        :param image_id: Image ID
+        """
+        path = self.get_image_filepath(image_id, 'metadata')
+        try:
+            with open(path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            logger.warn(_("Ignoring unreadable metadata snapshot %s"), path)
+            return None
+        return snapshot['image_meta'], snapshot['saved_at']
+
+    def delete_metadata_snapshot(self, image_id):
+        """
+        Removes the metadata snapshot stored for an image, if any.
+
+        :param image_id: Image ID
+        """
+        path = self.get_image_filepath(image_id, 'metadata')
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def delete_stale_metadata_snapshots(self):
+        """
+        Removes the metadata snapshots of images that are no longer
+        cached, or that were written under a different layout, and
+        returns the number of snapshots removed.
+        """
+        removed = 0
+        for path in list(self.get_cache_files(self.metadata_dir)):
+            image_id = os.path.basename(path)
+            if (path != self.get_image_filepath(image_id, 'metadata') or
+                not self.is_cached(image_id)):
+                try:
+                    os.unlink(path)
+                    removed += 1
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        return removed
+
+
+def check_changes(changes, since, generation):
+    """
+    Returns the list of changes after generation `since` read from a
+    change history, or None if the history does not reach back to it.
+
+    :param changes: List of (generation, image_id, cached) tuples read
+                    from the history, up to `generation`
+    :param since: Generation the changes were asked for after
+    :param generation: Current generation
+    """
+    if since > generation:
+        return None
+    if since == generation:
+        return []
+    if not changes or changes[0][0] != since + 1:
+        return None
+    return changes
@@ -23,18 +23,26 @@ from __future__ import absolute_import
 from contextlib import contextmanager
 import logging
 import os
-import stat
 import time
 
 from eventlet import sleep, timeout
 import sqlite3
 
 from glance.common import exception
+from glance.common import fileutils
 from glance.image_cache.drivers import base
 from glance.openstack.common import cfg
 
 logger = logging.getLogger(__name__)
 DEFAULT_SQL_CALL_TIMEOUT = 2
+BUSY_STRATEGIES = ('fixed', 'backoff')
+BUSY_DELAY = 0.05
+BUSY_MIN_DELAY = 0.001
+
+# Number of compiled statements each pooled connection keeps around
+CACHED_STATEMENTS = 32
+
+_pools = {}
 
 
 class SqliteConnection(sqlite3.Connection):
@@ -42,14 +50,24 @@ class SqliteConnection(sqlite3.Connection):
     """
     SQLite DB Connection handler that plays well with eventlet,
     slightly modified from Swift's similar code.
+
+    When the database is locked, the call is retried, sleeping
+    cooperatively between attempts, until the call timeout expires. With
+    the 'fixed' busy strategy we sleep for the same interval each time,
+    with 'backoff' we start small and double the interval on each retry.
     """
 
     def __init__(self, *args, **kwargs):
         self.timeout_seconds = kwargs.get('timeout', DEFAULT_SQL_CALL_TIMEOUT)
+        self.busy_strategy = 'fixed'
         kwargs['timeout'] = 0
         sqlite3.Connection.__init__(self, *args, **kwargs)
 
     def _timeout(self, call):
+        if self.busy_strategy == 'backoff':
+            delay = BUSY_MIN_DELAY
+        else:
+            delay = BUSY_DELAY
         with timeout.Timeout(self.timeout_seconds):
             while True:
                 try:
@@ -57,16 +75,94 @@ class SqliteConnection(sqlite3.Connection):
                 except sqlite3.OperationalError, e:
                     if 'locked' not in str(e):
                         raise
-                sleep(0.05)
+                sleep(delay)
+                if self.busy_strategy == 'backoff':
+                    delay = min(delay * 2, BUSY_DELAY)
 
     def execute(self, *args, **kwargs):
         return self._timeout(lambda: sqlite3.Connection.execute(
                                         self, *args, **kwargs))
 
+    def executemany(self, *args, **kwargs):
+        return self._timeout(lambda: sqlite3.Connection.executemany(
+                                        self, *args, **kwargs))
+
     def commit(self):
         return self._timeout(lambda: sqlite3.Connection.commit(self))
 
 
+class ConnectionPool(object):
+
+    """
+    A per-process pool of open connections to the cache database.
+
+    Opening a connection and setting it up costs far more than the
+    queries the driver runs, so connections are kept open and handed out
+    to one caller at a time. Each connection also keeps its statements
+    compiled between uses. The pool never blocks: if no idle connection
+    is available a new one is opened, and it is closed again on release
+    if the pool is already full. Connections are not carried across a
+    fork, since SQLite does not support using them in the child process.
+    """
+
+    def __init__(self, db_path, size, timeout_seconds, busy_strategy):
+        self.db_path = db_path
+        self.size = size
+        self.timeout_seconds = timeout_seconds
+        self.busy_strategy = busy_strategy
+        self.pid = os.getpid()
+        self.idle = []
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               factory=SqliteConnection,
+                               cached_statements=CACHED_STATEMENTS)
+        conn.timeout_seconds = self.timeout_seconds
+        conn.busy_strategy = self.busy_strategy
+        conn.row_factory = sqlite3.Row
+        conn.text_factory = str
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA count_changes = OFF')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def get(self):
+        """Returns an open connection for the caller's exclusive use"""
+        if os.getpid() != self.pid:
+            # We have been forked; forget the parent's connections
+            self.pid = os.getpid()
+            self.idle = []
+        if self.idle:
+            return self.idle.pop()
+        return self.connect()
+
+    def put(self, conn):
+        """Returns a connection obtained from `get` to the pool"""
+        if os.getpid() == self.pid and len(self.idle) < self.size:
+            self.idle.append(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        """Closes all idle connections"""
+        idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+def get_pool(db_path, size, timeout_seconds, busy_strategy):
+    """
+    Returns the connection pool for the supplied database, creating it if
+    needed, so that all drivers in a process using the same database
+    share their connections.
+    """
+    pool = _pools.get(db_path)
+    if pool is None:
+        pool = ConnectionPool(db_path, size, timeout_seconds, busy_strategy)
+        _pools[db_path] = pool
+    return pool
+
+
 def dict_factory(cur, row):
     return dict(
         ((col[0], row[idx]) for idx, col in enumerate(cur.description)))
@@ -81,6 +177,10 @@ class Driver(base.Driver):
 
     opts = [
         cfg.StrOpt('image_cache_sqlite_db', default='cache.db'),
+        cfg.IntOpt('image_cache_sqlite_pool_size', default=10),
+        cfg.IntOpt('image_cache_sqlite_busy_timeout',
+                   default=DEFAULT_SQL_CALL_TIMEOUT),
+        cfg.StrOpt('image_cache_sqlite_busy_strategy', default='fixed'),
         ]
 
     def configure(self):
@@ -100,9 +200,23 @@ class Driver(base.Driver):
     def initialize_db(self):
         db = self.conf.image_cache_sqlite_db
         self.db_path = os.path.join(self.base_dir, db)
+
+        busy_strategy = self.conf.image_cache_sqlite_busy_strategy
+        if busy_strategy not in BUSY_STRATEGIES:
+            logger.warn(_("Unknown image_cache_sqlite_busy_strategy '%s'. "
+                          "Defaulting to 'fixed'."), busy_strategy)
+            busy_strategy = 'fixed'
+        self.pool = get_pool(self.db_path,
+                             self.conf.image_cache_sqlite_pool_size,
+                             self.conf.image_cache_sqlite_busy_timeout,
+                             busy_strategy)
         try:
             conn = sqlite3.connect(self.db_path, check_same_thread=False,
                                    factory=SqliteConnection)
+            # WAL lets readers run alongside a writer instead of
+            # contending with it for the database lock. The journal
+            # mode is persistent, so this only needs doing once.
+            conn.execute('PRAGMA journal_mode = WAL')
             conn.executescript("""
                 CREATE TABLE IF NOT EXISTS cached_images (
                     image_id TEXT PRIMARY KEY,
@@ -112,8 +226,59 @@ class Driver(base.Driver):
                     hits INTEGER DEFAULT 0,
                     checksum TEXT
                 );
+                CREATE INDEX IF NOT EXISTS cached_images_last_accessed
+                    ON cached_images (last_accessed);
+
+                -- The total size of the cache is kept up to date by
+                -- triggers, so that it never has to be summed up
+                CREATE TABLE IF NOT EXISTS cache_size (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    total INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO cache_size (id, total)
+                    SELECT 0, COALESCE(SUM(size), 0) FROM cached_images;
+                CREATE TRIGGER IF NOT EXISTS cache_size_insert
+                    AFTER INSERT ON cached_images
+                    BEGIN
+                        UPDATE cache_size SET total = total + NEW.size;
+                    END;
+                CREATE TRIGGER IF NOT EXISTS cache_size_delete
+                    AFTER DELETE ON cached_images
+                    BEGIN
+                        UPDATE cache_size SET total = total - OLD.size;
+                    END;
+                CREATE TRIGGER IF NOT EXISTS cache_size_update
+                    AFTER UPDATE OF size ON cached_images
+                    BEGIN
+                        UPDATE cache_size
+                            SET total = total - OLD.size + NEW.size;
+                    END;
+
+                -- Every image added to or removed from the cache is
+                -- recorded under a new generation number, so that the
+                -- cache inventory can be kept up to date incrementally
+                CREATE TABLE IF NOT EXISTS cache_changes (
+                    generation INTEGER PRIMARY KEY AUTOINCREMENT,
+                    image_id TEXT NOT NULL,
+                    cached INTEGER NOT NULL
+                );
+                CREATE TRIGGER IF NOT EXISTS cache_changes_insert
+                    AFTER INSERT ON cached_images
+                    BEGIN
+                        INSERT INTO cache_changes (image_id, cached)
+                            VALUES (NEW.image_id, 1);
+                    END;
+                CREATE TRIGGER IF NOT EXISTS cache_changes_delete
+                    AFTER DELETE ON cached_images
+                    BEGIN
+                        INSERT INTO cache_changes (image_id, cached)
+                            VALUES (OLD.image_id, 0);
+                    END;
             """)
             conn.close()
+            # Drop any connections that were opened to a database
+            # file which has since been replaced
+            self.pool.close()
         except sqlite3.DatabaseError, e:
             msg = _("Failed to initialize the image cache database. "
                     "Got error: %s") % e
@@ -125,13 +290,9 @@ class Driver(base.Driver):
         """
         Returns the total size in bytes of the image cache.
         """
-        sizes = []
-        for path in self.get_cache_files(self.base_dir):
-            if path == self.db_path:
-                continue
-            file_info = os.stat(path)
-            sizes.append(file_info[stat.ST_SIZE])
-        return sum(sizes)
+        with self.get_db() as db:
+            cur = db.execute("""SELECT total FROM cache_size""")
+            return cur.fetchone()[0]
 
     def get_hit_count(self, image_id):
         """
@@ -142,6 +303,7 @@ class Driver(base.Driver):
         if not self.is_cached(image_id):
             return 0
 
+        self.flush_hits()
         hits = 0
         with self.get_db() as db:
             cur = db.execute("""SELECT hits FROM cached_images
@@ -155,6 +317,7 @@ class Driver(base.Driver):
         Returns a list of records about cached images.
         """
         logger.debug(_("Gathering cached image entries."))
+        self.flush_hits()
         with self.get_db() as db:
             cur = db.execute("""SELECT
                              image_id, hits, last_accessed, last_modified, size
@@ -207,6 +370,8 @@ class Driver(base.Driver):
         Removes all cached image files and any attributes about the images
         """
         deleted = 0
+        self.pending_hits = {}
+        self.num_pending_hits = 0
         with self.get_db() as db:
             for path in self.get_cache_files(self.base_dir):
                 delete_cached_file(path)
@@ -222,12 +387,70 @@ class Driver(base.Driver):
         :param image_id: Image ID
         """
         path = self.get_image_filepath(image_id)
+        self.discard_hits(image_id)
         with self.get_db() as db:
             delete_cached_file(path)
             db.execute("""DELETE FROM cached_images WHERE image_id = ?""",
                        (image_id, ))
             db.commit()
 
+    def invalidate_cached_image(self, image_id):
+        """
+        Moves a corrupt cached image file to the invalid directory and
+        forgets about the cached image.
+
+        :param image_id: Image ID
+        """
+        path = self.get_image_filepath(image_id)
+        invalid_path = self.get_image_filepath(image_id, 'invalid')
+        self.discard_hits(image_id)
+        with self.get_db() as db:
+            logger.debug(_("Moving corrupt cache file '%(path)s' to "
+                           "'%(invalid_path)s'") % locals())
+            self._move(path, invalid_path)
+            db.execute("""DELETE FROM cached_images WHERE image_id = ?""",
+                       (image_id, ))
+            db.commit()
+
+    def get_checksum(self, image_id):
+        """
+        Returns the MD5 checksum recorded for a cached image, or None.
+
+        :param image_id: Image ID
+        """
+        with self.get_db() as db:
+            row = db.execute("""SELECT checksum FROM cached_images
+                             WHERE image_id = ?""", (image_id, )).fetchone()
+            return row[0] if row is not None else None
+
+    def set_checksum(self, image_id, checksum):
+        """
+        Records the MD5 checksum of a cached image.
+
+        :param image_id: Image ID
+        :param checksum: MD5 checksum of the image file
+        """
+        with self.get_db() as db:
+            db.execute("""UPDATE cached_images SET checksum = ?
+                       WHERE image_id = ?""", (checksum, image_id))
+            db.commit()
+
+    def delete_cached_images(self, image_ids):
+        """
+        Removes the cached image files and any attributes about the images
+        with the supplied IDs in a single transaction.
+
+        :param image_ids: List of image IDs
+        """
+        for image_id in image_ids:
+            self.discard_hits(image_id)
+        with self.get_db() as db:
+            for image_id in image_ids:
+                delete_cached_file(self.get_image_filepath(image_id))
+            db.executemany("""DELETE FROM cached_images WHERE image_id = ?""",
+                           [(image_id, ) for image_id in image_ids])
+            db.commit()
+
     def delete_all_queued_images(self):
         """
         Removes all queued image files and any attributes about the images
@@ -262,31 +485,101 @@ class Driver(base.Driver):
         older_than = now - stall_time
         self.delete_stalled_files(older_than)
 
+        self.trim_changes(self.conf.image_cache_inventory_history)
+
+    def get_generation(self):
+        """
+        Returns the generation number of the last change to the set of
+        cached images.
+        """
+        with self.get_db() as db:
+            return self._get_generation(db)
+
+    def _get_generation(self, db):
+        row = db.execute("""SELECT seq FROM sqlite_sequence
+                         WHERE name = 'cache_changes'""").fetchone()
+        return row[0] if row is not None else 0
+
+    def get_changes(self, since):
+        """
+        Returns a list of (generation, image_id, cached) tuples of the
+        changes to the set of cached images after generation `since`, in
+        order, or None if they are no longer all recorded.
+
+        :param since: Generation number
+        """
+        with self.get_db() as db:
+            generation = self._get_generation(db)
+            rows = db.execute("""SELECT generation, image_id, cached
+                              FROM cache_changes
+                              WHERE generation > ? AND generation <= ?
+                              ORDER BY generation""",
+                              (since, generation)).fetchall()
+        changes = [(row[0], row[1], bool(row[2])) for row in rows]
+        return base.check_changes(changes, since, generation)
+
+    def trim_changes(self, keep):
+        """
+        Forgets all but the last `keep` changes to the set of cached
+        images.
+        """
+        with self.get_db() as db:
+            db.execute("""DELETE FROM cache_changes WHERE generation <= ?""",
+                       (self._get_generation(db) - keep, ))
+            db.commit()
+
     def get_least_recently_accessed(self):
         """
         Return a tuple containing the image_id and size of the least recently
         accessed cached file, or None if no cached files.
         """
+        self.flush_hits()
         with self.get_db() as db:
-            cur = db.execute("""SELECT image_id FROM cached_images
+            cur = db.execute("""SELECT image_id, size FROM cached_images
                              ORDER BY last_accessed LIMIT 1""")
-            image_id = cur.fetchone()[0]
+            row = cur.fetchone()
+        if row is None:
+            return None
+        return row[0], row[1]
 
-        path = self.get_image_filepath(image_id)
-        file_info = os.stat(path)
-        return image_id, file_info[stat.ST_SIZE]
+    def get_least_recently_accessed_images(self):
+        """
+        Return an iterator over tuples containing the image_id and size of
+        every cached file, least recently accessed first.
+        """
+        self.flush_hits()
+        with self.get_db() as db:
+            cur = db.execute("""SELECT image_id, size FROM cached_images
+                             ORDER BY last_accessed""")
+            for row in cur:
+                yield row[0], row[1]
+
+    def get_cache_entries(self):
+        """
+        Return an iterator over tuples of (image_id, size, hits,
+        last_accessed) for every cached file, for use by eviction policies.
+        """
+        self.flush_hits()
+        with self.get_db() as db:
+            cur = db.execute("""SELECT image_id, size, hits, last_accessed
+                             FROM cached_images""")
+            for row in cur:
+                yield row[0], row[1], row[2], row[3]
 
     @contextmanager
-    def open_for_write(self, image_id):
+    def open_for_write(self, image_id, checksum=None, size=None):
         """
         Open a file for writing the image file for an image
-        with supplied identifier.
+        with supplied identifier, verifying the image data against the
+        supplied checksum, if any, before committing it.
 
         :param image_id: Image ID
+        :param checksum: Expected MD5 checksum of the image
+        :param size: Size of the image, used to preallocate the file
         """
         incomplete_path = self.get_image_filepath(image_id, 'incomplete')
 
-        def commit():
+        def commit(actual_checksum):
             with self.get_db() as db:
                 final_path = self.get_image_filepath(image_id)
                 logger.debug(_("Fetch finished, moving "
@@ -303,9 +596,10 @@ class Driver(base.Driver):
                 now = time.time()
 
                 db.execute("""INSERT INTO cached_images
-                           (image_id, last_accessed, last_modified, hits, size)
-                           VALUES (?, 0, ?, 0, ?)""",
-                           (image_id, now, filesize))
+                           (image_id, last_accessed, last_modified, hits, size,
+                            checksum)
+                           VALUES (?, ?, ?, 0, ?, ?)""",
+                           (image_id, now, now, filesize, actual_checksum))
                 db.commit()
 
         def rollback(e):
@@ -324,12 +618,17 @@ class Driver(base.Driver):
 
         try:
             with open(incomplete_path, 'wb') as cache_file:
-                yield cache_file
+                fileutils.preallocate(cache_file.fileno(), size)
+                checksumming_file = base.ChecksummingFile(cache_file)
+                yield checksumming_file
+            actual_checksum = self.verify_checksum(image_id,
+                                                   checksumming_file,
+                                                   checksum)
         except Exception as e:
             rollback(e)
             raise
         else:
-            commit()
+            commit(actual_checksum)
 
     @contextmanager
     def open_for_read(self, image_id):
@@ -342,28 +641,32 @@ class Driver(base.Driver):
         path = self.get_image_filepath(image_id)
         with open(path, 'rb') as cache_file:
             yield cache_file
-        now = time.time()
+        self.record_hit(image_id)
+
+    def write_hits(self, hits):
+        """
+        Persists a batch of buffered hits in a single transaction.
+
+        :param hits: Mapping of image ID to a tuple of the number of hits
+                     and the time of the last hit
+        """
         with self.get_db() as db:
-            db.execute("""UPDATE cached_images
-                       SET hits = hits + 1, last_accessed = ?
-                       WHERE image_id = ?""",
-                       (now, image_id))
+            db.executemany("""UPDATE cached_images
+                           SET hits = hits + ?, last_accessed = ?
+                           WHERE image_id = ?""",
+                           [(count, last_accessed, image_id)
+                            for image_id, (count, last_accessed)
+                            in hits.items()])
             db.commit()
 
     @contextmanager
     def get_db(self):
         """
-        Returns a context manager that produces a database connection that
-        self-closes and calls rollback if an error occurs while using the
-        database connection
+        Returns a context manager that produces a pooled database
+        connection that is returned to the pool afterwards, and calls
+        rollback if an error occurs while using the database connection
         """
-        conn = sqlite3.connect(self.db_path, check_same_thread=False,
-                               factory=SqliteConnection)
-        conn.row_factory = sqlite3.Row
-        conn.text_factory = str
-        conn.execute('PRAGMA synchronous = NORMAL')
-        conn.execute('PRAGMA count_changes = OFF')
-        conn.execute('PRAGMA temp_store = MEMORY')
+        conn = self.pool.get()
         try:
             yield conn
         except sqlite3.DatabaseError, e:
@@ -371,9 +674,12 @@ class Driver(base.Driver):
             logger.error(msg)
             conn.rollback()
         finally:
-            conn.close()
+            # Never hand a connection with an open transaction on to
+            # the next user of the pool
+            conn.rollback()
+            self.pool.put(conn)
 
-    def queue_image(self, image_id):
+    def queue_image(self, image_id, priority=0):
         """
         This adds a image to be cache to the queue.
 
@@ -381,6 +687,7 @@ class Driver(base.Driver):
         cached, we return False, True otherwise
 
         :param image_id: Image ID
+        :param priority: Prefetching priority, higher goes first
         """
         if self.is_cached(image_id):
             msg = _("Not queueing image '%s'. Already cached.") % image_id
@@ -393,17 +700,11 @@ class Driver(base.Driver):
             logger.warn(msg)
             return False
 
-        if self.is_queued(image_id):
+        if not self._add_queue_entry(image_id, priority):
             msg = _("Not queueing image '%s'. Already queued.") % image_id
             logger.warn(msg)
             return False
 
-        path = self.get_image_filepath(image_id, 'queue')
-
-        # Touch the file to add it to the queue
-        with open(path, "w") as f:
-            pass
-
         return True
 
     def delete_invalid_files(self):
@@ -443,13 +744,14 @@ class Driver(base.Driver):
 
     def get_cache_files(self, basepath):
         """
-        Returns cache files in the supplied directory
+        Returns cache files in the supplied directory and in any shard
+        directories under it
 
         :param basepath: Directory to look in for cache files
         """
-        for fname in os.listdir(basepath):
-            path = os.path.join(basepath, fname)
-            if path != self.db_path and os.path.isfile(path):
+        for path in super(Driver, self).get_cache_files(basepath):
+            # Skip the database and its -wal, -shm and -journal files
+            if not path.startswith(self.db_path):
                 yield path
 
 
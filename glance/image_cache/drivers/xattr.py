@@ -51,9 +51,25 @@ $image_cache_dir/
   incomplete/
   invalid/
   queue/
+
+With `image_cache_dir_levels` set, entries are spread over one or two
+levels of shard directories named after the MD5 of the image ID, for
+example with two levels:
+
+$image_cache_dir/
+  3f/
+    a2/
+      entry1
+  ...
+  incomplete/
+    3f/
+      a2/
+        entry1
+  ...
 """
 
 from __future__ import absolute_import
+import collections
 from contextlib import contextmanager
 import datetime
 import errno
@@ -62,21 +78,137 @@ import os
 import stat
 import time
 
+import sqlite3
 import xattr
 
 from glance.common import exception
+from glance.common import fileutils
 from glance.image_cache.drivers import base
+from glance.image_cache.drivers.sqlite import SqliteConnection
 
 logger = logging.getLogger(__name__)
 
+# Name of the database in the cache directory recording the changes to
+# the set of cached images. Like every dotfile there, it is never taken
+# for a cached image.
+CHANGES_FILE = '.changes.db'
+
+
+class CacheIndex(object):
+
+    """
+    In-memory index of the active cache entries, which keeps the total
+    size of the cache and the entries in least recently accessed order,
+    so neither needs a walk of the cache directory.
+    """
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.total_size = 0
+
+    def add(self, image_id, size):
+        """Adds an entry as the most recently accessed one"""
+        self.remove(image_id)
+        self.entries[str(image_id)] = size
+        self.total_size += size
+
+    def remove(self, image_id):
+        """Removes an entry, if present"""
+        size = self.entries.pop(str(image_id), None)
+        if size is not None:
+            self.total_size -= size
+
+    def touch(self, image_id):
+        """Marks an entry, if present, as the most recently accessed one"""
+        size = self.entries.pop(str(image_id), None)
+        if size is not None:
+            self.entries[str(image_id)] = size
+
+    def __iter__(self):
+        return self.entries.iteritems()
+
+
+class ChangeLog(object):
+
+    """
+    Records the images added to and removed from the cache under
+    increasing generation numbers, shared by all processes using the
+    cache directory.
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path: Path to the change log database
+        """
+        self.conn = sqlite3.connect(db_path, check_same_thread=False,
+                                    factory=SqliteConnection)
+        self.conn.text_factory = str
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cache_changes (
+                generation INTEGER PRIMARY KEY AUTOINCREMENT,
+                image_id TEXT NOT NULL,
+                cached INTEGER NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+    def record(self, image_ids, cached):
+        """
+        Records that the images were added to the cache, if `cached` is
+        True, or removed from it.
+        """
+        try:
+            self.conn.executemany("""INSERT INTO cache_changes
+                                  (image_id, cached) VALUES (?, ?)""",
+                                  [(image_id, int(cached))
+                                   for image_id in image_ids])
+            self.conn.commit()
+        except sqlite3.DatabaseError:
+            self.conn.rollback()
+            raise
+
+    def get_generation(self):
+        row = self.conn.execute("""SELECT seq FROM sqlite_sequence
+                                WHERE name = 'cache_changes'""").fetchone()
+        return row[0] if row is not None else 0
+
+    def get_changes(self, since, generation):
+        rows = self.conn.execute("""SELECT generation, image_id, cached
+                                 FROM cache_changes
+                                 WHERE generation > ? AND generation <= ?
+                                 ORDER BY generation""", (since, generation))
+        changes = [(row[0], row[1], bool(row[2])) for row in rows]
+        self.conn.rollback()
+        return changes
+
+    def trim(self, keep):
+        try:
+            self.conn.execute("""DELETE FROM cache_changes
+                              WHERE generation <= ?""",
+                              (self.get_generation() - keep, ))
+            self.conn.commit()
+        except sqlite3.DatabaseError:
+            self.conn.rollback()
+            raise
+
 
 class Driver(base.Driver):
 
     """
     Cache driver that uses xattr file tags and requires a filesystem
     that has atimes set.
+
+    The driver keeps an in-memory index of the cache entries, which is
+    built with one walk of the cache directory and then updated as images
+    are cached, read and deleted. Other processes sharing the cache
+    directory change its modification time when they add or remove
+    entries, which is how we notice the index has to be rebuilt.
     """
 
+    index = None
+    index_mtime = None
+    change_log = None
+
     def configure(self):
         """
         Configure the driver to use the stored configuration options
@@ -117,11 +249,40 @@ class Driver(base.Driver):
         """
         Returns the total size in bytes of the image cache.
         """
-        sizes = []
-        for path in get_all_regular_files(self.base_dir):
-            file_info = os.stat(path)
-            sizes.append(file_info[stat.ST_SIZE])
-        return sum(sizes)
+        return self.get_index().total_size
+
+    def get_index(self):
+        """
+        Returns the index of the cache entries, (re)building it if it was
+        never built or another process changed the cache directory.
+        """
+        mtime = os.stat(self.base_dir).st_mtime
+        if self.index is None or mtime != self.index_mtime:
+            stats = []
+            for path in self.get_cache_files(self.base_dir):
+                file_info = os.stat(path)
+                stats.append((file_info[stat.ST_ATIME],  # access time
+                              os.path.basename(path),
+                              file_info[stat.ST_SIZE]))
+            stats.sort()
+
+            index = CacheIndex()
+            for atime, image_id, size in stats:
+                index.add(image_id, size)
+            self.index = index
+            self.index_mtime = mtime
+        return self.index
+
+    def _index_updated(self):
+        """
+        Records the cache directory's modification time after we changed
+        the directory and updated the index ourselves. With a sharded
+        layout, files are added and removed in the shard directories, so
+        we touch the cache directory to let other processes know.
+        """
+        if self.dir_levels:
+            os.utime(self.base_dir, None)
+        self.index_mtime = os.stat(self.base_dir).st_mtime
 
     def get_hit_count(self, image_id):
         """
@@ -132,6 +293,7 @@ class Driver(base.Driver):
         if not self.is_cached(image_id):
             return 0
 
+        self.flush_hits()
         path = self.get_image_filepath(image_id)
         return int(get_xattr(path, 'hits', default=0))
 
@@ -140,8 +302,9 @@ class Driver(base.Driver):
         Returns a list of records about cached images.
         """
         logger.debug(_("Gathering cached image entries."))
+        self.flush_hits()
         entries = []
-        for path in get_all_regular_files(self.base_dir):
+        for path in self.get_cache_files(self.base_dir):
             image_id = os.path.basename(path)
 
             entry = {}
@@ -201,19 +364,78 @@ class Driver(base.Driver):
         Removes all cached image files and any attributes about the images
         """
         deleted = 0
-        for path in get_all_regular_files(self.base_dir):
+        self.pending_hits = {}
+        self.num_pending_hits = 0
+        image_ids = []
+        for path in self.get_cache_files(self.base_dir):
             delete_cached_file(path)
+            image_ids.append(os.path.basename(path))
             deleted += 1
+        self.index = CacheIndex()
+        self._index_updated()
+        self.get_change_log().record(image_ids, False)
         return deleted
 
     def delete_cached_image(self, image_id):
         """
         Removes a specific cached image file and any attributes about the image
 
+        :param image_id: Image ID
+        """
+        self.delete_cached_images([image_id])
+
+    def delete_cached_images(self, image_ids):
+        """
+        Removes the cached image files and any attributes about the images
+        with the supplied IDs.
+
+        :param image_ids: List of image IDs
+        """
+        index = self.get_index()
+        removed = []
+        for image_id in image_ids:
+            self.discard_hits(image_id)
+            if str(image_id) in index.entries:
+                removed.append(image_id)
+            index.remove(image_id)
+            delete_cached_file(self.get_image_filepath(image_id))
+        self._index_updated()
+        self.get_change_log().record(removed, False)
+
+    def invalidate_cached_image(self, image_id):
+        """
+        Moves a corrupt cached image file to the invalid directory and
+        forgets about the cached image.
+
         :param image_id: Image ID
         """
         path = self.get_image_filepath(image_id)
-        delete_cached_file(path)
+        invalid_path = self.get_image_filepath(image_id, 'invalid')
+        self.discard_hits(image_id)
+        self.get_index().remove(image_id)
+        logger.debug(_("Moving corrupt cache file '%(path)s' to "
+                       "'%(invalid_path)s'") % locals())
+        self._move(path, invalid_path)
+        self._index_updated()
+        self.get_change_log().record([image_id], False)
+
+    def get_checksum(self, image_id):
+        """
+        Returns the MD5 checksum recorded for a cached image, or None.
+
+        :param image_id: Image ID
+        """
+        return get_xattr(self.get_image_filepath(image_id), 'checksum',
+                         default=None)
+
+    def set_checksum(self, image_id, checksum):
+        """
+        Records the MD5 checksum of a cached image.
+
+        :param image_id: Image ID
+        :param checksum: MD5 checksum of the image file
+        """
+        set_xattr(self.get_image_filepath(image_id), 'checksum', checksum)
 
     def delete_all_queued_images(self):
         """
@@ -239,41 +461,65 @@ class Driver(base.Driver):
         Return a tuple containing the image_id and size of the least recently
         accessed cached file, or None if no cached files.
         """
-        stats = []
-        for path in get_all_regular_files(self.base_dir):
-            file_info = os.stat(path)
-            stats.append((file_info[stat.ST_ATIME],  # access time
-                          file_info[stat.ST_SIZE],   # size in bytes
-                          path))                     # absolute path
+        for entry in self.get_index():
+            return entry
+        return None
 
-        if not stats:
-            return None
+    def get_least_recently_accessed_images(self):
+        """
+        Return an iterator over tuples containing the image_id and size of
+        every cached file, least recently accessed first.
+        """
+        return iter(list(self.get_index()))
 
-        stats.sort()
-        return os.path.basename(stats[0][2]), stats[0][1]
+    def get_cache_entries(self):
+        """
+        Return an iterator over tuples of (image_id, size, hits,
+        last_accessed) for every cached file, for use by eviction policies.
+        The position of an entry in the index stands in for its access
+        time, as only the order matters.
+        """
+        self.flush_hits()
+        entries = []
+        for position, (image_id, size) in enumerate(self.get_index()):
+            path = self.get_image_filepath(image_id)
+            try:
+                hits = int(get_xattr(path, 'hits', default=0))
+            except (IOError, OSError):
+                hits = 0
+            entries.append((image_id, size, hits, position))
+        return iter(entries)
 
     @contextmanager
-    def open_for_write(self, image_id):
+    def open_for_write(self, image_id, checksum=None, size=None):
         """
         Open a file for writing the image file for an image
-        with supplied identifier.
+        with supplied identifier, verifying the image data against the
+        supplied checksum, if any, before committing it.
 
         :param image_id: Image ID
+        :param checksum: Expected MD5 checksum of the image
+        :param size: Size of the image, used to preallocate the file
         """
         incomplete_path = self.get_image_filepath(image_id, 'incomplete')
 
         def set_attr(key, value):
             set_xattr(incomplete_path, key, value)
 
-        def commit():
+        def commit(actual_checksum):
             set_attr('hits', 0)
+            set_attr('checksum', actual_checksum)
 
             final_path = self.get_image_filepath(image_id)
             logger.debug(_("Fetch finished, moving "
                          "'%(incomplete_path)s' to '%(final_path)s'"),
                          dict(incomplete_path=incomplete_path,
                               final_path=final_path))
+            index = self.get_index()
             os.rename(incomplete_path, final_path)
+            index.add(image_id, os.path.getsize(final_path))
+            self._index_updated()
+            self.get_change_log().record([image_id], True)
 
             # Make sure that we "pop" the image from the queue...
             if self.is_queued(image_id):
@@ -292,12 +538,17 @@ class Driver(base.Driver):
 
         try:
             with open(incomplete_path, 'wb') as cache_file:
-                yield cache_file
+                fileutils.preallocate(cache_file.fileno(), size)
+                checksumming_file = base.ChecksummingFile(cache_file)
+                yield checksumming_file
+            actual_checksum = self.verify_checksum(image_id,
+                                                   checksumming_file,
+                                                   checksum)
         except Exception as e:
             rollback(e)
             raise
         else:
-            commit()
+            commit(actual_checksum)
 
     @contextmanager
     def open_for_read(self, image_id):
@@ -310,10 +561,27 @@ class Driver(base.Driver):
         path = self.get_image_filepath(image_id)
         with open(path, 'rb') as cache_file:
             yield cache_file
-        path = self.get_image_filepath(image_id)
-        inc_xattr(path, 'hits', 1)
+        self.get_index().touch(image_id)
+        self.record_hit(image_id)
+
+    def write_hits(self, hits):
+        """
+        Persists a batch of buffered hits. The access time is maintained
+        by the filesystem, so only the hit counts need writing.
 
-    def queue_image(self, image_id):
+        :param hits: Mapping of image ID to a tuple of the number of hits
+                     and the time of the last hit
+        """
+        for image_id, (count, last_accessed) in hits.items():
+            path = self.get_image_filepath(image_id)
+            try:
+                inc_xattr(path, 'hits', count)
+            except (IOError, OSError):
+                # The image was removed from the cache before we got here
+                logger.debug(_("Not recording hits on image '%s', which "
+                               "is no longer cached"), image_id)
+
+    def queue_image(self, image_id, priority=0):
         """
         This adds a image to be cache to the queue.
 
@@ -321,6 +589,7 @@ class Driver(base.Driver):
         cached, we return False, True otherwise
 
         :param image_id: Image ID
+        :param priority: Prefetching priority, higher goes first
         """
         if self.is_cached(image_id):
             msg = _("Not queueing image '%s'. Already cached.") % image_id
@@ -333,18 +602,13 @@ class Driver(base.Driver):
             logger.warn(msg)
             return False
 
-        if self.is_queued(image_id):
+        if not self._add_queue_entry(image_id, priority):
             msg = _("Not queueing image '%s'. Already queued.") % image_id
             logger.warn(msg)
             return False
 
-        path = self.get_image_filepath(image_id, 'queue')
         logger.debug(_("Queueing image '%s'."), image_id)
 
-        # Touch the file to add it to the queue
-        with open(path, "w") as f:
-            pass
-
         return True
 
     def get_queued_images(self):
@@ -353,7 +617,7 @@ class Driver(base.Driver):
         list should be sorted by the time the image ID was inserted
         into the queue.
         """
-        files = [f for f in get_all_regular_files(self.queue_dir)]
+        files = [f for f in self.get_cache_files(self.queue_dir)]
         items = []
         for path in files:
             mtime = os.path.getmtime(path)
@@ -367,7 +631,7 @@ class Driver(base.Driver):
         """
         now = time.time()
         reaped = 0
-        for path in get_all_regular_files(dirpath):
+        for path in self.get_cache_files(dirpath):
             mtime = os.path.getmtime(path)
             age = now - mtime
             if not grace:
@@ -415,12 +679,41 @@ class Driver(base.Driver):
 
         self.reap_stalled(stall_time)
 
+        self.trim_changes(self.conf.image_cache_inventory_history)
 
-def get_all_regular_files(basepath):
-    for fname in os.listdir(basepath):
-        path = os.path.join(basepath, fname)
-        if os.path.isfile(path):
-            yield path
+    def get_change_log(self):
+        """Returns the log of changes to the set of cached images"""
+        if self.change_log is None:
+            self.change_log = ChangeLog(os.path.join(self.base_dir,
+                                                     CHANGES_FILE))
+        return self.change_log
+
+    def get_generation(self):
+        """
+        Returns the generation number of the last change to the set of
+        cached images.
+        """
+        return self.get_change_log().get_generation()
+
+    def get_changes(self, since):
+        """
+        Returns a list of (generation, image_id, cached) tuples of the
+        changes to the set of cached images after generation `since`, in
+        order, or None if they are no longer all recorded.
+
+        :param since: Generation number
+        """
+        change_log = self.get_change_log()
+        generation = change_log.get_generation()
+        changes = change_log.get_changes(since, generation)
+        return base.check_changes(changes, since, generation)
+
+    def trim_changes(self, keep):
+        """
+        Forgets all but the last `keep` changes to the set of cached
+        images.
+        """
+        self.get_change_log().trim(keep)
 
 
 def delete_cached_file(path):
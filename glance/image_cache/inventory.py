@@ -0,0 +1,196 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Compact inventory of the images in the image cache.
+
+Schedulers that want to send downloads to an API server already holding
+the image need to know what each server has cached, without listing
+every cached image with its statistics on every poll. The inventory is
+a sorted list of the cached image IDs, or a Bloom filter of them, along
+with the generation number of the last change to the cache. A caller
+that already holds the inventory at some generation can ask for just
+the images added and removed since then.
+
+The cache drivers number every change to the set of cached images, so
+each process keeps its copy of the inventory up to date by applying the
+changes made since it last looked, and only rebuilds it from the driver
+if those changes have been trimmed from the history.
+"""
+
+import base64
+import hashlib
+import math
+import struct
+
+from glance.openstack.common import cfg
+
+
+class BloomFilter(object):
+
+    """
+    A Bloom filter over image IDs. Bit i of the filter is bit i % 8 of
+    byte i / 8. The k bit positions of an image ID are (h1 + i * h2) % m
+    for i in 0..k-1, where h1 and h2 are the first and second 64-bit
+    big-endian integers of the MD5 digest of the image ID, and m is the
+    number of bits.
+    """
+
+    def __init__(self, num_bits, num_hashes):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray((num_bits + 7) / 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate):
+        """
+        Returns an empty filter sized to hold `capacity` image IDs with
+        the supplied false positive rate.
+        """
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(-capacity * math.log(false_positive_rate) /
+                                 math.log(2) ** 2))
+        num_hashes = max(int(round(num_bits * math.log(2) / capacity)), 1)
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, image_id):
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(image_id).digest())
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, image_id):
+        for position in self._positions(image_id):
+            self.bits[position / 8] |= 1 << (position % 8)
+
+    def __contains__(self, image_id):
+        return all(self.bits[position / 8] & (1 << (position % 8))
+                   for position in self._positions(image_id))
+
+    def to_dict(self):
+        return {'num_bits': self.num_bits,
+                'num_hashes': self.num_hashes,
+                'bits': base64.b64encode(str(self.bits))}
+
+
+class Inventory(object):
+
+    """
+    The set of cached image IDs as of a generation of the cache, kept up
+    to date from the driver's change history.
+    """
+
+    opts = [
+        cfg.FloatOpt('image_cache_inventory_false_positive_rate',
+                     default=0.01),
+        ]
+
+    def __init__(self, conf, driver):
+        """
+        :param conf: Configuration options for the image cache
+        :param driver: Image cache driver
+        """
+        conf.register_opts(self.opts)
+        self.false_positive_rate = (
+                conf.image_cache_inventory_false_positive_rate)
+        self.driver = driver
+        self.images = None
+        self.generation = None
+        self._bloom = None
+        self._bloom_capacity = 0
+
+    def refresh(self):
+        """
+        Brings the inventory up to date, applying the changes made to
+        the cache since it was last refreshed.
+        """
+        changes = None
+        if self.images is not None:
+            changes = self.driver.get_changes(self.generation)
+        if changes is None:
+            self._rebuild()
+        else:
+            self._apply(changes)
+
+    def _rebuild(self):
+        generation = self.driver.get_generation()
+        self.images = set(str(image['image_id'])
+                          for image in self.driver.get_cached_images())
+        self.generation = generation
+        self._bloom = None
+        # Changes made while the images were being listed are applied
+        # again, which does no harm
+        self._apply(self.driver.get_changes(generation) or [])
+
+    def _apply(self, changes):
+        for generation, image_id, cached in changes:
+            if cached:
+                self.images.add(image_id)
+                if self._bloom is not None:
+                    self._bloom.add(image_id)
+            else:
+                self.images.discard(image_id)
+                # Nothing can be taken out of a Bloom filter
+                self._bloom = None
+            self.generation = generation
+
+    def get_images(self):
+        """
+        Returns a tuple of the current generation and the sorted list of
+        cached image IDs.
+        """
+        self.refresh()
+        return self.generation, sorted(self.images)
+
+    def get_bloom_filter(self):
+        """
+        Returns a tuple of the current generation and a `BloomFilter` of
+        the cached image IDs. The filter is only rebuilt after images are
+        removed from the cache, or it fills past its capacity.
+        """
+        self.refresh()
+        if (self._bloom is None or
+            len(self.images) > self._bloom_capacity):
+            self._bloom_capacity = max(len(self.images) * 2, 1024)
+            self._bloom = BloomFilter.for_capacity(self._bloom_capacity,
+                                                   self.false_positive_rate)
+            for image_id in self.images:
+                self._bloom.add(image_id)
+        return self.generation, self._bloom
+
+    def get_delta(self, since):
+        """
+        Returns a tuple of the current generation, and the sorted lists of
+        the image IDs added to and removed from the cache since generation
+        `since`. Returns None if the changes since then are no longer
+        known, in which case the whole inventory has to be fetched again.
+
+        :param since: Generation number the caller has the inventory at
+        """
+        self.refresh()
+        changes = self.driver.get_changes(since)
+        if changes is None:
+            return None
+
+        cached = {}
+        for generation, image_id, is_cached in changes:
+            cached[image_id] = is_cached
+        added = sorted(image_id for image_id, is_cached in cached.items()
+                       if is_cached)
+        removed = sorted(image_id for image_id, is_cached in cached.items()
+                         if not is_cached)
+        generation = changes[-1][0] if changes else since
+        return generation, added, removed
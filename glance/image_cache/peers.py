@@ -0,0 +1,180 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Sharing image caches between API servers.
+
+Behind a load balancer, every API server ends up fetching each popular
+image from the backend store and caching its own copy of it. With
+`image_cache_peers` set, the API servers instead divide the images
+between them on a consistent hash ring. Each image is owned by one of
+the servers, and a server that does not have an image cached asks the
+owner for it before going to the backend store itself. Only the owner
+caches the image, so each image is fetched from the backend store once
+and cached once. Adding or removing a server only moves the images
+owned by that server.
+"""
+
+import bisect
+import hashlib
+import logging
+
+from eventlet.green import httplib
+
+from glance.openstack.common import cfg
+
+logger = logging.getLogger(__name__)
+
+# Header marking a request from a peer, which must be served locally
+PEER_HEADER = 'x-image-cache-peer'
+
+# Headers that describe the connection rather than the image
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding',
+                      'proxy-authenticate', 'proxy-authorization', 'te',
+                      'trailers', 'upgrade')
+
+# Headers of the client's request passed on to the peer, so that the
+# peer can authenticate it, check access to the image and serve ranges
+FORWARDED_HEADERS = ('x-auth-token', 'x-identity-status', 'x-user-id',
+                     'x-tenant-id', 'x-roles', 'x-service-catalog', 'range')
+
+CHUNK_SIZE = 65536
+
+
+class HashRing(object):
+
+    """
+    Maps keys to nodes, so that adding or removing a node only moves the
+    keys of that node. Each node is placed on the ring at a number of
+    points, to spread the keys evenly between nodes.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        """
+        :param nodes: List of node names
+        :param replicas: Number of points each node is placed at
+        """
+        self.nodes = list(nodes)
+        ring = []
+        for node in self.nodes:
+            for replica in xrange(replicas):
+                ring.append((self._hash('%s-%d' % (node, replica)), node))
+        ring.sort()
+        self._points = [point for point, node in ring]
+        self._nodes = [node for point, node in ring]
+
+    def _hash(self, key):
+        return long(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        """
+        Returns the node owning `key`, the first node placed after it on
+        the ring, or None if the ring has no nodes.
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self._hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+class PeerFetchError(Exception):
+    pass
+
+
+class PeerCache(object):
+
+    """
+    Works out which API server owns each image, and fetches images from
+    their owners.
+    """
+
+    opts = [
+        cfg.ListOpt('image_cache_peers', default=[]),
+        cfg.StrOpt('image_cache_peer_self'),
+        cfg.IntOpt('image_cache_peer_timeout', default=10),  # seconds
+        ]
+
+    def __init__(self, conf):
+        conf.register_opts(self.opts)
+        self.conf = conf
+        self.self_peer = conf.image_cache_peer_self
+        self.enabled = bool(conf.image_cache_peers and self.self_peer)
+        if conf.image_cache_peers and not self.self_peer:
+            logger.warn(_("image_cache_peers is set without "
+                          "image_cache_peer_self, so cache peering is "
+                          "disabled"))
+        self.ring = HashRing(conf.image_cache_peers)
+        self.timeout = conf.image_cache_peer_timeout
+
+    def get_owner(self, image_id):
+        """
+        Returns the address of the peer owning the image, or None if this
+        API server owns it or peering is disabled.
+
+        :param image_id: Image ID
+        """
+        if not self.enabled:
+            return None
+        owner = self.ring.get_node(image_id)
+        if owner == self.self_peer:
+            return None
+        return owner
+
+    def fetch(self, peer, path, headers):
+        """
+        Requests an image from a peer. Returns a tuple of the response
+        status, the response headers and an iterator over the image data.
+        Raises PeerFetchError if the peer cannot serve the image.
+
+        :param peer: host:port address of the peer
+        :param path: Path of the image in the peer's API
+        :param headers: Headers of the client's request
+        """
+        request_headers = dict((name, value)
+                               for name, value in headers.items()
+                               if name.lower() in FORWARDED_HEADERS)
+        request_headers[PEER_HEADER] = self.self_peer
+
+        conn = httplib.HTTPConnection(peer, timeout=self.timeout)
+        try:
+            conn.request('GET', path, headers=request_headers)
+            response = conn.getresponse()
+        except Exception, e:
+            conn.close()
+            raise PeerFetchError(_("Could not reach peer %(peer)s: %(e)s") %
+                                 locals())
+
+        status = response.status
+        if status not in (httplib.OK, httplib.PARTIAL_CONTENT):
+            conn.close()
+            raise PeerFetchError(_("Peer %(peer)s returned %(status)d") %
+                                 locals())
+
+        response_headers = [(name, value)
+                            for name, value in response.getheaders()
+                            if name.lower() not in HOP_BY_HOP_HEADERS]
+        return status, response_headers, self._read(conn, response)
+
+    def _read(self, conn, response):
+        try:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            conn.close()
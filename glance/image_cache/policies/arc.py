@@ -0,0 +1,139 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Adaptive Replacement Cache eviction policy
+"""
+
+import collections
+import operator
+
+from glance.image_cache.policies import base
+
+
+class Policy(base.Policy):
+
+    """
+    Adaptive Replacement Cache (ARC) eviction, measured in bytes rather
+    than in entries.
+
+    Cached images are split between T1, images read only once since they
+    were cached, and T2, images read more than once. Each list is kept in
+    least recently used order. Evicted images are remembered, without
+    their data, in the ghost lists B1 and B2. Re-caching an image found
+    in B1 means T1 was too small, so the byte target `p` for T1 grows.
+    Re-caching one found in B2 shrinks it. A burst of one-off images
+    therefore only churns T1, while images read repeatedly stay in T2.
+
+    When loaded from the cache driver's statistics, images with more than
+    one hit go to T2. The ghost lists and the target are kept across
+    calls to `load`, but start out empty in every new process.
+    """
+
+    def __init__(self, conf):
+        super(Policy, self).__init__(conf)
+        self.capacity = self.conf.image_cache_max_size
+        self.target = 0
+        self.t1 = SizedList()
+        self.t2 = SizedList()
+        self.b1 = SizedList()
+        self.b2 = SizedList()
+
+    def load(self, entries):
+        self.t1 = SizedList()
+        self.t2 = SizedList()
+        for image_id, size, hits, last_accessed in sorted(
+                entries, key=operator.itemgetter(3)):
+            if image_id in self.b1 or image_id in self.b2:
+                self.insert(image_id, size)
+            elif hits > 1:
+                self.t2.push(image_id, size)
+            else:
+                self.t1.push(image_id, size)
+
+    def insert(self, image_id, size):
+        self.remove(image_id)
+        if image_id in self.b1:
+            ratio = max(1.0, self.b2.size / float(max(self.b1.size, 1)))
+            self.target = min(self.capacity, self.target + ratio * size)
+            self.b1.discard(image_id)
+            self.t2.push(image_id, size)
+        elif image_id in self.b2:
+            ratio = max(1.0, self.b1.size / float(max(self.b2.size, 1)))
+            self.target = max(0, self.target - ratio * size)
+            self.b2.discard(image_id)
+            self.t2.push(image_id, size)
+        else:
+            self.t1.push(image_id, size)
+
+    def access(self, image_id):
+        size = self.t1.discard(image_id)
+        if size is None:
+            size = self.t2.discard(image_id)
+        if size is not None:
+            self.t2.push(image_id, size)
+
+    def remove(self, image_id):
+        self.t1.discard(image_id)
+        self.t2.discard(image_id)
+
+    def evict(self):
+        if self.t1 and (self.t1.size > self.target or not self.t2):
+            image_id, size = self.t1.pop_oldest()
+            self.b1.push(image_id, size)
+        elif self.t2:
+            image_id, size = self.t2.pop_oldest()
+            self.b2.push(image_id, size)
+        else:
+            return None
+        self._trim_ghosts()
+        return image_id, size
+
+    def _trim_ghosts(self):
+        while self.b1 and self.t1.size + self.b1.size > self.capacity:
+            self.b1.pop_oldest()
+        while self.b2 and (self.t1.size + self.t2.size + self.b1.size +
+                           self.b2.size > 2 * self.capacity):
+            self.b2.pop_oldest()
+
+
+class SizedList(collections.OrderedDict):
+
+    """
+    An OrderedDict of image_id to size, oldest first, that keeps track of
+    the total size of its entries.
+    """
+
+    def __init__(self):
+        super(SizedList, self).__init__()
+        self.size = 0
+
+    def push(self, image_id, size):
+        self[image_id] = size
+        self.size += size
+
+    def discard(self, image_id):
+        size = self.get(image_id)
+        if size is not None:
+            del self[image_id]
+            self.size -= size
+        return size
+
+    def pop_oldest(self):
+        image_id, size = self.popitem(last=False)
+        self.size -= size
+        return image_id, size
@@ -0,0 +1,87 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Base eviction policy class
+"""
+
+
+class Policy(object):
+
+    """
+    Decides which cached images are removed when the image cache grows
+    past its maximum size.
+
+    A policy can follow the cache as images are cached, read and removed
+    through `insert`, `access` and `remove`, as the cache policy simulator
+    does. A policy that has not followed the cache from the start, like
+    the one in glance-cache-pruner, is brought up to date from the
+    statistics the cache driver keeps with `load`. Policies keep any
+    state of their own that the driver does not track across calls to
+    `load`.
+    """
+
+    def __init__(self, conf):
+        """
+        Initialize the policy with a set of options.
+
+        :param conf: Dictionary of configuration options
+        """
+        self.conf = conf
+
+    def load(self, entries):
+        """
+        Replaces the set of cached images the policy knows about.
+
+        :param entries: Iterable of tuples of (image_id, size, hits,
+                        last_accessed) for every cached image
+        """
+        raise NotImplementedError
+
+    def insert(self, image_id, size):
+        """
+        Records that an image has been written into the cache.
+
+        :param image_id: Image ID
+        :param size: Size of the image file in bytes
+        """
+        raise NotImplementedError
+
+    def access(self, image_id):
+        """
+        Records a hit on a cached image.
+
+        :param image_id: Image ID
+        """
+        raise NotImplementedError
+
+    def remove(self, image_id):
+        """
+        Records that an image has been removed from the cache other than
+        through `evict`.
+
+        :param image_id: Image ID
+        """
+        raise NotImplementedError
+
+    def evict(self):
+        """
+        Picks the next image to remove from the cache and forgets about it.
+        Returns a tuple of the image_id and size of that image, or None if
+        no images are left.
+        """
+        raise NotImplementedError
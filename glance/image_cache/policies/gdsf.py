@@ -0,0 +1,106 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Greedy-Dual-Size-Frequency eviction policy
+"""
+
+import heapq
+import itertools
+import logging
+import operator
+
+from glance.image_cache.policies import base
+from glance.openstack.common import cfg
+
+logger = logging.getLogger(__name__)
+
+COSTS = ('uniform', 'bytes')
+
+
+class Policy(base.Policy):
+
+    """
+    Greedy-Dual-Size-Frequency (GDSF) eviction.
+
+    Each cached image has a priority of L + hits * cost / size, and the
+    image with the lowest priority is evicted. L starts at zero and is
+    raised to the priority of each evicted image, so images that are not
+    read again age out as newer images are given higher priorities.
+
+    With the 'uniform' cost every miss costs the same, which favours
+    keeping many small, popular images and maximises the hit ratio. With
+    the 'bytes' cost a miss costs the size of the image, which maximises
+    the share of bytes served from the cache.
+
+    The clock L is kept across calls to `load`, but starts again from
+    zero in every new process.
+    """
+
+    opts = [
+        cfg.StrOpt('image_cache_gdsf_cost', default='uniform'),
+        ]
+
+    def __init__(self, conf):
+        super(Policy, self).__init__(conf)
+        self.conf.register_opts(self.opts)
+        self.cost = self.conf.image_cache_gdsf_cost
+        if self.cost not in COSTS:
+            logger.warn(_("Unknown image_cache_gdsf_cost '%s'. Defaulting "
+                          "to 'uniform'."), self.cost)
+            self.cost = 'uniform'
+        self.clock = 0.0
+        self.counter = itertools.count()
+        self.entries = {}
+        self.heap = []
+
+    def load(self, entries):
+        self.entries = {}
+        self.heap = []
+        for image_id, size, hits, last_accessed in sorted(
+                entries, key=operator.itemgetter(3)):
+            self._push(image_id, size, hits)
+
+    def insert(self, image_id, size):
+        self._push(image_id, size, 1)
+
+    def access(self, image_id):
+        entry = self.entries.get(image_id)
+        if entry is not None:
+            self._push(image_id, entry[3], entry[4] + 1)
+
+    def remove(self, image_id):
+        self.entries.pop(image_id, None)
+
+    def evict(self):
+        while self.heap:
+            item = heapq.heappop(self.heap)
+            image_id = item[2]
+            if self.entries.get(image_id) is item:
+                del self.entries[image_id]
+                self.clock = item[0]
+                return image_id, item[3]
+        return None
+
+    def _push(self, image_id, size, hits):
+        if self.cost == 'bytes':
+            value = float(hits)
+        else:
+            value = float(hits) / max(size, 1)
+        item = [self.clock + value, self.counter.next(), image_id, size, hits]
+        self.entries[image_id] = item
+        heapq.heappush(self.heap, item)
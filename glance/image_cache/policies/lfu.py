@@ -0,0 +1,76 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Least frequently used eviction policy
+"""
+
+import heapq
+import itertools
+import operator
+
+from glance.image_cache.policies import base
+
+
+class Policy(base.Policy):
+
+    """
+    Evicts the image with the fewest hits, and of those the one that was
+    least recently read.
+
+    Images sit in a heap ordered by (hits, access sequence). Rather than
+    re-ordering the heap on every hit, a hit pushes a new heap item and
+    stale items are skipped when they come off the heap.
+    """
+
+    def __init__(self, conf):
+        super(Policy, self).__init__(conf)
+        self.counter = itertools.count()
+        self.entries = {}
+        self.heap = []
+
+    def load(self, entries):
+        self.entries = {}
+        self.heap = []
+        for image_id, size, hits, last_accessed in sorted(
+                entries, key=operator.itemgetter(3)):
+            self._push(image_id, size, hits)
+
+    def insert(self, image_id, size):
+        self._push(image_id, size, 1)
+
+    def access(self, image_id):
+        entry = self.entries.get(image_id)
+        if entry is not None:
+            self._push(image_id, entry[3], entry[0] + 1)
+
+    def remove(self, image_id):
+        self.entries.pop(image_id, None)
+
+    def evict(self):
+        while self.heap:
+            item = heapq.heappop(self.heap)
+            image_id = item[2]
+            if self.entries.get(image_id) is item:
+                del self.entries[image_id]
+                return image_id, item[3]
+        return None
+
+    def _push(self, image_id, size, hits):
+        item = [hits, self.counter.next(), image_id, size]
+        self.entries[image_id] = item
+        heapq.heappush(self.heap, item)
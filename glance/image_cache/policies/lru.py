@@ -0,0 +1,59 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Least recently used eviction policy
+"""
+
+import collections
+import operator
+
+from glance.image_cache.policies import base
+
+
+class Policy(base.Policy):
+
+    """
+    Evicts the image that was least recently read from the cache.
+    """
+
+    def __init__(self, conf):
+        super(Policy, self).__init__(conf)
+        self.entries = collections.OrderedDict()
+
+    def load(self, entries):
+        self.entries = collections.OrderedDict()
+        for image_id, size, hits, last_accessed in sorted(
+                entries, key=operator.itemgetter(3)):
+            self.entries[image_id] = size
+
+    def insert(self, image_id, size):
+        self.entries.pop(image_id, None)
+        self.entries[image_id] = size
+
+    def access(self, image_id):
+        size = self.entries.pop(image_id, None)
+        if size is not None:
+            self.entries[image_id] = size
+
+    def remove(self, image_id):
+        self.entries.pop(image_id, None)
+
+    def evict(self):
+        if not self.entries:
+            return None
+        return self.entries.popitem(last=False)
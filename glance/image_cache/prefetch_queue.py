@@ -0,0 +1,161 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Persistent index of the images waiting to be prefetched.
+
+The queue directory stays the record of which images are queued, since
+that is what the API servers write to. The prefetcher daemon mirrors it
+into an SQLite database, indexed so that the next images to fetch are
+found without reading every queue file, and records there when each
+failed image may next be retried. The index survives restarts, so
+failed images keep their backoff and nothing already fetched is
+fetched again.
+"""
+
+from contextlib import contextmanager
+import logging
+
+import sqlite3
+
+from glance.image_cache.drivers.sqlite import SqliteConnection
+
+logger = logging.getLogger(__name__)
+
+# Name of the index database in the queue directory. Like every dotfile
+# there, it is never taken for a queued image.
+INDEX_FILE = '.index.db'
+
+FIELDS = ('image_id', 'priority', 'requests', 'size', 'backend',
+          'queued_at', 'attempts', 'retry_at')
+
+
+class PrefetchQueue(object):
+
+    """An SQLite index over the prefetch queue"""
+
+    def __init__(self, db_path):
+        """
+        :param db_path: Path to the index database
+        """
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False,
+                                    factory=SqliteConnection)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.text_factory = str
+        with self.get_db() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS queue (
+                    image_id TEXT PRIMARY KEY,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    requests INTEGER NOT NULL DEFAULT 1,
+                    size INTEGER,
+                    backend TEXT,
+                    queued_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    retry_at REAL NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS queue_order ON queue
+                    (priority DESC, requests DESC, size, queued_at);
+            """)
+
+    @contextmanager
+    def get_db(self):
+        """
+        Returns a context manager around the index connection that
+        commits on success and rolls back if an error occurs
+        """
+        try:
+            yield self.conn
+            self.conn.commit()
+        except sqlite3.DatabaseError:
+            self.conn.rollback()
+            raise
+
+    def get_entries(self):
+        """Returns a mapping of image ID to entry for all indexed images"""
+        rows = self.conn.execute("SELECT * FROM queue")
+        return dict((row['image_id'], dict(row)) for row in rows)
+
+    def get_entry(self, image_id):
+        """
+        Returns the indexed entry of an image as a dict, or None if the
+        image is not in the index.
+
+        :param image_id: Image ID
+        """
+        row = self.conn.execute("SELECT * FROM queue WHERE image_id = ?",
+                                (image_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def get_ready(self, now):
+        """
+        Returns the entries of the images that may be fetched at the
+        supplied time, highest priority first, then most often queued,
+        then smallest.
+
+        :param now: Current time
+        """
+        rows = self.conn.execute("""
+            SELECT * FROM queue WHERE retry_at <= ?
+            ORDER BY priority DESC, requests DESC, size, queued_at
+        """, (now,))
+        return [dict(row) for row in rows]
+
+    def add(self, entry, size, backend):
+        """
+        Indexes an image from its queue entry.
+
+        :param entry: Queue entry of the image, see `ImageCache`
+        :param size: Size of the image, None if not known yet
+        :param backend: Name of the backend store holding the image
+        """
+        with self.get_db() as db:
+            db.execute("""
+                INSERT OR REPLACE INTO queue
+                (image_id, priority, requests, size, backend, queued_at,
+                 attempts)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (entry['image_id'], entry['priority'], entry['requests'],
+                  size, backend, entry['queued_at'], entry['attempts']))
+
+    def update(self, image_id, **values):
+        """
+        Updates the indexed entry of an image with the supplied values.
+
+        :param image_id: Image ID
+        """
+        for key in values:
+            if key not in FIELDS[1:]:
+                raise ValueError(_("Unknown prefetch queue field "
+                                   "%s") % key)
+        columns = ', '.join('%s = ?' % key for key in values)
+        with self.get_db() as db:
+            db.execute("UPDATE queue SET %s WHERE image_id = ?" % columns,
+                       values.values() + [image_id])
+
+    def delete(self, image_id):
+        """
+        Removes an image from the index.
+
+        :param image_id: Image ID
+        """
+        with self.get_db() as db:
+            db.execute("DELETE FROM queue WHERE image_id = ?", (image_id,))
+
+    def close(self):
+        self.conn.close()
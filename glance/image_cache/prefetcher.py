@@ -15,17 +15,37 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+
 """
 Prefetches images into the Image Cache
+
+Queued images are fetched by a fixed number of workers, highest priority
+first, then most often queued, then smallest. Fetches from each backend
+store can be limited to fewer workers than that, and the combined rate
+at which image data is read can be capped, so that prefetching leaves
+bandwidth for the images being served to clients.
+
+Run once, the prefetcher fetches everything queued and exits. Run as a
+daemon, it keeps a persistent index of the queue, picks up newly queued
+images within a poll interval, and retries failed fetches with
+exponential backoff.
 """
 
 import logging
+import os
+import time
+import urlparse
 
 import eventlet
+from eventlet import event
 
 from glance.common import context
 from glance.common import exception
 from glance.image_cache import ImageCache
+from glance.image_cache import prefetch_queue
+from glance.image_cache.throttle import Throttle
+from glance.image_cache import warmer
+from glance.openstack.common import cfg
 from glance import registry
 import glance.store
 import glance.store.filesystem
@@ -38,17 +58,138 @@ from glance.store import get_from_backend
 
 logger = logging.getLogger(__name__)
 
+# Seconds after which the daemon re-reads the whole queue even if nothing
+# was queued, to notice entries changed behind its back
+RESCAN_INTERVAL = 60
+
+
+class QueuedImage(object):
+
+    """An image waiting to be prefetched"""
+
+    def __init__(self, entry, image_meta):
+        """
+        :param entry: Queue entry of the image, see `ImageCache`
+        :param image_meta: Mapping of image metadata
+        """
+        self.image_id = entry['image_id']
+        self.priority = entry['priority']
+        self.requests = entry['requests']
+        self.attempts = entry['attempts']
+        self.image_meta = image_meta
+        self.size = image_meta['size'] or 0
+        self.backend = get_backend(image_meta['location'])
+
+    def sort_key(self):
+        return (-self.priority, -self.requests, self.size)
+
+
+class Scheduler(object):
+
+    """
+    Hands queued images out to workers in priority order, while keeping
+    the number of images fetched at once from each backend within limits.
+    """
+
+    def __init__(self, images, default_limit, backend_limits):
+        """
+        :param images: List of `QueuedImage` instances
+        :param default_limit: Limit for backends without their own
+        :param backend_limits: Mapping of backend name to limit
+        """
+        self.pending = sorted(images, key=QueuedImage.sort_key)
+        self.default_limit = max(default_limit, 1)
+        self.backend_limits = backend_limits
+        self.active = {}
+        self._waiters = []
+
+    def next(self):
+        """
+        Returns the next image to fetch, waiting for a fetch to finish if
+        every backend with pending images is at its limit. Returns None
+        once there is nothing left to fetch.
+        """
+        while self.pending:
+            for index, image in enumerate(self.pending):
+                active = self.active.get(image.backend, 0)
+                limit = self.backend_limits.get(image.backend,
+                                                self.default_limit)
+                if active < limit:
+                    del self.pending[index]
+                    self.active[image.backend] = active + 1
+                    return image
+            waiter = event.Event()
+            self._waiters.append(waiter)
+            waiter.wait()
+        return None
+
+    def done(self, image):
+        """Records that a worker finished with an image"""
+        self.active[image.backend] -= 1
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.send()
+
+
+def get_backend(location):
+    """
+    Returns the name of the backend store an image location points to,
+    such as 'swift' for 'swift+https://...'.
+    """
+    scheme = urlparse.urlparse(location or '').scheme
+    return scheme.split('+')[0] or 'file'
+
+
+def parse_backend_limits(values):
+    """
+    Parses a list of 'backend:limit' strings into a mapping of backend
+    name to limit, skipping malformed values and limits below 1, which
+    would leave the images of a backend waiting forever.
+    """
+    limits = {}
+    for value in values:
+        backend, sep, limit = value.partition(':')
+        try:
+            limit = int(limit)
+        except ValueError:
+            logger.warn(_("Ignoring malformed prefetcher backend limit "
+                          "'%s'"), value)
+            continue
+        if limit < 1:
+            logger.warn(_("Ignoring prefetcher backend limit '%s', limits "
+                          "must be at least 1"), value)
+            continue
+        limits[backend.strip()] = limit
+    return limits
+
 
 class Prefetcher(object):
 
+    opts = [
+        cfg.IntOpt('image_cache_prefetch_workers', default=4),
+        cfg.IntOpt('image_cache_prefetch_rate_limit', default=0),  # B/s
+        cfg.ListOpt('image_cache_prefetch_backend_limits', default=[]),
+        cfg.FloatOpt('image_cache_prefetch_poll_interval', default=1.0),
+        cfg.IntOpt('image_cache_prefetch_retry_interval', default=60),
+        cfg.IntOpt('image_cache_prefetch_max_retry_interval', default=3600),
+        ]
+
     def __init__(self, conf, **local_conf):
         self.conf = conf
+        self.conf.register_opts(self.opts)
         glance.store.create_stores(conf)
         self.cache = ImageCache(conf)
         registry.configure_registry_client(conf)
         registry.configure_registry_admin_creds(conf)
+        self.throttle = Throttle(self.conf.image_cache_prefetch_rate_limit)
+        self.backend_limits = parse_backend_limits(
+                self.conf.image_cache_prefetch_backend_limits)
 
-    def fetch_image_into_cache(self, image_id):
+    def get_image_meta(self, image_id):
+        """
+        Returns the metadata of a queued image, or None if the image is
+        not active or not known to the registry.
+        """
         ctx = context.RequestContext(is_admin=True, show_deleted=True)
 
         try:
@@ -56,29 +197,70 @@ class Prefetcher(object):
             if image_meta['status'] != 'active':
                 logger.warn(_("Image '%s' is not active. Not caching."),
                             image_id)
-                return False
+                return None
 
         except exception.NotFound:
             logger.warn(_("No metadata found for image '%s'"), image_id)
-            return False
+            return None
+
+        return image_meta
 
-        image_data, image_size = get_from_backend(image_meta['location'])
-        logger.debug(_("Caching image '%s'"), image_id)
-        self.cache.cache_image_iter(image_id, image_data)
+    def fetch_image_into_cache(self, image):
+        image_id = image.image_id
+        self.cache.update_queue_entry(image_id, state='fetching',
+                                      size=image.size)
+        try:
+            location = image.image_meta['location']
+            image_data, image_size = get_from_backend(location)
+            logger.debug(_("Caching image '%s'"), image_id)
+            self.cache.cache_image_iter(
+                    image_id, self.throttle.throttled_iter(image_data),
+                    image.image_meta)
+        except Exception:
+            logger.exception(_("Failed to prefetch image '%s'"), image_id)
+            self.cache.update_queue_entry(image_id, state='failed',
+                                          attempts=image.attempts + 1)
+            return False
         return True
 
     def run(self):
 
-        images = self.cache.get_queued_images()
-        if not images:
+        entries = self.cache.get_queue_entries()
+        if not entries:
             logger.debug(_("Nothing to prefetch."))
             return True
 
-        num_images = len(images)
+        num_images = len(entries)
         logger.debug(_("Found %d images to prefetch"), num_images)
 
-        pool = eventlet.GreenPool(num_images)
-        results = pool.imap(self.fetch_image_into_cache, images)
+        num_workers = min(self.conf.image_cache_prefetch_workers, num_images)
+        pool = eventlet.GreenPool(max(num_workers, 1))
+
+        images = []
+        image_ids = [entry['image_id'] for entry in entries]
+        for entry, image_meta in zip(entries,
+                                     pool.imap(self.get_image_meta,
+                                               image_ids)):
+            if image_meta is not None:
+                images.append(QueuedImage(entry, image_meta))
+
+        scheduler = Scheduler(images, num_workers, self.backend_limits)
+        results = []
+
+        def worker():
+            while True:
+                image = scheduler.next()
+                if image is None:
+                    break
+                try:
+                    results.append(self.fetch_image_into_cache(image))
+                finally:
+                    scheduler.done(image)
+
+        for x in xrange(num_workers):
+            pool.spawn_n(worker)
+        pool.waitall()
+
         successes = sum([1 for r in results if r is True])
         if successes != num_images:
             logger.error(_("Failed to successfully cache all "
@@ -87,3 +269,162 @@ class Prefetcher(object):
 
         logger.info(_("Successfully cached all %d images"), num_images)
         return True
+
+    def serve(self):
+        """
+        Runs as a daemon, fetching images as they are queued, until
+        killed.
+        """
+        logger.info(_("Starting prefetcher daemon"))
+        self.start_daemon()
+        while True:
+            self.poll()
+            eventlet.sleep(self.conf.image_cache_prefetch_poll_interval)
+
+    def start_daemon(self):
+        """Opens the queue index and sets up the daemon's state"""
+        db_path = os.path.join(self.cache.driver.queue_dir,
+                               prefetch_queue.INDEX_FILE)
+        self.queue = prefetch_queue.PrefetchQueue(db_path)
+        self.pool = eventlet.GreenPool(
+                max(self.conf.image_cache_prefetch_workers, 1))
+        self.fetching = {}
+        self.synced_change = None
+        self.next_rescan = 0
+        self.trend_warmer = warmer.TrendWarmer(self.conf, self.cache)
+        self.next_warm = 0
+
+    def poll(self):
+        """
+        Queues trending images that dropped out of the cache when a
+        sample of the cache hits is due, brings the queue index up to
+        date if images were queued, then starts fetching the images that
+        are due, as far as the worker and backend limits allow.
+        """
+        now = time.time()
+        if self.trend_warmer.interval > 0 and now >= self.next_warm:
+            self.next_warm = now + self.trend_warmer.interval
+            try:
+                self.trend_warmer.run()
+            except Exception:
+                logger.exception(_("Failed to sample cache hit trends"))
+
+        self.sync_queue()
+        now = time.time()
+        for entry in self.queue.get_ready(now):
+            if not self.pool.free():
+                break
+            image_id = entry['image_id']
+            backend = entry['backend']
+            if image_id in self.fetching:
+                continue
+            limit = self.backend_limits.get(backend, self.pool.size)
+            if self.fetching.values().count(backend) >= limit:
+                continue
+            self.fetching[image_id] = backend
+            self.pool.spawn_n(self.prefetch, entry)
+
+    def sync_queue(self):
+        """
+        Mirrors the queue directory into the index. The queue is only
+        read when an image was queued since the last sync, or once every
+        `RESCAN_INTERVAL` seconds.
+        """
+        changed = self.cache.get_queue_changed_time()
+        now = time.time()
+        if changed == self.synced_change and now < self.next_rescan:
+            return
+        self.synced_change = changed
+        self.next_rescan = now + RESCAN_INTERVAL
+
+        entries = self.cache.get_queue_entries()
+        queued_ids = set(entry['image_id'] for entry in entries)
+        indexed = self.queue.get_entries()
+
+        # Images dequeued, or cached by someone else
+        for image_id in set(indexed) - queued_ids:
+            if image_id not in self.fetching:
+                self.queue.delete(image_id)
+
+        new_entries = []
+        for entry in entries:
+            image_id = entry['image_id']
+            indexed_entry = indexed.get(image_id)
+            if indexed_entry is None:
+                new_entries.append(entry)
+            elif (entry['priority'] != indexed_entry['priority'] or
+                  entry['requests'] != indexed_entry['requests']):
+                self.queue.update(image_id, priority=entry['priority'],
+                                  requests=entry['requests'])
+
+        if not new_entries:
+            return
+        logger.debug(_("Found %d newly queued images"), len(new_entries))
+        image_ids = [entry['image_id'] for entry in new_entries]
+        pool = eventlet.GreenPool(max(self.conf.image_cache_prefetch_workers,
+                                      1))
+        for entry, image_meta in zip(new_entries,
+                                     pool.imap(self.get_image_meta,
+                                               image_ids)):
+            if image_meta is None:
+                self.queue.add(entry, None, None)
+                self.retry_later(entry)
+            else:
+                self.queue.add(entry, image_meta['size'],
+                               get_backend(image_meta['location']))
+
+    def prefetch(self, entry):
+        """
+        Fetches an indexed image into the cache, scheduling a retry if
+        that fails.
+
+        :param entry: Indexed entry of the image
+        """
+        image_id = entry['image_id']
+        try:
+            if self.cache.is_cached(image_id):
+                self.queue.delete(image_id)
+                return
+            if not self.cache.is_queued(image_id):
+                # Dequeued since the last sync
+                self.queue.delete(image_id)
+                return
+
+            image_meta = self.get_image_meta(image_id)
+            if image_meta is None:
+                self.retry_later(entry)
+                return
+
+            image = QueuedImage(entry, image_meta)
+            if not self.fetch_image_into_cache(image):
+                self.retry_later(entry)
+            elif self.cache.is_cached(image_id):
+                logger.info(_("Prefetched image '%s'"), image_id)
+                self.queue.delete(image_id)
+            else:
+                # Someone else is writing the image into the cache
+                delay = self.conf.image_cache_prefetch_retry_interval
+                self.queue.update(image_id, retry_at=time.time() + delay)
+        except Exception:
+            logger.exception(_("Error prefetching image '%s'"), image_id)
+        finally:
+            del self.fetching[image_id]
+
+    def retry_later(self, entry):
+        """
+        Records a failed attempt to fetch an image and schedules the next
+        one, doubling the delay after each consecutive failure.
+
+        :param entry: Indexed entry of the image
+        """
+        image_id = entry['image_id']
+        attempts = entry['attempts'] + 1
+        delay = min(self.conf.image_cache_prefetch_retry_interval *
+                    2 ** (attempts - 1),
+                    self.conf.image_cache_prefetch_max_retry_interval)
+        self.queue.update(image_id, attempts=attempts,
+                          retry_at=time.time() + delay)
+        self.cache.update_queue_entry(image_id, state='failed',
+                                      attempts=attempts)
+        logger.warn(_("Will retry prefetching image '%(image_id)s' in "
+                      "%(delay)d seconds"), locals())
@@ -0,0 +1,112 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Trace-replay simulator for image cache eviction policies.
+
+A trace is a sequence of image requests, one per line in the form
+
+    <timestamp> <image_id> <size>
+
+with blank lines and lines starting with '#' ignored. Replaying the same
+trace against each eviction policy shows which one would serve the most
+requests, and the most bytes, from the cache for that workload.
+"""
+
+from glance.common import exception
+from glance.common import utils
+
+POLICIES = ('lru', 'lfu', 'gdsf', 'arc')
+
+
+def parse_trace(lines):
+    """
+    Returns an iterator over tuples of (timestamp, image_id, size) for
+    the requests in the supplied lines of a trace.
+
+    :param lines: Iterable of lines of a trace
+    :raises `glance.common.exception.Invalid` if a line is malformed
+    """
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        try:
+            timestamp, image_id, size = fields
+            yield float(timestamp), image_id, int(size)
+        except ValueError:
+            msg = _("Malformed trace line %(lineno)d: %(line)r") % locals()
+            raise exception.Invalid(msg)
+
+
+def load_policy(name, conf):
+    """
+    Returns an instance of the eviction policy with the supplied name.
+
+    :param name: Name of a module in `glance.image_cache.policies`
+    :param conf: Configuration options for the policy
+    """
+    policy_class = utils.import_class('glance.image_cache.policies.%s.Policy'
+                                      % name)
+    return policy_class(conf)
+
+
+def simulate(policy, trace, max_size):
+    """
+    Replays a trace against a cache of `max_size` bytes that evicts
+    images with the supplied policy, and returns a dict of statistics.
+
+    Misses cache the image straight away and evict images until the
+    cache fits again, so the cache never goes over its maximum size the
+    way it may between runs of glance-cache-pruner. Images larger than
+    the cache are never cached.
+
+    :param policy: Instance of an eviction policy
+    :param trace: Iterable of (timestamp, image_id, size) tuples
+    :param max_size: Maximum size of the cache in bytes
+    """
+    cached = {}
+    current_size = 0
+    requests = hits = bytes_requested = bytes_from_backend = 0
+
+    for timestamp, image_id, size in trace:
+        requests += 1
+        bytes_requested += size
+        if image_id in cached:
+            hits += 1
+            policy.access(image_id)
+            continue
+
+        bytes_from_backend += size
+        if size > max_size:
+            continue
+        cached[image_id] = size
+        current_size += size
+        policy.insert(image_id, size)
+        while current_size > max_size:
+            victim_id, victim_size = policy.evict()
+            del cached[victim_id]
+            current_size -= victim_size
+
+    return {'requests': requests,
+            'hits': hits,
+            'hit_ratio': float(hits) / requests if requests else 0.0,
+            'bytes_requested': bytes_requested,
+            'bytes_from_backend': bytes_from_backend,
+            'byte_hit_ratio': (1.0 - float(bytes_from_backend) /
+                               bytes_requested if bytes_requested else 0.0)}
@@ -0,0 +1,210 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Keeping the image cache within its maximum size from the API server.
+
+When `image_cache_auto_prune` is enabled, the API server does not wait
+for `glance-cache-pruner` to be run. Whenever the cache grows past its
+high watermark, a background greenthread removes images until the cache
+is back down to its low watermark, at a limited rate so that pruning
+never competes with downloads for the cache disk.
+
+Before an image of known size is written into the cache, space for it
+is reserved. If the image would take the cache past its maximum size,
+even counting the other images still being written, it is served
+without being cached, and the cache is pruned to make room for the
+next download instead: down to its low watermark, or further if the
+image would not fit even then.
+"""
+
+import logging
+
+import eventlet
+
+from glance.image_cache.throttle import Throttle
+from glance.openstack.common import cfg
+
+logger = logging.getLogger(__name__)
+
+_spaces = {}
+
+
+class Reservation(object):
+
+    """Space reserved in the cache for one image being written"""
+
+    def __init__(self, space, size):
+        self.space = space
+        self.size = size
+
+    def release(self):
+        """
+        Gives back the reserved space, once the image has either been
+        committed to the cache or thrown away. Releasing a reservation
+        more than once has no effect.
+        """
+        if self.size:
+            size, self.size = self.size, 0
+            self.space.release(size)
+
+
+class CacheSpace(object):
+
+    """
+    Tracks the space reserved for images being written into a cache, and
+    prunes the cache in the background when it passes its high watermark.
+    """
+
+    opts = [
+        cfg.BoolOpt('image_cache_auto_prune', default=False),
+        cfg.IntOpt('image_cache_high_watermark', default=95),  # percent
+        cfg.IntOpt('image_cache_low_watermark', default=85),  # percent
+        cfg.IntOpt('image_cache_prune_rate_limit',
+                   default=100 * 1024 * 1024),  # 100 MB/s
+        ]
+
+    def __init__(self, conf, cache):
+        """
+        :param conf: Configuration options for the image cache
+        :param cache: `ImageCache` to measure and prune the cache with
+        """
+        conf.register_opts(self.opts)
+        self.cache = cache
+        self.enabled = conf.image_cache_auto_prune
+        self.max_size = conf.image_cache_max_size
+        self.high_watermark = (self.max_size *
+                               conf.image_cache_high_watermark / 100)
+        self.low_watermark = (self.max_size *
+                              conf.image_cache_low_watermark / 100)
+        self.throttle = Throttle(conf.image_cache_prune_rate_limit)
+        self.reserved = 0
+        self.pruning = False
+        self.counters = {'refused': 0,
+                         'prunes': 0,
+                         'pruned_images': 0,
+                         'pruned_bytes': 0}
+
+    def reserve(self, size):
+        """
+        Reserves space for an image about to be written into the cache.
+        Returns a `Reservation` to release once the write has finished,
+        or None if the image does not fit in the cache.
+
+        :param size: Size of the image, or None if not known
+        """
+        if not self.enabled or not size:
+            return Reservation(self, 0)
+
+        used = self.cache.get_cache_size() + self.reserved
+        if used + size > self.max_size:
+            logger.info(_("Not caching image of %(size)d bytes, the cache "
+                          "has %(free)d bytes free") %
+                        {'size': size, 'free': max(self.max_size - used, 0)})
+            self.counters['refused'] += 1
+            if size <= self.max_size:
+                # Below the high watermark nothing else would prune the
+                # cache, so make room for this image to be cached next time
+                self._start_prune(min(self.low_watermark,
+                                      self.max_size - size))
+            return None
+
+        self.reserved += size
+        self.check()
+        return Reservation(self, size)
+
+    def release(self, size):
+        """
+        Gives back `size` bytes of reserved space, and starts pruning if
+        the image that was written took the cache past its high watermark.
+        """
+        self.reserved -= size
+        self.check()
+
+    def check(self):
+        """
+        Starts pruning the cache in the background if it is above its
+        high watermark and is not already being pruned.
+        """
+        if not self.enabled:
+            return
+        if self.cache.get_cache_size() + self.reserved > self.high_watermark:
+            self._start_prune(self.low_watermark)
+
+    def _start_prune(self, target_size):
+        if self.pruning:
+            return
+        self.pruning = True
+        eventlet.spawn_n(self.prune, target_size)
+
+    def prune(self, target_size=None):
+        """
+        Removes images from the cache, one at a time and at no more than
+        `image_cache_prune_rate_limit` bytes per second, until the cache
+        and the space reserved in it fit under `target_size` bytes, the
+        low watermark by default.
+        """
+        if target_size is None:
+            target_size = self.low_watermark
+        try:
+            self.counters['prunes'] += 1
+            target_size -= self.reserved
+            logger.debug(_("Pruning image cache to %d bytes"), target_size)
+            for image_id, size in self.cache.select_victims(target_size):
+                self.throttle.consume(size)
+                self.cache.delete_cached_image(image_id)
+                self.counters['pruned_images'] += 1
+                self.counters['pruned_bytes'] += size
+        except Exception:
+            logger.exception(_("Exception encountered while pruning the "
+                               "image cache"))
+        finally:
+            self.pruning = False
+
+    def get_stats(self):
+        """
+        Returns a dict of the watermarks, the space currently reserved,
+        the number of images that were not cached for lack of space, and
+        the number of background prunes and of images and bytes they
+        removed.
+        """
+        stats = dict(self.counters)
+        stats['enabled'] = self.enabled
+        stats['reserved'] = self.reserved
+        stats['high_watermark'] = self.high_watermark
+        stats['low_watermark'] = self.low_watermark
+        return stats
+
+
+def get_space(conf, cache):
+    """
+    Returns the `CacheSpace` for the cache directory in `conf`, shared by
+    everything in the process that uses the same cache. The first cache
+    to ask for it is used to measure and prune the cache.
+
+    :param conf: Configuration options for the image cache
+    :param cache: `ImageCache` asking for it
+    """
+    conf.register_opts(CacheSpace.opts)
+    key = (conf.image_cache_dir, conf.image_cache_max_size,
+           conf.image_cache_auto_prune, conf.image_cache_high_watermark,
+           conf.image_cache_low_watermark, conf.image_cache_prune_rate_limit)
+    space = _spaces.get(key)
+    if space is None:
+        space = CacheSpace(conf, cache)
+        _spaces[key] = space
+    return space
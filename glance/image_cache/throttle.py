@@ -0,0 +1,56 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Rate limiting of image cache background work
+"""
+
+import time
+
+import eventlet
+
+
+class Throttle(object):
+
+    """
+    Limits the combined rate at which image data is read, verified or
+    pruned through it to a number of bytes per second.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: Bytes per second, or 0 for no limit
+        """
+        self.rate = rate
+        self.next_time = 0
+
+    def consume(self, num_bytes):
+        """Waits until `num_bytes` more bytes may be read"""
+        if self.rate <= 0:
+            return
+        now = time.time()
+        duration = float(num_bytes) / self.rate
+        self.next_time = max(self.next_time, now) + duration
+        delay = self.next_time - now
+        if delay > 0:
+            eventlet.sleep(delay)
+
+    def throttled_iter(self, image_iter):
+        """Returns an iterator over the image data that obeys the limit"""
+        for chunk in image_iter:
+            self.consume(len(chunk))
+            yield chunk
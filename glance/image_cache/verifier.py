@@ -0,0 +1,163 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Verifies the integrity of the images in the image cache.
+
+Images are checked against their MD5 checksum as they are written into
+the cache, and the checksum is recorded with the cached image. The
+verifier re-reads cached image files and compares them with the
+recorded checksum, so that images corrupted on disk afterwards are taken
+out of the cache instead of being served. Corrupt files are moved to the
+invalid directory, where the cleaner eventually reaps them, and the
+image is fetched from its store again on the next request for it.
+
+Each run verifies the images not verified in the last
+`image_cache_verify_interval` seconds, least recently verified first,
+reading at no more than `image_cache_verify_rate_limit` bytes per second
+so that it leaves disk bandwidth for the images being served. When each
+image was last verified is remembered between runs, so an interrupted
+run picks up where it left off.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import time
+
+from glance.image_cache import ImageCache
+from glance.image_cache.throttle import Throttle
+from glance.openstack.common import cfg
+
+logger = logging.getLogger(__name__)
+
+# File in the base cache directory recording when images were verified
+VERIFIED_FILE = '.verified'
+
+CHUNK_SIZE = 65536
+
+
+class Verifier(object):
+
+    opts = [
+        cfg.IntOpt('image_cache_verify_interval', default=7 * 24 * 3600),
+        cfg.IntOpt('image_cache_verify_rate_limit',
+                   default=10 * 1024 * 1024),  # B/s
+        ]
+
+    def __init__(self, conf, **local_conf):
+        self.conf = conf
+        self.conf.register_opts(self.opts)
+        self.cache = ImageCache(conf)
+        self.throttle = Throttle(self.conf.image_cache_verify_rate_limit)
+        self.verified_path = os.path.join(self.conf.image_cache_dir,
+                                          VERIFIED_FILE)
+
+    def load(self):
+        try:
+            with open(self.verified_path) as verified_file:
+                return json.load(verified_file)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            logger.warn(_("Ignoring unreadable cache verification "
+                          "file %s"), self.verified_path)
+        return {}
+
+    def save(self, verified):
+        tmp_path = self.verified_path + '.tmp'
+        with open(tmp_path, 'w') as verified_file:
+            json.dump(verified, verified_file)
+        os.rename(tmp_path, self.verified_path)
+
+    def run(self):
+        """
+        Verifies the cached images that are due. Returns False if any
+        turned out to be corrupt.
+        """
+        verified = self.load()
+        cached_ids = [entry['image_id']
+                      for entry in self.cache.get_cached_images()]
+        # Forget about images that are no longer cached
+        verified = dict((image_id, verified[image_id])
+                        for image_id in cached_ids if image_id in verified)
+
+        due_before = time.time() - self.conf.image_cache_verify_interval
+        due = [image_id for image_id in cached_ids
+               if verified.get(image_id, 0) <= due_before]
+        due.sort(key=lambda image_id: verified.get(image_id, 0))
+        logger.debug(_("Found %d cached images to verify"), len(due))
+
+        num_corrupt = 0
+        for image_id in due:
+            if self.verify_image(image_id):
+                verified[image_id] = time.time()
+            else:
+                num_corrupt += 1
+                verified.pop(image_id, None)
+            self.save(verified)
+
+        if num_corrupt:
+            logger.error(_("Removed %d corrupt images from the cache"),
+                         num_corrupt)
+            return False
+        return True
+
+    def verify_image(self, image_id):
+        """
+        Re-reads a cached image and checks it against its recorded
+        checksum, taking it out of the cache if it does not match.
+        Images without a recorded checksum, such as those cached by
+        older releases, get the checksum of their current contents
+        recorded. Returns False if the image was corrupt.
+
+        :param image_id: Image ID
+        """
+        expected = self.cache.driver.get_checksum(image_id)
+        path = self.cache.driver.get_image_filepath(image_id)
+        md5 = hashlib.md5()
+        try:
+            # Read the file directly, so verifying does not count as hits
+            with open(path, 'rb') as image_file:
+                while True:
+                    chunk = image_file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    md5.update(chunk)
+                    self.throttle.consume(len(chunk))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Deleted or pruned while we were looking
+            return True
+        actual = md5.hexdigest()
+
+        if expected is None:
+            logger.debug(_("Recording checksum %(actual)s of cached image "
+                           "'%(image_id)s'"), locals())
+            self.cache.driver.set_checksum(image_id, actual)
+            return True
+        if actual != expected:
+            logger.error(_("Cached image '%(image_id)s' is corrupt, its "
+                           "checksum is %(actual)s instead of %(expected)s. "
+                           "Removing it from the cache."), locals())
+            self.cache.invalidate_cached_image(image_id)
+            return False
+        return True
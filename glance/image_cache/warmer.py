@@ -0,0 +1,214 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Automatic warming of the image cache.
+
+Two things queue images for prefetching without an operator having to:
+
+ * When `image_cache_warm_on_activation` is set, the API server queues
+   every image that becomes active through it, if the image matches the
+   `image_cache_warm_properties` and `image_cache_warm_max_size` rules.
+
+ * When `image_cache_warm_interval` is set, the prefetcher daemon
+   samples the hit counts of the cached images at that interval and
+   keeps a moving average of each image's hit rate. An image whose hits
+   in the last interval reach `image_cache_warm_min_hits` and are
+   `image_cache_warm_trend_factor` times its average is trending. If a
+   trending image drops out of the cache, because the pruner evicted it
+   or it was deleted, it is queued again so that the next burst of
+   requests for it does not go to the backend store.
+"""
+
+import errno
+import json
+import logging
+import os
+
+from glance.image_cache import ImageCache
+from glance.openstack.common import cfg
+
+logger = logging.getLogger(__name__)
+
+# File in the base cache directory holding the hit rate history
+TRENDS_FILE = '.trends'
+
+# Weight of the latest interval in the moving average of hit rates
+TREND_WEIGHT = 0.25
+
+
+def parse_property_rules(values):
+    """
+    Parses a list of 'name=value' strings into a mapping of image
+    property name to value, skipping malformed rules.
+    """
+    rules = {}
+    for value in values:
+        name, sep, expected = value.partition('=')
+        if not sep or not name.strip():
+            logger.warn(_("Ignoring malformed cache warming rule '%s'"),
+                        value)
+            continue
+        rules[name.strip()] = expected.strip()
+    return rules
+
+
+class ActivationWarmer(object):
+
+    """Queues images for prefetching as they become active"""
+
+    opts = [
+        cfg.BoolOpt('image_cache_warm_on_activation', default=False),
+        cfg.ListOpt('image_cache_warm_properties', default=[]),
+        cfg.IntOpt('image_cache_warm_max_size', default=0),
+        ]
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.conf.register_opts(self.opts)
+        self.enabled = self.conf.image_cache_warm_on_activation
+        self.rules = parse_property_rules(
+                self.conf.image_cache_warm_properties)
+        self.max_size = self.conf.image_cache_warm_max_size
+        self.cache = None
+
+    def matches(self, image_meta):
+        """
+        Returns True if the image passes the size limit and every
+        property rule. Rules are matched against the image's custom
+        properties first, then its base attributes, ignoring case.
+
+        :param image_meta: Mapping of image metadata
+        """
+        if self.max_size and (image_meta.get('size') or 0) > self.max_size:
+            return False
+        properties = image_meta.get('properties') or {}
+        for name, expected in self.rules.iteritems():
+            if name in properties:
+                value = properties[name]
+            else:
+                value = image_meta.get(name)
+            if value is None or unicode(value).lower() != expected.lower():
+                return False
+        return True
+
+    def image_activated(self, image_meta):
+        """
+        Queues a newly active image for prefetching if it matches the
+        rules. Errors are logged rather than raised, so a broken cache
+        never fails an upload.
+
+        :param image_meta: Mapping of image metadata
+        """
+        if not self.enabled or not self.matches(image_meta):
+            return
+        image_id = image_meta['id']
+        try:
+            if self.cache is None:
+                self.cache = ImageCache(self.conf)
+            if self.cache.queue_image(image_id):
+                logger.info(_("Queued newly active image '%s' for "
+                              "prefetching"), image_id)
+        except Exception:
+            logger.exception(_("Failed to queue newly active image '%s' "
+                               "for prefetching"), image_id)
+
+
+class TrendWarmer(object):
+
+    """Queues trending images again when they drop out of the cache"""
+
+    opts = [
+        cfg.IntOpt('image_cache_warm_interval', default=0),
+        cfg.FloatOpt('image_cache_warm_trend_factor', default=2.0),
+        cfg.IntOpt('image_cache_warm_min_hits', default=10),
+        ]
+
+    def __init__(self, conf, cache):
+        """
+        :param conf: Configuration options for the image cache
+        :param cache: `ImageCache` to sample and queue images in
+        """
+        self.conf = conf
+        self.conf.register_opts(self.opts)
+        self.cache = cache
+        self.interval = self.conf.image_cache_warm_interval
+        self.factor = self.conf.image_cache_warm_trend_factor
+        self.min_hits = self.conf.image_cache_warm_min_hits
+        self.trends_path = os.path.join(self.conf.image_cache_dir,
+                                        TRENDS_FILE)
+
+    def load(self):
+        try:
+            with open(self.trends_path) as trends_file:
+                return json.load(trends_file)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            logger.warn(_("Ignoring unreadable cache hit trends file %s"),
+                        self.trends_path)
+        return {}
+
+    def save(self, trends):
+        tmp_path = self.trends_path + '.tmp'
+        with open(tmp_path, 'w') as trends_file:
+            json.dump(trends, trends_file)
+        os.rename(tmp_path, self.trends_path)
+
+    def run(self):
+        """
+        Takes a sample of the hit counts of the cached images and queues
+        any trending image that is no longer cached. Returns the IDs of
+        the images queued.
+        """
+        trends = self.load()
+        new_trends = {}
+        for entry in self.cache.get_cached_images():
+            image_id = entry['image_id']
+            hits = entry['hits']
+            trend = trends.get(image_id)
+            if trend is None:
+                # No history to compare with yet
+                new_trends[image_id] = {'hits': hits, 'rate': 0.0,
+                                        'trending': False}
+                continue
+            recent = hits - trend['hits']
+            if recent < 0:
+                # The image was cached again since the last sample
+                recent = hits
+            trending = (recent >= self.min_hits and
+                        recent >= self.factor * trend['rate'])
+            rate = (1 - TREND_WEIGHT) * trend['rate'] + TREND_WEIGHT * recent
+            new_trends[image_id] = {'hits': hits, 'rate': rate,
+                                    'trending': trending}
+            if trending and not trend['trending']:
+                logger.info(_("Image '%(image_id)s' is trending with "
+                              "%(recent)d hits in the last interval"),
+                            locals())
+
+        queued = []
+        for image_id, trend in trends.iteritems():
+            if image_id in new_trends or not trend['trending']:
+                continue
+            if self.cache.queue_image(image_id):
+                logger.info(_("Queued trending image '%s' that dropped out "
+                              "of the cache"), image_id)
+                queued.append(image_id)
+
+        self.save(new_trends)
+        return queued
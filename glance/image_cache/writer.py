@@ -0,0 +1,261 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+"""
+Background writing of image data into the image cache.
+
+When an image is tee'd into the cache, the chunks sent to the client are
+handed to a writer greenthread through a buffer instead of being written
+to the cache file first, and the writer does the file I/O in eventlet's
+native thread pool. Since the eventlet hub does not make file I/O
+cooperative, writing in the request's greenthread would let a slow cache
+disk hold up not only that download, but every other request handled by
+the worker. If the writer falls more than `image_cache_write_buffer_size`
+bytes behind the client, caching of the image is abandoned instead.
+"""
+
+import logging
+
+import eventlet
+from eventlet import event
+from eventlet import queue
+from eventlet import tpool
+
+from glance.common import exception
+from glance.openstack.common import cfg
+
+logger = logging.getLogger(__name__)
+
+_writers = {}
+
+# Queued by the tee once it has seen all of the image data, or has
+# stopped reading it, to wake up the writer
+_EOF = object()
+
+
+class WriteAbandoned(Exception):
+    pass
+
+
+class CacheWriter(object):
+
+    """
+    Writes one image into the cache from a background greenthread, fed
+    with chunks by the iterator tee'ing the image into the cache.
+    """
+
+    def __init__(self, writers, driver, image_id, image_meta=None,
+                 checksum=None, size=None, reservation=None):
+        """
+        :param writers: The `CacheWriters` that started this writer
+        :param driver: Image cache driver to write the image with
+        :param image_id: Image ID
+        :param image_meta: Image metadata to snapshot once the image
+                           is cached
+        :param checksum: Expected MD5 checksum of the image
+        :param size: Size of the image, if known
+        :param reservation: Space reserved in the cache for the image,
+                            released once the write has finished
+        """
+        self.writers = writers
+        self.driver = driver
+        self.image_id = image_id
+        self.image_meta = image_meta
+        self.checksum = checksum
+        self.size = size
+        self.reservation = reservation
+        self.buffered = 0
+        self.stopped = False
+        self.reason = None
+        self.done = event.Event()
+        self._queue = queue.LightQueue()
+
+    def write(self, chunk):
+        """
+        Queues a chunk of image data for writing to the cache, abandoning
+        the write if that would take the amount of buffered data over the
+        configured limit.
+        """
+        if self.stopped:
+            return
+        if self.buffered + len(chunk) > self.writers.buffer_size:
+            logger.warn(_("Abandoning caching of image '%s', the cache "
+                          "could not keep up with the download")
+                        % self.image_id)
+            self.stop('abandoned')
+            return
+        self.buffered += len(chunk)
+        self._queue.put(chunk)
+        # Let the writer hand the chunk to the thread pool straight away
+        eventlet.sleep(0)
+
+    def close(self):
+        """
+        Lets the writer commit the image to the cache once it has written
+        out all of the buffered data.
+        """
+        if not self.stopped:
+            self.stopped = True
+            self._queue.put(_EOF)
+
+    def stop(self, reason):
+        """
+        Makes the writer throw away the partially written image.
+
+        :param reason: Name of the counter the stopped write is added to
+        """
+        if not self.stopped:
+            self.stopped = True
+            self.reason = reason
+            self._queue.put(_EOF)
+
+    def wait(self):
+        """Waits for the writer to finish"""
+        self.done.wait()
+
+    def run(self):
+        image_id = self.image_id
+        try:
+            with self.driver.open_for_write(image_id, self.checksum,
+                                            self.size) as cache_file:
+                while True:
+                    chunk = self._queue.get()
+                    if self.reason is not None:
+                        raise WriteAbandoned()
+                    if chunk is _EOF:
+                        break
+                    tpool.execute(cache_file.write, chunk)
+                    self.buffered -= len(chunk)
+                tpool.execute(cache_file.flush)
+        except WriteAbandoned:
+            self.writers.finished(self, self.reason)
+        except exception.ImageChecksumMismatch, e:
+            logger.error(_("Not caching image '%(image_id)s': %(e)s") %
+                         locals())
+            self.stopped = True
+            self.writers.finished(self, 'corrupt')
+        except exception.StorageFull:
+            logger.warn(_("Not caching image '%s', there is not enough "
+                          "space for it in the cache") % image_id)
+            self.stopped = True
+            self.writers.finished(self, 'failed')
+        except Exception:
+            logger.exception(_("Exception encountered while writing "
+                               "image '%s' into cache.") % image_id)
+            self.stopped = True
+            self.writers.finished(self, 'failed')
+        else:
+            self.writers.finished(self, 'completed')
+            if self.image_meta is not None:
+                self.save_metadata_snapshot()
+        finally:
+            if self.reservation is not None:
+                self.reservation.release()
+            self.done.send()
+
+    def save_metadata_snapshot(self):
+        # The image is cached by now, and can still be served without
+        # a snapshot, so failing to write one is not fatal
+        try:
+            self.driver.save_metadata_snapshot(self.image_id,
+                                               self.image_meta)
+        except Exception:
+            logger.exception(_("Failed to save metadata snapshot of "
+                               "image '%s'") % self.image_id)
+
+
+class CacheWriters(object):
+
+    """
+    Starts background writers for the images tee'd into a cache, and
+    counts how the writes ended.
+    """
+
+    opts = [
+        cfg.IntOpt('image_cache_write_buffer_size',
+                   default=16 * 1024 * 1024),  # 16 MB
+        ]
+
+    def __init__(self, conf):
+        conf.register_opts(self.opts)
+        self.buffer_size = conf.image_cache_write_buffer_size
+        self.active = {}
+        self.counters = {'started': 0,
+                         'completed': 0,
+                         'abandoned': 0,
+                         'incomplete': 0,
+                         'corrupt': 0,
+                         'failed': 0}
+
+    def start(self, driver, image_id, image_meta=None, checksum=None,
+              size=None, reservation=None):
+        """
+        Starts writing an image into the cache in the background, and
+        returns the `CacheWriter` to feed the image data to.
+
+        :param driver: Image cache driver to write the image with
+        :param image_id: Image ID
+        :param image_meta: Image metadata to snapshot once the image
+                           is cached
+        :param checksum: Expected MD5 checksum of the image
+        :param size: Size of the image, if known
+        :param reservation: Space reserved in the cache for the image
+        """
+        writer = CacheWriter(self, driver, image_id, image_meta, checksum,
+                             size, reservation)
+        self.active[writer] = image_id
+        self.counters['started'] += 1
+        eventlet.spawn_n(writer.run)
+        return writer
+
+    def finished(self, writer, outcome):
+        del self.active[writer]
+        self.counters[outcome] += 1
+
+    def wait(self):
+        """Waits for every write in progress to finish"""
+        for writer in self.active.keys():
+            writer.wait()
+
+    def get_stats(self):
+        """
+        Returns a dict of the write buffer size and the number of writes
+        started, writes in progress, and writes that completed, were
+        abandoned because the cache fell behind the download, were left
+        incomplete because the download stopped early, or failed.
+        """
+        stats = dict(self.counters)
+        stats['active'] = len(self.active)
+        stats['buffer_size'] = self.buffer_size
+        return stats
+
+
+def get_writers(conf):
+    """
+    Returns the `CacheWriters` for the cache directory and settings in
+    `conf`, shared by everything in the process that uses the same cache.
+
+    :param conf: Configuration options for the image cache
+    """
+    conf.register_opts(CacheWriters.opts)
+    key = (conf.image_cache_dir, conf.image_cache_write_buffer_size)
+    writers = _writers.get(key)
+    if writers is None:
+        writers = CacheWriters(conf)
+        _writers[key] = writers
+    return writers
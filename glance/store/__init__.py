@@ -15,11 +15,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import logging
 import os
 import sys
 import time
 
+import eventlet
+import eventlet.queue
+
 from glance.common import exception
 from glance.common import utils
 from glance.openstack.common import cfg
@@ -89,10 +93,17 @@ class Indexable(object):
 
     def __iter__(self):
         """
-        Delegate iteration to the wrapped instance.
+        Delegate iteration to the wrapped instance, closing it if the
+        iteration is abandoned before the end.
         """
-        for self.chunk in self.wrapped:
-            yield self.chunk
+        completed = False
+        try:
+            for self.chunk in self.wrapped:
+                yield self.chunk
+            completed = True
+        finally:
+            if not completed:
+                self.close()
 
     def __getitem__(self, i):
         """
@@ -115,6 +126,13 @@ class Indexable(object):
         """Implemented by subclasses to return the next element"""
         raise NotImplementedError
 
+    def close(self):
+        """
+        Close the wrapped iterator or filelike, if it can be closed.
+        """
+        if hasattr(self.wrapped, 'close'):
+            self.wrapped.close()
+
     def getvalue(self):
         """
         Return entire string value... used in testing
@@ -128,6 +146,99 @@ class Indexable(object):
         return self.size
 
 
+class ParallelReader(object):
+
+    """
+    Iterator over image data that a store fetches in parts, several at a
+    time, yielding the parts in order.
+
+    At most `concurrency` parts are being fetched at once. Each part is
+    streamed into a buffer of at most `read_ahead` chunks, and its fetch
+    waits while the buffer is full, so the data read ahead of a slow
+    reader stays bounded. Each part must have the expected size, so that
+    the byte count of the whole image stays right.
+    """
+
+    CHUNKSIZE = 65536
+
+    def __init__(self, fetch, parts, concurrency, read_ahead=16):
+        """
+        :param fetch: Callable taking a part and returning an iterator
+                      over its data
+        :param parts: Iterable of (part, size) pairs, in order
+        :param concurrency: Maximum number of parts fetched at once
+        :param read_ahead: Maximum number of chunks of a part buffered
+        """
+        self.fetch = fetch
+        self.parts = parts
+        self.concurrency = max(1, concurrency)
+        self.read_ahead = max(1, read_ahead)
+        self._chunks = self._read()
+
+    def __iter__(self):
+        return self._chunks
+
+    def next(self):
+        return self._chunks.next()
+
+    def close(self):
+        """
+        Stops the fetches still in progress, for a reader abandoned
+        before the end.
+        """
+        self._chunks.close()
+
+    def _fetch(self, part, buffered):
+        chunks = self.fetch(part)
+        try:
+            for chunk in chunks:
+                buffered.put(chunk)
+        except Exception, e:
+            buffered.put(e)
+        else:
+            buffered.put(None)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def _read(self):
+        parts = iter(self.parts)
+        pending = collections.deque()
+        try:
+            while True:
+                for part, size in parts:
+                    buffered = eventlet.queue.Queue(self.read_ahead)
+                    fetcher = eventlet.spawn(self._fetch, part, buffered)
+                    pending.append((fetcher, buffered, part, size))
+                    if len(pending) >= self.concurrency:
+                        break
+                if not pending:
+                    break
+                fetcher, buffered, part, size = pending[0]
+                got = 0
+                while True:
+                    data = buffered.get()
+                    if data is None:
+                        break
+                    if isinstance(data, Exception):
+                        raise data
+                    got += len(data)
+                    for offset in xrange(0, len(data), self.CHUNKSIZE):
+                        yield data[offset:offset + self.CHUNKSIZE]
+                if got != size:
+                    msg = (_("Expected %(size)d bytes of part %(part)s of "
+                             "the image, but got %(got)d") % locals())
+                    raise BackendException(msg)
+                pending.popleft()
+        finally:
+            if pending:
+                # Let every fetcher start, as one that has not started
+                # cannot be killed
+                eventlet.sleep(0)
+                for fetcher, buffered, part, size in pending:
+                    fetcher.kill()
+
+
 def register_store(store_module, schemes):
     """
     Registers a store module and a set of schemes
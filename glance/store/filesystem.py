@@ -26,6 +26,7 @@ import os
 import urlparse
 
 from glance.common import exception
+from glance.common import fileutils
 from glance.common import utils
 from glance.openstack.common import cfg
 import glance.store
@@ -66,7 +67,8 @@ class ChunkedFile(object):
 
     """
     We send this back to the Glance API server as
-    something that can iterate over a large file
+    something that can iterate over a large file, or
+    seek within it to serve ranges of it
     """
 
     CHUNKSIZE = 65536
@@ -87,6 +89,14 @@ class ChunkedFile(object):
         finally:
             self.close()
 
+    def seek(self, offset):
+        """Move to `offset` bytes into the image file"""
+        self.fp.seek(offset)
+
+    def read(self, size=-1):
+        """Read up to `size` bytes from the current offset"""
+        return self.fp.read(size)
+
     def close(self):
         """Close the internal file pointer"""
         if self.fp:
@@ -198,18 +208,27 @@ class Store(glance.store.base.Store):
         bytes_written = 0
         try:
             with open(filepath, 'wb') as f:
+                # Reserve the space up front, so a full disk is noticed
+                # before any of the image has been uploaded
+                fileutils.preallocate(f.fileno(), image_size)
+                drop_behind = fileutils.DropBehind(f.fileno())
                 for buf in utils.chunkreadable(image_file,
                                               ChunkedFile.CHUNKSIZE):
                     bytes_written += len(buf)
                     checksum.update(buf)
                     f.write(buf)
+                    drop_behind.wrote(len(buf))
         except IOError as e:
+            self._remove_partial(filepath)
             if e.errno in [errno.EFBIG, errno.ENOSPC]:
                 raise exception.StorageFull()
             elif e.errno == errno.EACCES:
                 raise exception.StorageWriteDenied()
             else:
                 raise
+        except exception.StorageFull:
+            self._remove_partial(filepath)
+            raise
 
         checksum_hex = checksum.hexdigest()
 
@@ -217,5 +236,11 @@ class Store(glance.store.base.Store):
                      "checksum %(checksum_hex)s") % locals())
         return ('file://%s' % filepath, bytes_written, checksum_hex)
 
+    def _remove_partial(self, filepath):
+        try:
+            os.unlink(filepath)
+        except OSError:
+            pass
+
 
 glance.store.register_store(__name__, ['filesystem', 'file'])
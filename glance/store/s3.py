@@ -20,10 +20,14 @@
 import logging
 import hashlib
 import httplib
+import itertools
 import re
-import tempfile
+import StringIO
+import sys
 import urlparse
 
+import eventlet
+
 from glance.common import exception
 from glance.common import utils
 from glance.openstack.common import cfg
@@ -194,10 +198,26 @@ class Store(glance.store.base.Store):
         cfg.StrOpt('s3_store_access_key', secret=True),
         cfg.StrOpt('s3_store_secret_key', secret=True),
         cfg.StrOpt('s3_store_bucket'),
-        cfg.StrOpt('s3_store_object_buffer_dir'),
         cfg.BoolOpt('s3_store_create_bucket_on_put', default=False),
+        cfg.IntOpt('s3_store_multipart_part_size', default=10),
+        cfg.IntOpt('s3_store_multipart_concurrency', default=1),
+        cfg.IntOpt('s3_store_download_concurrency', default=1),
+        cfg.IntOpt('s3_store_download_range_size', default=16),
         ]
 
+    def configure(self):
+        """
+        Configure the Store to use the stored configuration options
+        Any store that needs special configuration should implement
+        this method.
+        """
+        self.conf.register_opts(self.opts)
+        self.download_concurrency = max(
+                1, self.conf.s3_store_download_concurrency)
+        # The config file has s3_store_download_range_size in MB
+        self.download_range_size = max(
+                1, self.conf.s3_store_download_range_size) * 1024 * 1024
+
     def configure_add(self):
         """
         Configure the Store to use the stored configuration options
@@ -205,7 +225,6 @@ class Store(glance.store.base.Store):
         this method. If the store was not able to successfully configure
         itself, it should raise `exception.BadStoreConfiguration`
         """
-        self.conf.register_opts(self.opts)
         self.s3_host = self._option_get('s3_store_host')
         access_key = self._option_get('s3_store_access_key')
         secret_key = self._option_get('s3_store_secret_key')
@@ -226,8 +245,12 @@ class Store(glance.store.base.Store):
         else:  # Defaults http
             self.full_s3_host = 'http://' + self.s3_host
 
-        self.s3_store_object_buffer_dir = \
-            self.conf.s3_store_object_buffer_dir
+        # The config file has s3_store_multipart_part_size in MB, and S3
+        # takes no parts smaller than 5MB, other than the last
+        self.multipart_part_size = max(
+                5, self.conf.s3_store_multipart_part_size) * 1024 * 1024
+        self.multipart_concurrency = max(
+                1, self.conf.s3_store_multipart_concurrency)
 
     def _option_get(self, param):
         result = getattr(self.conf, param)
@@ -251,6 +274,20 @@ class Store(glance.store.base.Store):
         """
         key = self._retrieve_key(location)
 
+        if (self.download_concurrency > 1 and
+                key.size > self.download_range_size):
+            class RangedIndexable(glance.store.Indexable):
+                def another(self):
+                    try:
+                        return self.wrapped.next()
+                    except StopIteration:
+                        return ''
+
+            reader = glance.store.ParallelReader(
+                    self._get_range(key), self._get_ranges(key.size),
+                    self.download_concurrency)
+            return (RangedIndexable(reader, key.size), key.size)
+
         key.BufferSize = self.CHUNKSIZE
 
         class ChunkedIndexable(glance.store.Indexable):
@@ -260,6 +297,28 @@ class Store(glance.store.base.Store):
 
         return (ChunkedIndexable(ChunkedFile(key), key.size), key.size)
 
+    def _get_ranges(self, size):
+        """
+        Returns the byte ranges, as (first, last) byte offsets, and their
+        sizes that an object of `size` bytes is fetched in.
+        """
+        ranges = []
+        for first in xrange(0, size, self.download_range_size):
+            last = min(first + self.download_range_size, size) - 1
+            ranges.append(((first, last), last - first + 1))
+        return ranges
+
+    def _get_range(self, key):
+        """
+        Returns a callable that fetches a byte range of the supplied key,
+        over a request of its own, as a list of a single string.
+        """
+        def fetch(byte_range):
+            range_key = key.__class__(key.bucket, key.name)
+            headers = {'Range': 'bytes=%d-%d' % byte_range}
+            return [range_key.get_contents_as_string(headers=headers)]
+        return fetch
+
     def get_size(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
@@ -354,39 +413,29 @@ class Store(glance.store.base.Store):
                 'obj_name': obj_name})
         logger.debug(msg)
 
-        key = bucket_obj.new_key(obj_name)
-
-        # We need to wrap image_file, which is a reference to the
-        # webob.Request.body_file, with a seekable file-like object,
-        # otherwise the call to set_contents_from_file() will die
-        # with an error about Input object has no method 'seek'. We
-        # might want to call webob.Request.make_body_seekable(), but
-        # unfortunately, that method copies the entire image into
-        # memory and results in LP Bug #818292 occurring. So, here
-        # we write temporary file in as memory-efficient manner as
-        # possible and then supply the temporary file to S3. We also
-        # take this opportunity to calculate the image checksum while
-        # writing the tempfile, so we don't need to call key.compute_md5()
-
-        msg = _("Writing request body file to temporary file "
-                "for %s") % _sanitize(loc.get_uri())
-        logger.debug(msg)
-
-        tmpdir = self.s3_store_object_buffer_dir
-        temp_file = tempfile.NamedTemporaryFile(dir=tmpdir)
+        # The image data is streamed to S3 in parts, which are held in
+        # memory, as image_file cannot be rewound. The checksum is worked
+        # out as the parts are read, so we don't need key.compute_md5()
         checksum = hashlib.md5()
-        for chunk in utils.chunkreadable(image_file, self.CHUNKSIZE):
-            checksum.update(chunk)
-            temp_file.write(chunk)
-        temp_file.flush()
-
-        msg = (_("Uploading temporary file to S3 for %s") %
-               _sanitize(loc.get_uri()))
-        logger.debug(msg)
-
-        # OK, now upload the data into the key
-        key.set_contents_from_file(open(temp_file.name, 'r+b'), replace=False)
-        size = key.size
+        parts = self._get_parts(image_file, checksum)
+        first_part = next(parts, '')
+        second_part = next(parts, None)
+        if second_part is None:
+            # The image fits in a single part, so is sent with a plain PUT
+            msg = (_("Uploading image data to S3 for %s") %
+                   _sanitize(loc.get_uri()))
+            logger.debug(msg)
+            key = bucket_obj.new_key(obj_name)
+            key.set_contents_from_file(StringIO.StringIO(first_part),
+                                       replace=False)
+            size = len(first_part)
+        else:
+            msg = (_("Uploading image data to S3 in parts for %s") %
+                   _sanitize(loc.get_uri()))
+            logger.debug(msg)
+            size = self._add_multipart(
+                    bucket_obj, obj_name,
+                    itertools.chain([first_part, second_part], parts))
         checksum_hex = checksum.hexdigest()
 
         logger.debug(_("Wrote %(size)d bytes to S3 key named %(obj_name)s "
@@ -394,6 +443,82 @@ class Store(glance.store.base.Store):
 
         return (loc.get_uri(), size, checksum_hex)
 
+    def _get_parts(self, image_file, checksum):
+        """
+        Yields the image data in parts of ``s3_store_multipart_part_size``
+        MB, the last of which may be smaller, updating `checksum` with the
+        data as it is read.
+        """
+        part = StringIO.StringIO()
+        part_size = 0
+        for chunk in utils.chunkreadable(image_file, self.CHUNKSIZE):
+            checksum.update(chunk)
+            while chunk:
+                room = self.multipart_part_size - part_size
+                part.write(chunk[:room])
+                part_size += min(room, len(chunk))
+                chunk = chunk[room:]
+                if part_size == self.multipart_part_size:
+                    yield part.getvalue()
+                    part = StringIO.StringIO()
+                    part_size = 0
+        if part_size:
+            yield part.getvalue()
+
+    def _add_multipart(self, bucket_obj, obj_name, parts):
+        """
+        Uploads the supplied parts of the image data as a multipart upload,
+        with up to ``s3_store_multipart_concurrency`` parts being uploaded
+        at once, and returns the size of the image. The multipart upload
+        is aborted if a part fails, so S3 does not keep the parts.
+        """
+        upload = bucket_obj.initiate_multipart_upload(obj_name)
+        pool = eventlet.GreenPool(self.multipart_concurrency)
+        errors = []
+
+        def upload_part(part, part_num):
+            if errors:
+                return
+            try:
+                upload.upload_part_from_file(StringIO.StringIO(part),
+                                             part_num)
+                logger.debug(_("Uploaded part %(part_num)d of %(obj_name)s "
+                               "to S3") % dict(part_num=part_num,
+                                               obj_name=obj_name))
+            except Exception, e:
+                logger.error(_("Failed to upload part %(part_num)d of "
+                               "%(obj_name)s to S3: %(e)s") %
+                             dict(part_num=part_num, obj_name=obj_name, e=e))
+                errors.append(e)
+
+        size = 0
+        try:
+            part_num = 1
+            for part in parts:
+                if errors:
+                    break
+                # Blocks while the maximum number of parts are uploading,
+                # which bounds the number of parts held in memory
+                pool.spawn_n(upload_part, part, part_num)
+                part_num += 1
+                size += len(part)
+            pool.waitall()
+            if errors:
+                raise errors[0]
+            upload.complete_upload()
+        except Exception:
+            exc_info = sys.exc_info()
+            pool.waitall()
+            logger.error(_("Aborting multipart upload of %s to S3"),
+                         obj_name)
+            try:
+                upload.cancel_upload()
+            except Exception, e:
+                logger.error(_("Failed to abort multipart upload of "
+                               "%(obj_name)s to S3: %(e)s") % locals())
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return size
+
     def delete(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
@@ -23,8 +23,12 @@ import hashlib
 import httplib
 import logging
 import math
+import socket
+import tempfile
 import urlparse
 
+import eventlet
+
 from glance.common import exception
 from glance.openstack.common import cfg
 import glance.store
@@ -200,12 +204,24 @@ class Store(glance.store.base.Store):
         cfg.IntOpt('swift_store_large_object_chunk_size',
                    default=DEFAULT_LARGE_OBJECT_CHUNK_SIZE),
         cfg.BoolOpt('swift_store_create_container_on_put', default=False),
+        cfg.IntOpt('swift_store_upload_concurrency', default=1),
+        cfg.IntOpt('swift_store_segment_retries', default=2),
+        cfg.IntOpt('swift_store_delete_concurrency', default=10),
+        cfg.IntOpt('swift_store_connection_pool_size', default=10),
+        cfg.IntOpt('swift_store_download_concurrency', default=1),
         ]
 
     def configure(self):
         self.conf.register_opts(self.opts)
         self.snet = self.conf.swift_enable_snet
         self.auth_version = self._option_get('swift_store_auth_version')
+        self.segment_retries = max(0, self.conf.swift_store_segment_retries)
+        self.delete_concurrency = max(
+                1, self.conf.swift_store_delete_concurrency)
+        self.connection_pool_size = max(
+                0, self.conf.swift_store_connection_pool_size)
+        self.download_concurrency = max(
+                1, self.conf.swift_store_download_concurrency)
 
     def configure_add(self):
         """
@@ -232,6 +248,9 @@ class Store(glance.store.base.Store):
             raise exception.BadStoreConfiguration(store_name="swift",
                                                   reason=reason)
 
+        self.upload_concurrency = max(1,
+                                      self.conf.swift_store_upload_concurrency)
+
         self.scheme = 'swift+https'
         if self.auth_address.startswith('http://'):
             self.scheme = 'swift+http'
@@ -252,14 +271,19 @@ class Store(glance.store.base.Store):
         :raises `glance.exception.NotFound` if image does not exist
         """
         loc = location.store_location
-        swift_conn = self._make_swift_connection(
+        swift_conn = self._get_swift_connection(
             auth_url=loc.swift_auth_url, user=loc.user, key=loc.key)
 
         try:
-            (resp_headers, resp_body) = swift_conn.get_object(
-                container=loc.container, obj=loc.obj,
-                resp_chunk_size=self.CHUNKSIZE)
+            segments = None
+            if self.download_concurrency > 1:
+                segments = self._get_segments(swift_conn, loc)
+            if segments is None:
+                (resp_headers, resp_body) = swift_conn.get_object(
+                    container=loc.container, obj=loc.obj,
+                    resp_chunk_size=self.CHUNKSIZE)
         except swift_client.ClientException, e:
+            self._release_swift_connection(swift_conn)
             if e.http_status == httplib.NOT_FOUND:
                 uri = location.get_store_uri()
                 raise exception.NotFound(_("Swift could not find image at "
@@ -267,14 +291,38 @@ class Store(glance.store.base.Store):
             else:
                 raise
 
+        if segments is not None:
+            # The segments are fetched over connections of their own
+            self._release_swift_connection(swift_conn)
+            swift_conn = None
+            resp_body, length = segments
+        else:
+            length = resp_headers.get('content-length')
+
+        store = self
+
         class ResponseIndexable(glance.store.Indexable):
+            # The connection is busy until the whole response has been
+            # read, after which it is handed back to the pool
+            connection = swift_conn
+
+            def __iter__(self):
+                for chunk in super(ResponseIndexable, self).__iter__():
+                    yield chunk
+                self.release()
+
             def another(self):
                 try:
                     return self.wrapped.next()
                 except StopIteration:
+                    self.release()
                     return ''
 
-        length = resp_headers.get('content-length')
+            def release(self):
+                if self.connection is not None:
+                    store._release_swift_connection(self.connection)
+                    self.connection = None
+
         return (ResponseIndexable(resp_body, length), length)
 
     def get_size(self, location):
@@ -287,19 +335,117 @@ class Store(glance.store.base.Store):
                         from glance.store.location.get_location_from_uri()
         """
         loc = location.store_location
-        swift_conn = self._make_swift_connection(
+        swift_conn = self._get_swift_connection(
             auth_url=loc.swift_auth_url, user=loc.user, key=loc.key)
 
         try:
             resp_headers = swift_conn.head_object(container=loc.container,
                                                   obj=loc.obj)
+            self._release_swift_connection(swift_conn)
             return resp_headers.get('content-length', 0)
         except Exception:
             return 0
 
-    def _make_swift_connection(self, auth_url, user, key):
+    def _get_segments(self, swift_conn, loc):
+        """
+        Returns a tuple of an iterator over the image data of a large
+        object, which streams up to ``swift_store_download_concurrency``
+        of its segments at once, and the image size. Returns None for an
+        object that is not segmented, or whose segment listing does not
+        add up to its size yet, which is read as a single stream instead.
+        """
+        headers = swift_conn.head_object(loc.container, loc.obj)
+        manifest = headers.get('x-object-manifest')
+        if not manifest:
+            return None
+
+        container, prefix = manifest.split('/', 1)
+        segments = [(segment['name'], int(segment['bytes']))
+                    for segment in self._list_segments(swift_conn, loc,
+                                                       container, prefix)]
+        length = int(headers.get('content-length', 0))
+        if sum(size for name, size in segments) != length:
+            logger.warn(_("Segments of %(obj)s do not add up to its size, "
+                          "reading it as a single stream") %
+                        dict(obj=loc.obj))
+            return None
+
+        def fetch(name):
+            segment_conn = self._get_swift_connection(
+                auth_url=loc.swift_auth_url, user=loc.user, key=loc.key)
+            # A connection is only reused once its response has been read
+            completed = False
+            try:
+                resp_headers, chunks = segment_conn.get_object(
+                    container, name, resp_chunk_size=self.CHUNKSIZE)
+                for chunk in chunks:
+                    yield chunk
+                completed = True
+            except swift_client.ClientException:
+                completed = True
+                raise
+            finally:
+                if completed:
+                    self._release_swift_connection(segment_conn)
+
+        # Let the connections for the segments use the token of this one
+        CONNECTION_POOL.save_auth(swift_conn)
+        return (glance.store.ParallelReader(fetch, segments,
+                                            self.download_concurrency),
+                length)
+
+    def _list_segments(self, swift_conn, loc, container, prefix):
+        """
+        Yields the container listing entries of the segments of a large
+        object, a page at a time, as Swift returns at most 10,000 objects
+        per container listing.
+        """
+        marker = None
+        while True:
+            segments = swift_conn.get_container(container, prefix=prefix,
+                                                marker=marker)[1]
+            if not segments:
+                break
+            for segment in segments:
+                # The manifest itself matches the prefix of its segments
+                # when they share a container
+                if container != loc.container or segment['name'] != loc.obj:
+                    yield segment
+            marker = segments[-1]['name']
+
+    def _get_swift_connection(self, auth_url, user, key, retries=5):
+        """
+        Returns an authenticated connection from the process-wide pool of
+        Swift connections, creating one if none are idle. The connection
+        should be handed back with `_release_swift_connection` once its
+        request has completed; a connection that is not handed back is
+        simply not reused.
+
+        :param retries: Number of times the client library retries a
+                        request that failed with a server error
+        """
+        # Pooled connections are keyed by the auth URL they were made with
+        if auth_url and not auth_url.endswith('/'):
+            auth_url += '/'
+        return CONNECTION_POOL.get(self._make_swift_connection, auth_url,
+                                   user, key, retries)
+
+    def _release_swift_connection(self, swift_conn):
+        """
+        Hands a connection back to the pool, after a request on it has
+        completed, whether successfully or with a `ClientException`.
+        """
+        CONNECTION_POOL.put(swift_conn, self.connection_pool_size)
+
+    def _make_swift_connection(self, auth_url, user, key, retries=5,
+                               preauthurl=None, preauthtoken=None):
         """
         Creates a connection using the Swift client library.
+
+        :param retries: Number of times the client library retries a
+                        request that failed with a server error
+        :param preauthurl: Storage URL from an earlier authentication
+        :param preauthtoken: Token from an earlier authentication
         """
         snet = self.snet
         auth_version = self.auth_version
@@ -311,7 +457,8 @@ class Store(glance.store.base.Store):
                      locals())
         return swift_client.Connection(
             authurl=full_auth_url, user=user, key=key, snet=snet,
-            auth_version=auth_version)
+            auth_version=auth_version, retries=retries,
+            preauthurl=preauthurl, preauthtoken=preauthtoken)
 
     def _option_get(self, param):
         result = getattr(self.conf, param)
@@ -358,7 +505,7 @@ class Store(glance.store.base.Store):
               of an unknown size, as pushing them directly to swift would
               fail if the image turns out to be greater than 5GB.
         """
-        swift_conn = self._make_swift_connection(
+        swift_conn = self._get_swift_connection(
             auth_url=self.full_auth_address, user=self.user, key=self.key)
 
         create_container_if_missing(self.container, swift_conn, self.conf)
@@ -382,7 +529,6 @@ class Store(glance.store.base.Store):
                                                  content_length=image_size)
             else:
                 # Write the image into Swift in chunks.
-                chunk_id = 1
                 if image_size > 0:
                     total_chunks = str(int(
                         math.ceil(float(image_size) /
@@ -396,40 +542,14 @@ class Store(glance.store.base.Store):
                     total_chunks = '?'
 
                 checksum = hashlib.md5()
-                combined_chunks_size = 0
-                while True:
-                    chunk_size = self.large_object_chunk_size
-                    if image_size == 0:
-                        content_length = None
-                    else:
-                        left = image_size - combined_chunks_size
-                        if left == 0:
-                            break
-                        if chunk_size > left:
-                            chunk_size = left
-                        content_length = chunk_size
-
-                    chunk_name = "%s-%05d" % (obj_name, chunk_id)
-                    reader = ChunkReader(image_file, checksum, chunk_size)
-                    chunk_etag = swift_conn.put_object(
-                        self.container, chunk_name, reader,
-                        content_length=content_length)
-                    bytes_read = reader.bytes_read
-                    logger.debug(_("Wrote chunk %(chunk_id)d/"
-                                   "%(total_chunks)s of length %(bytes_read)d "
-                                   "to Swift returning MD5 of content: "
-                                   "%(chunk_etag)s")
-                                 % locals())
-
-                    if bytes_read == 0:
-                        # Delete the last chunk, because it's of zero size.
-                        # This will happen if image_size == 0.
-                        logger.debug(_("Deleting final zero-length chunk"))
-                        swift_conn.delete_object(self.container, chunk_name)
-                        break
-
-                    chunk_id += 1
-                    combined_chunks_size += bytes_read
+                if self.upload_concurrency > 1:
+                    combined_chunks_size = self._add_segments_concurrently(
+                            swift_conn, obj_name, image_file, image_size,
+                            checksum, total_chunks)
+                else:
+                    combined_chunks_size = self._add_segments(
+                            swift_conn, obj_name, image_file, image_size,
+                            checksum, total_chunks)
 
                 # In the case we have been given an unknown image size,
                 # set the image_size to the total size of the combined chunks.
@@ -457,8 +577,10 @@ class Store(glance.store.base.Store):
             # the location attribute from GET /images/<ID> and
             # GET /images/details
 
+            self._release_swift_connection(swift_conn)
             return (location.get_uri(), image_size, obj_etag)
         except swift_client.ClientException, e:
+            self._release_swift_connection(swift_conn)
             if e.http_status == httplib.CONFLICT:
                 raise exception.Duplicate(_("Swift already has an image at "
                                           "location %s") % location.get_uri())
@@ -467,6 +589,127 @@ class Store(glance.store.base.Store):
             logger.error(msg)
             raise glance.store.BackendException(msg)
 
+    def _add_segments(self, swift_conn, obj_name, image_file, image_size,
+                      checksum, total_chunks):
+        """
+        Writes the image data into Swift as segments of a large object,
+        one segment after another, and returns the combined size of the
+        segments written.
+        """
+        chunk_id = 1
+        combined_chunks_size = 0
+        while True:
+            chunk_size = self.large_object_chunk_size
+            if image_size == 0:
+                content_length = None
+            else:
+                left = image_size - combined_chunks_size
+                if left == 0:
+                    break
+                if chunk_size > left:
+                    chunk_size = left
+                content_length = chunk_size
+
+            chunk_name = "%s-%05d" % (obj_name, chunk_id)
+            reader = ChunkReader(image_file, checksum, chunk_size)
+            chunk_etag = swift_conn.put_object(
+                self.container, chunk_name, reader,
+                content_length=content_length)
+            bytes_read = reader.bytes_read
+            logger.debug(_("Wrote chunk %(chunk_id)d/"
+                           "%(total_chunks)s of length %(bytes_read)d "
+                           "to Swift returning MD5 of content: "
+                           "%(chunk_etag)s")
+                         % locals())
+
+            if bytes_read == 0:
+                # Delete the last chunk, because it's of zero size.
+                # This will happen if image_size == 0.
+                logger.debug(_("Deleting final zero-length chunk"))
+                swift_conn.delete_object(self.container, chunk_name)
+                break
+
+            chunk_id += 1
+            combined_chunks_size += bytes_read
+        return combined_chunks_size
+
+    def _add_segments_concurrently(self, swift_conn, obj_name, image_file,
+                                   image_size, checksum, total_chunks):
+        """
+        Writes the image data into Swift as segments of a large object,
+        with up to ``swift_store_upload_concurrency`` segments being
+        uploaded at once, and returns the combined size of the segments
+        written.
+
+        The image data is read in order, so that `checksum` covers the
+        whole image, into a temporary buffer per segment, from which a
+        failed upload is retried. The uploads are retried here rather than
+        by the Swift client library, which cannot rewind the segment.
+        """
+        # Let the connections for the segments use the token of this one
+        CONNECTION_POOL.save_auth(swift_conn)
+        uploader = SegmentPool(
+                lambda: self._get_swift_connection(
+                        auth_url=self.full_auth_address, user=self.user,
+                        key=self.key, retries=0),
+                self._release_swift_connection,
+                self.container, self.upload_concurrency,
+                self.segment_retries)
+        chunk_id = 1
+        combined_chunks_size = 0
+        while uploader.error is None:
+            chunk_size = self.large_object_chunk_size
+            if image_size > 0:
+                chunk_size = min(chunk_size,
+                                 image_size - combined_chunks_size)
+                if chunk_size == 0:
+                    break
+
+            segment = tempfile.TemporaryFile()
+            reader = ChunkReader(image_file, checksum, chunk_size)
+            while True:
+                buf = reader.read(self.CHUNKSIZE)
+                if not buf:
+                    break
+                segment.write(buf)
+            bytes_read = reader.bytes_read
+            if bytes_read == 0:
+                # The end of image data of an unknown size
+                segment.close()
+                break
+
+            chunk_name = "%s-%05d" % (obj_name, chunk_id)
+            logger.debug(_("Queueing chunk %(chunk_id)d/"
+                           "%(total_chunks)s of length %(bytes_read)d "
+                           "for upload to Swift") % locals())
+            uploader.add(chunk_name, segment, bytes_read)
+            chunk_id += 1
+            combined_chunks_size += bytes_read
+        uploader.wait()
+        return combined_chunks_size
+
+    def _delete_segments(self, swift_conn, loc, container, prefix):
+        """
+        Deletes the segments of a large object, with up to
+        ``swift_store_delete_concurrency`` segments being deleted at once.
+
+        Deletion starts with the first page of the segment listing.
+        """
+        pool = SegmentPool(
+                lambda: self._get_swift_connection(
+                        auth_url=loc.swift_auth_url, user=loc.user,
+                        key=loc.key, retries=0),
+                self._release_swift_connection,
+                container, self.delete_concurrency, self.segment_retries)
+        # Let the connections for the segments use the token of this one
+        CONNECTION_POOL.save_auth(swift_conn)
+        for segment in self._list_segments(swift_conn, loc, container,
+                                           prefix):
+            if pool.error is not None:
+                break
+            pool.delete(segment['name'])
+        pool.wait()
+
     def delete(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
@@ -478,7 +721,7 @@ class Store(glance.store.base.Store):
         :raises NotFound if image does not exist
         """
         loc = location.store_location
-        swift_conn = self._make_swift_connection(
+        swift_conn = self._get_swift_connection(
             auth_url=loc.swift_auth_url, user=loc.user, key=loc.key)
 
         try:
@@ -496,18 +739,14 @@ class Store(glance.store.base.Store):
             if manifest:
                 # Delete all the chunks before the object manifest itself
                 obj_container, obj_prefix = manifest.split('/', 1)
-                for segment in swift_conn.get_container(obj_container,
-                                                        prefix=obj_prefix)[1]:
-                    # TODO(jaypipes): This would be an easy area to parallelize
-                    # since we're simply sending off parallelizable requests
-                    # to Swift to delete stuff. It's not like we're going to
-                    # be hogging up network or file I/O here...
-                    swift_conn.delete_object(obj_container, segment['name'])
+                self._delete_segments(swift_conn, loc, obj_container,
+                                      obj_prefix)
 
-            else:
-                swift_conn.delete_object(loc.container, loc.obj)
+            swift_conn.delete_object(loc.container, loc.obj)
+            self._release_swift_connection(swift_conn)
 
         except swift_client.ClientException, e:
+            self._release_swift_connection(swift_conn)
             if e.http_status == httplib.NOT_FOUND:
                 uri = location.get_store_uri()
                 raise exception.NotFound(_("Swift could not find image at "
@@ -533,6 +772,190 @@ class ChunkReader(object):
         return result
 
 
+class ConnectionPool(object):
+
+    """
+    Pool of authenticated Swift connections shared by the stores of a
+    process, keyed by auth URL and credentials.
+
+    Reusing a connection reuses both its auth token and its keep-alive
+    socket to the storage URL. The latest token seen for each key is
+    also remembered, so that new connections skip authentication and
+    idle connections pick up a token another connection renewed. The
+    Swift client library authenticates again, once, when a request
+    fails with 401 Unauthorized, which is how an expired token shows.
+    """
+
+    def __init__(self):
+        self.idle = {}
+        self.auth = {}
+
+    def get(self, make_connection, auth_url, user, key, retries):
+        """
+        Returns an idle connection for the supplied credentials, or one
+        made by calling `make_connection` if none are idle.
+        """
+        pool_key = (auth_url, user, key)
+        storage_url, token = self.auth.get(pool_key, (None, None))
+        idle = self.idle.get(pool_key)
+        if idle:
+            swift_conn = idle.pop()
+            if token is not None and swift_conn.token != token:
+                swift_conn.url, swift_conn.token = storage_url, token
+            swift_conn.retries = retries
+            return swift_conn
+        return make_connection(auth_url, user, key, retries=retries,
+                               preauthurl=storage_url, preauthtoken=token)
+
+    def put(self, swift_conn, max_idle):
+        """
+        Takes back a connection, keeping it for reuse unless `max_idle`
+        connections for its credentials are already idle.
+        """
+        self.save_auth(swift_conn)
+        idle = self.idle.setdefault(self._get_key(swift_conn), [])
+        if len(idle) < max_idle and swift_conn not in idle:
+            idle.append(swift_conn)
+
+    def save_auth(self, swift_conn):
+        """
+        Remembers the auth token of a connection, for the connections
+        made or reused later with the same credentials.
+        """
+        if swift_conn.token:
+            self.auth[self._get_key(swift_conn)] = (swift_conn.url,
+                                                    swift_conn.token)
+
+    def clear(self):
+        """Forgets all connections and auth tokens."""
+        self.idle.clear()
+        self.auth.clear()
+
+    def _get_key(self, swift_conn):
+        return (swift_conn.authurl, swift_conn.user, swift_conn.key)
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
+class SegmentPool(object):
+
+    """
+    Uploads or deletes the segments of a large object in Swift, several
+    at a time, each over its own connection, retrying failed requests.
+
+    Segments to upload are handed over in temporary files, which are
+    rewound to retry a failed upload and closed once the segment is
+    uploaded. Handing over a segment blocks while the maximum number of
+    segments are in flight, which bounds the number of segments buffered.
+    """
+
+    def __init__(self, get_connection, release_connection, container,
+                 concurrency, retries):
+        """
+        :param get_connection: Callable returning a Swift connection
+        :param release_connection: Callable taking back a Swift connection
+        :param container: Name of the container holding the segments
+        :param concurrency: Maximum number of segments in flight at once
+        :param retries: Number of times a failed request is retried
+        """
+        self.get_connection = get_connection
+        self.release_connection = release_connection
+        self.container = container
+        self.retries = retries
+        self.pool = eventlet.GreenPool(concurrency)
+        self.connections = []
+        self.error = None
+
+    def add(self, name, segment, length):
+        """
+        Starts uploading the supplied segment, of `length` bytes, as the
+        object `name`, once fewer than the maximum number are in flight.
+        """
+        self.pool.spawn_n(self._upload, name, segment, length)
+
+    def delete(self, name):
+        """
+        Starts deleting the segment `name`, once fewer than the maximum
+        number are in flight. A segment that is already gone is taken
+        to be deleted.
+        """
+        self.pool.spawn_n(self._run, _("deletion"), self._delete_segment,
+                          name)
+
+    def wait(self):
+        """
+        Waits for all the segments in flight, and raises the first error
+        a segment failed with, if any.
+        """
+        self.pool.waitall()
+        while self.connections:
+            self.release_connection(self.connections.pop())
+        if self.error is not None:
+            raise self.error
+
+    def _upload(self, name, segment, length):
+        try:
+            self._run(_("upload"), self._put_segment, name, segment, length)
+        finally:
+            segment.close()
+
+    def _run(self, action, func, name, *args):
+        try:
+            if self.error is not None:
+                return
+            if self.connections:
+                swift_conn = self.connections.pop()
+            else:
+                swift_conn = self.get_connection()
+            attempt = 0
+            reauthenticated = False
+            while True:
+                try:
+                    func(swift_conn, name, *args)
+                    self.connections.append(swift_conn)
+                    return
+                except swift_client.ClientException, e:
+                    if (e.http_status == httplib.UNAUTHORIZED and
+                            not reauthenticated):
+                        # The token has expired, so authenticate again
+                        swift_conn.url = swift_conn.token = None
+                        reauthenticated = True
+                        continue
+                    if e.http_status == httplib.CONFLICT or \
+                            attempt >= self.retries:
+                        self.connections.append(swift_conn)
+                        raise
+                except (socket.error, httplib.HTTPException), e:
+                    # The proxy may have closed the keep-alive socket of a
+                    # connection that sat idle, so retry over a new socket
+                    swift_conn.http_conn = None
+                    if attempt >= self.retries:
+                        self.connections.append(swift_conn)
+                        raise
+                attempt += 1
+                logger.warn(_("Retrying %(action)s of chunk %(name)s in "
+                              "Swift, which failed with: %(e)s") % locals())
+        except Exception, e:
+            if self.error is None:
+                self.error = e
+
+    def _put_segment(self, swift_conn, name, segment, length):
+        segment.seek(0)
+        etag = swift_conn.put_object(self.container, name, segment,
+                                     content_length=length)
+        logger.debug(_("Wrote chunk %(name)s of length %(length)d "
+                       "to Swift returning MD5 of content: "
+                       "%(etag)s") % locals())
+
+    def _delete_segment(self, swift_conn, name):
+        try:
+            swift_conn.delete_object(self.container, name)
+        except swift_client.ClientException, e:
+            if e.http_status != httplib.NOT_FOUND:
+                raise
+
+
 def create_container_if_missing(container, swift_conn, conf):
     """
     Creates a missing container in Swift if the
@@ -0,0 +1,116 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import StringIO
+import unittest
+
+from glance.common import byteranges
+
+
+class TestParseRangeHeader(unittest.TestCase):
+
+    def test_single_ranges(self):
+        parse = byteranges.parse_range_header
+        self.assertEqual([(0, 10)], parse('bytes=0-9', 100))
+        self.assertEqual([(90, 100)], parse('bytes=90-', 100))
+        self.assertEqual([(90, 100)], parse('bytes=-10', 100))
+        self.assertEqual([(0, 100)], parse('bytes=-1000', 100))
+        self.assertEqual([(50, 100)], parse('bytes=50-1000', 100))
+        self.assertEqual([(5, 6)], parse('Bytes = 5-5', 100))
+
+    def test_multiple_ranges_sorted_and_merged(self):
+        parse = byteranges.parse_range_header
+        self.assertEqual([(0, 10), (20, 30)],
+                         parse('bytes=20-29,0-9', 100))
+        self.assertEqual([(0, 30)], parse('bytes=0-9,10-19,15-29', 100))
+        self.assertEqual([(0, 5), (90, 100)],
+                         parse('bytes=0-4, -10, 95-', 100))
+
+    def test_invalid_headers_ignored(self):
+        parse = byteranges.parse_range_header
+        for header in ('0-9', 'items=0-9', 'bytes=', 'bytes=a-b',
+                       'bytes=9-0', 'bytes=-', 'bytes=0-9,x'):
+            self.assertEqual(None, parse(header, 100), header)
+
+    def test_too_many_ranges_ignored(self):
+        specs = ','.join('%d-%d' % (i * 2, i * 2)
+                         for i in xrange(byteranges.MAX_RANGES + 1))
+        self.assertEqual(None,
+                         byteranges.parse_range_header('bytes=' + specs,
+                                                       1000))
+
+    def test_unsatisfiable(self):
+        parse = byteranges.parse_range_header
+        self.assertEqual([], parse('bytes=100-', 100))
+        self.assertEqual([], parse('bytes=-0', 100))
+        self.assertEqual([(0, 1)], parse('bytes=100-,0-0', 100))
+
+
+class TestRangedResponse(unittest.TestCase):
+
+    data = ''.join(chr(ord('a') + i % 26) for i in xrange(100))
+
+    def chunks(self, size=7):
+        for offset in xrange(0, len(self.data), size):
+            yield self.data[offset:offset + size]
+
+    def test_iter_ranges_seek_and_skip_agree(self):
+        ranges = [(0, 1), (3, 17), (20, 21), (21, 22), (50, 100)]
+        expected = [self.data[start:stop] for start, stop in ranges]
+        for source in (StringIO.StringIO(self.data), self.chunks(),
+                       self.chunks(1), self.chunks(100)):
+            got = {}
+            for start, stop, chunk in byteranges.iter_ranges(source, ranges,
+                                                             chunk_size=4):
+                got[start] = got.get(start, '') + chunk
+            self.assertEqual(expected,
+                             [got[start] for start, stop in ranges])
+
+    def test_skip_ahead_stops_reading(self):
+        source = self.chunks(10)
+        list(byteranges.iter_ranges(source, [(5, 15)]))
+        self.assertEqual(self.data[20:30], source.next())
+
+    def test_single_range(self):
+        ranged = byteranges.RangedResponse([(10, 20)], 100, 'text/plain')
+        self.assertEqual({'Content-Type': 'text/plain',
+                          'Content-Range': 'bytes 10-19/100'},
+                         ranged.headers)
+        body = ''.join(ranged.iter_body(self.chunks()))
+        self.assertEqual(self.data[10:20], body)
+        self.assertEqual(len(body), ranged.content_length)
+
+    def test_multiple_ranges(self):
+        ranged = byteranges.RangedResponse([(0, 2), (98, 100)], 100,
+                                           'text/plain')
+        boundary = ranged.boundary
+        self.assertEqual('multipart/byteranges; boundary=%s' % boundary,
+                         ranged.headers['Content-Type'])
+        fp = StringIO.StringIO(self.data)
+        body = ''.join(ranged.iter_body(fp))
+        self.assertEqual('--%(b)s\r\n'
+                         'Content-Type: text/plain\r\n'
+                         'Content-Range: bytes 0-1/100\r\n\r\n'
+                         'ab\r\n'
+                         '--%(b)s\r\n'
+                         'Content-Type: text/plain\r\n'
+                         'Content-Range: bytes 98-99/100\r\n\r\n'
+                         'uv\r\n'
+                         '--%(b)s--\r\n' % {'b': boundary}, body)
+        self.assertEqual(len(body), ranged.content_length)
+        self.assertTrue(fp.closed)
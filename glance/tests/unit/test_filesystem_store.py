@@ -20,8 +20,10 @@
 import errno
 import StringIO
 import hashlib
+import os
 
 from glance.common import exception
+from glance.common import fileutils
 from glance.common import utils
 from glance.store.location import get_location_from_uri
 from glance.store.filesystem import Store, ChunkedFile
@@ -70,6 +72,23 @@ class TestStore(base.IsolatedUnitTest):
         self.assertEqual(expected_data, data)
         self.assertEqual(expected_num_chunks, num_chunks)
 
+    def test_get_seek(self):
+        """Test reading a retrieved image at arbitrary offsets"""
+        image_id = utils.generate_uuid()
+        file_contents = "chunk00000remainder"
+        image_file = StringIO.StringIO(file_contents)
+        self.store.add(image_id, image_file, len(file_contents))
+
+        uri = "file:///%s/%s" % (self.test_dir, image_id)
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc)
+
+        image_file.seek(10)
+        self.assertEqual("rem", image_file.read(3))
+        image_file.seek(0)
+        self.assertEqual("chunk", image_file.read(5))
+        image_file.close()
+
     def test_get_non_existing(self):
         """
         Test that trying to retrieve a file that doesn't exist
@@ -164,6 +183,25 @@ class TestStore(base.IsolatedUnitTest):
         """
         self._do_test_add_failure(errno.EFBIG, exception.StorageFull)
 
+    def test_add_preallocation_fails(self):
+        """
+        Tests that adding an image too big for the free space left is
+        refused before any of it is read, and leaves no file behind
+        """
+        image_id = utils.generate_uuid()
+        image_file = StringIO.StringIO("*" * 1024)
+
+        def fake_preallocate(fd, size):
+            raise exception.StorageFull()
+
+        self.stubs.Set(fileutils, 'preallocate', fake_preallocate)
+        self.assertRaises(exception.StorageFull,
+                          self.store.add,
+                          image_id, image_file, 1024)
+        self.assertEqual(0, image_file.tell())
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir,
+                                                     image_id)))
+
     def test_add_storage_write_denied(self):
         """
         Tests that adding an image with insufficient filestore permissions
@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests for the image file writing helpers"""
+
+import errno
+import os
+import tempfile
+import unittest
+
+import stubout
+
+from glance.common import exception
+from glance.common import fileutils
+
+
+class FakeStatvfs(object):
+
+    def __init__(self, free_blocks, block_size=4096):
+        self.f_bavail = free_blocks
+        self.f_frsize = block_size
+
+
+class TestPreallocate(unittest.TestCase):
+
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.image_file = tempfile.TemporaryFile()
+        self.fd = self.image_file.fileno()
+        self.errno = 0
+        self.allocated = []
+
+        def fake_fallocate(fd, mode, offset, length):
+            self.allocated.append((mode, offset, length))
+            return -1 if self.errno else 0
+
+        self.stubs.Set(fileutils, '_fallocate', fake_fallocate)
+        self.stubs.Set(fileutils.ctypes, 'get_errno', lambda: self.errno)
+        self.stubs.Set(fileutils.os, 'fstatvfs',
+                       lambda fd: FakeStatvfs(free_blocks=10))
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+        self.image_file.close()
+
+    def test_preallocate(self):
+        fileutils.preallocate(self.fd, 1024 * 1024)
+        self.assertEqual([(fileutils.FALLOC_FL_KEEP_SIZE, 0, 1024 * 1024)],
+                         self.allocated)
+
+    def test_unknown_size(self):
+        fileutils.preallocate(self.fd, None)
+        fileutils.preallocate(self.fd, 0)
+        self.assertEqual([], self.allocated)
+
+    def test_no_space(self):
+        self.errno = errno.ENOSPC
+        self.assertRaises(exception.StorageFull,
+                          fileutils.preallocate, self.fd, 1024 * 1024)
+
+    def test_unsupported_checks_free_space(self):
+        """
+        Where the file system cannot preallocate, a file larger than the
+        free space is still refused
+        """
+        self.errno = errno.EOPNOTSUPP
+        fileutils.preallocate(self.fd, 10 * 4096)
+        self.assertRaises(exception.StorageFull,
+                          fileutils.preallocate, self.fd, 10 * 4096 + 1)
+
+    def test_no_fallocate_checks_free_space(self):
+        self.stubs.Set(fileutils, '_fallocate', None)
+        fileutils.preallocate(self.fd, 10 * 4096)
+        self.assertRaises(exception.StorageFull,
+                          fileutils.preallocate, self.fd, 10 * 4096 + 1)
+
+    def test_keeps_size(self):
+        """Preallocating does not change the size of the file"""
+        self.stubs.UnsetAll()
+        fileutils.preallocate(self.fd, 4096)
+        self.assertEqual(0, os.fstat(self.fd).st_size)
+
+
+class TestDropBehind(unittest.TestCase):
+
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.calls = []
+
+        def fake_fadvise(fd, offset, length, advice):
+            self.calls.append(('fadvise', offset, length, advice))
+
+        def fake_sync_file_range(fd, offset, length, flags):
+            self.calls.append(('sync', offset, length))
+
+        self.stubs.Set(fileutils, 'fadvise', fake_fadvise)
+        self.stubs.Set(fileutils, '_sync_file_range', fake_sync_file_range)
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_drop_behind(self):
+        drop_behind = fileutils.DropBehind(3, window=10)
+        self.assertEqual([('fadvise', 0, 0, fileutils.POSIX_FADV_SEQUENTIAL)],
+                         self.calls)
+        self.calls = []
+
+        drop_behind.wrote(6)
+        self.assertEqual([], self.calls)
+
+        # The first window is written out, but stays cached
+        drop_behind.wrote(6)
+        self.assertEqual([('sync', 0, 10)], self.calls)
+        self.calls = []
+
+        # Once the next window is written, the first one is dropped
+        drop_behind.wrote(8)
+        self.assertEqual([('fadvise', 0, 10, fileutils.POSIX_FADV_DONTNEED),
+                          ('sync', 10, 10)], self.calls)
+        self.calls = []
+
+        drop_behind.wrote(25)
+        self.assertEqual([('fadvise', 10, 10, fileutils.POSIX_FADV_DONTNEED),
+                          ('sync', 20, 10),
+                          ('fadvise', 20, 10, fileutils.POSIX_FADV_DONTNEED),
+                          ('sync', 30, 10)], self.calls)
@@ -15,17 +15,27 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
 from contextlib import contextmanager
+import hashlib
 import os
 import random
 import shutil
 import StringIO
 import unittest
 
+import eventlet
 import stubout
 
 from glance import image_cache
+from glance.common import exception
+from glance.common import fileutils
 from glance.common import utils
+from glance.image_cache import admission
+from glance.image_cache import coalesce
+from glance.image_cache.drivers import base as base_driver
+from glance.image_cache import inventory as inventory_module
+from glance.image_cache import writer
 from glance.openstack.common import cfg
 from glance.tests import utils as test_utils
 from glance.tests.utils import skip_if_disabled, xattr_writes_supported
@@ -183,6 +193,302 @@ class ImageCacheTestCase(object):
             self.assertTrue(self.cache.is_cached(x),
                             "Image %s was not cached!" % x)
 
+    @skip_if_disabled
+    def test_hits_are_buffered(self):
+        """
+        Test that hits are recorded in memory and written out in a batch
+        """
+        self._setup_fixture_file()
+
+        for x in xrange(3):
+            with self.cache.open_for_read(1) as cache_file:
+                cache_file.read()
+
+        pending_hits = self.cache.driver.pending_hits
+        self.assertEqual([1], pending_hits.keys())
+        self.assertEqual(3, pending_hits[1][0])
+
+        self.cache.flush_hits()
+        self.assertEqual({}, self.cache.driver.pending_hits)
+        self.assertEqual(3, self.cache.get_hit_count(1))
+
+    @skip_if_disabled
+    def test_hits_are_flushed_at_exit(self):
+        """
+        Test that buffered hits are written out when the process exits
+        """
+        self._setup_fixture_file()
+
+        with self.cache.open_for_read(1) as cache_file:
+            cache_file.read()
+
+        base_driver._flush_all_hits()
+        self.assertEqual({}, self.cache.driver.pending_hits)
+        self.assertEqual(1, self.cache.get_hit_count(1))
+
+    @skip_if_disabled
+    def test_hits_are_flushed_when_reporting(self):
+        """
+        Test that buffered hits are included in cache statistics
+        """
+        self._setup_fixture_file()
+
+        with self.cache.open_for_read(1) as cache_file:
+            cache_file.read()
+
+        self.assertEqual(1, self.cache.get_hit_count(1))
+        self.assertEqual(1, self.cache.get_cached_images()[0]['hits'])
+
+    @skip_if_disabled
+    def test_delete_discards_buffered_hits(self):
+        """
+        Test that deleting an image drops its buffered hits
+        """
+        self._setup_fixture_file()
+
+        with self.cache.open_for_read(1) as cache_file:
+            cache_file.read()
+        self.cache.delete_cached_image(1)
+
+        self.assertEqual({}, self.cache.driver.pending_hits)
+        self.assertEqual(0, self.cache.driver.num_pending_hits)
+
+    @skip_if_disabled
+    def test_cache_size_tracking(self):
+        """
+        Test that the cache size follows images being cached and deleted
+        """
+        for x in xrange(3):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+        self.assertEqual(3 * FIXTURE_LENGTH, self.cache.get_cache_size())
+
+        self.cache.delete_cached_image(0)
+        self.assertEqual(2 * FIXTURE_LENGTH, self.cache.get_cache_size())
+
+        self.cache.delete_all_cached_images()
+        self.assertEqual(0, self.cache.get_cache_size())
+
+    @skip_if_disabled
+    def test_cache_size_shared_between_processes(self):
+        """
+        Test that images cached through another cache instance on the same
+        directory, as another process would, are accounted for
+        """
+        self.assertEqual(0, self.cache.get_cache_size())
+
+        other_cache = image_cache.ImageCache(self.conf)
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(other_cache.cache_image_file(1, FIXTURE_FILE))
+
+        self.assertEqual(FIXTURE_LENGTH, self.cache.get_cache_size())
+
+    @skip_if_disabled
+    def test_sharded_layout(self):
+        """
+        Test that a sharded cache directory works like a flat one
+        """
+        self.conf.set_override('image_cache_dir_levels', 2)
+        self.cache = image_cache.ImageCache(self.conf)
+
+        for x in xrange(0, 5):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+        self.assertTrue(self.cache.queue_image(5))
+
+        path = self.cache.driver.get_image_filepath(0)
+        shards = os.path.relpath(path, self.cache_dir).split(os.sep)[:-1]
+        self.assertEqual(2, len(shards))
+        self.assertTrue(os.path.exists(path))
+
+        self.assertEqual(5 * FIXTURE_LENGTH, self.cache.get_cache_size())
+        self.assertEqual(['0', '1', '2', '3', '4'],
+                         [entry['image_id'] for entry
+                          in self.cache.get_cached_images()])
+        self.assertEqual(['5'], self.cache.get_queued_images())
+        self.assertEqual(5, self.cache.delete_all_cached_images())
+        self.assertEqual(0, self.cache.get_cache_size())
+
+    @skip_if_disabled
+    def test_checksum_verified_on_write(self):
+        """
+        Test that the checksum of image data is recorded as it is cached,
+        and that image data not matching the expected checksum is moved
+        to the invalid directory instead of being cached
+        """
+        checksum = hashlib.md5(FIXTURE_DATA).hexdigest()
+        self.assertTrue(self.cache.cache_image_iter(
+                1, iter([FIXTURE_DATA]), {'checksum': checksum}))
+        self.assertEqual(checksum, self.cache.driver.get_checksum(1))
+
+        self.assertRaises(exception.ImageChecksumMismatch,
+                          self.cache.cache_image_iter, 2,
+                          iter([FIXTURE_DATA[1:]]), {'checksum': checksum})
+        self.assertFalse(self.cache.is_cached(2))
+        invalid_path = self.cache.driver.get_image_filepath(2, 'invalid')
+        self.assertTrue(os.path.exists(invalid_path))
+
+    @skip_if_disabled
+    def test_write_refused_when_cache_disk_full(self):
+        """
+        Test that an image too big for the space left on the cache disk
+        is refused before any of it is written
+        """
+        stubs = stubout.StubOutForTesting()
+        stubs.Set(fileutils.os, 'fstatvfs',
+                  lambda fd: os.statvfs_result((4096, 4096, 1, 1, 1,
+                                                1, 1, 1, 0, 255)))
+        stubs.Set(fileutils, '_fallocate', None)
+        try:
+            self.assertRaises(exception.StorageFull,
+                              self.cache.cache_image_iter, 1,
+                              iter([FIXTURE_DATA]), {'size': 8192})
+        finally:
+            stubs.UnsetAll()
+        self.assertFalse(self.cache.is_cached(1))
+
+        self.assertTrue(self.cache.cache_image_iter(
+                1, iter([FIXTURE_DATA]), {'size': len(FIXTURE_DATA)}))
+        self.assertTrue(self.cache.is_cached(1))
+
+    @skip_if_disabled
+    def test_invalidate_cached_image(self):
+        """
+        Test that a corrupt image is taken out of the cache and kept in
+        the invalid directory
+        """
+        self._setup_fixture_file()
+        self.cache.invalidate_cached_image(1)
+
+        self.assertFalse(self.cache.is_cached(1))
+        self.assertEqual(0, self.cache.get_cache_size())
+        self.assertEqual([], self.cache.get_cached_images())
+        invalid_path = self.cache.driver.get_image_filepath(1, 'invalid')
+        self.assertTrue(os.path.exists(invalid_path))
+
+    @skip_if_disabled
+    def test_metadata_snapshots(self):
+        """
+        Test that metadata snapshots are stored with cached images and
+        removed along with them
+        """
+        self.conf.set_override('image_cache_metadata_ttl', 60)
+        self.cache = image_cache.ImageCache(self.conf)
+        self.assertEqual(None, self.cache.get_metadata_snapshot('0'))
+
+        for x in xrange(0, 3):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+            self.cache.save_metadata_snapshot(x, {'id': x, 'size': 1024})
+
+        image_meta, age = self.cache.get_metadata_snapshot('1')
+        self.assertEqual({'id': 1, 'size': 1024}, image_meta)
+        self.assertTrue(0 <= age < 60)
+
+        self.cache.delete_cached_image('0')
+        self.assertEqual(None, self.cache.get_metadata_snapshot('0'))
+
+        # Snapshots of images pruned from the cache go with the next clean
+        self.cache.driver.delete_cached_images(['1'])
+        self.cache.clean()
+        self.assertEqual(None, self.cache.get_metadata_snapshot('1'))
+        self.assertNotEqual(None, self.cache.get_metadata_snapshot('2'))
+
+        self.cache.delete_all_cached_images()
+        self.assertEqual(None, self.cache.get_metadata_snapshot('2'))
+
+    @skip_if_disabled
+    def test_layout_migration(self):
+        """
+        Test that changing the layout moves the cache files while the
+        cache is in use
+        """
+        for x in xrange(0, 5):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+        self.assertTrue(self.cache.queue_image(5))
+        flat_path = self.cache.driver.get_image_filepath(0)
+
+        self.conf.set_override('image_cache_dir_levels', 2)
+        self.cache = image_cache.ImageCache(self.conf)
+        self.assertTrue(self.cache.driver.migrating)
+
+        # Lookups move the files they need straight away...
+        self.assertTrue(self.cache.is_cached(0))
+        self.assertFalse(os.path.exists(flat_path))
+        self.assertTrue(self.cache.is_queued(5))
+        self.assertEqual(5 * FIXTURE_LENGTH, self.cache.get_cache_size())
+
+        # ...and cleaning the cache moves the rest
+        self.cache.clean()
+        self.assertFalse(self.cache.driver.migrating)
+        for x in xrange(1, 5):
+            flat_path = os.path.join(self.cache_dir, str(x))
+            self.assertFalse(os.path.exists(flat_path))
+            self.assertTrue(os.path.exists(
+                    self.cache.driver.get_image_filepath(x)))
+        self.assertEqual(5 * FIXTURE_LENGTH, self.cache.get_cache_size())
+
+        other_cache = image_cache.ImageCache(self.conf)
+        self.assertFalse(other_cache.driver.migrating)
+
+        # Going back to the flat layout works the same way
+        self.conf.set_override('image_cache_dir_levels', 0)
+        self.cache = image_cache.ImageCache(self.conf)
+        self.assertTrue(self.cache.driver.migrating)
+        self.cache.clean()
+        for x in xrange(0, 5):
+            self.assertTrue(os.path.exists(os.path.join(self.cache_dir,
+                                                        str(x))))
+        self.assertEqual(['5'], self.cache.get_queued_images())
+
+    @skip_if_disabled
+    def test_prune_deletes_in_one_batch(self):
+        """
+        Test that pruning removes all the images it selects at once
+        """
+        for x in xrange(0, 10):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        batches = []
+        delete_cached_images = self.cache.driver.delete_cached_images
+
+        def fake_delete_cached_images(image_ids):
+            batches.append(image_ids)
+            delete_cached_images(image_ids)
+
+        self.cache.driver.delete_cached_images = fake_delete_cached_images
+        self.assertEqual((5, 5 * FIXTURE_LENGTH), self.cache.prune())
+        self.assertEqual(1, len(batches))
+        self.assertEqual(5 * FIXTURE_LENGTH, self.cache.get_cache_size())
+
+    @skip_if_disabled
+    def test_prune_with_lfu_policy(self):
+        """
+        Test that pruning removes the images the configured eviction
+        policy picks
+        """
+        for x in xrange(0, 10):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        # Images 0-4 are read most often, images 5-9 most recently
+        for x in range(0, 5) * 3 + range(5, 10):
+            with self.cache.open_for_read(x) as cache_file:
+                list(cache_file)
+
+        self.conf.set_override('image_cache_eviction_policy', 'lfu')
+        self.cache.init_policy()
+        self.assertEqual((5, 5 * FIXTURE_LENGTH), self.cache.prune())
+
+        for x in xrange(0, 5):
+            self.assertTrue(self.cache.is_cached(x),
+                            "Image %s was not cached!" % x)
+        for x in xrange(5, 10):
+            self.assertFalse(self.cache.is_cached(x),
+                             "Image %s was cached!" % x)
+
     @skip_if_disabled
     def test_queue(self):
         """
@@ -223,6 +529,79 @@ class ImageCacheTestCase(object):
         self.assertEqual(self.cache.get_queued_images(),
                          ['0', '1', '2'])
 
+    @skip_if_disabled
+    def test_queue_entries(self):
+        """
+        Test that queue entries record priority, repeated requests and
+        prefetch progress without changing the queue order
+        """
+        self.assertTrue(self.cache.queue_image(0))
+        self.assertTrue(self.cache.queue_image(1, priority=3))
+        self.assertFalse(self.cache.queue_image(0, priority=2))
+        self.assertFalse(self.cache.queue_image(1))
+
+        entries = self.cache.get_queue_entries()
+        self.assertEqual(['0', '1'], [e['image_id'] for e in entries])
+        self.assertEqual([2, 3], [e['priority'] for e in entries])
+        self.assertEqual([2, 2], [e['requests'] for e in entries])
+        self.assertEqual(['queued', 'queued'], [e['state'] for e in entries])
+
+        self.cache.update_queue_entry(0, state='fetching',
+                                      size=FIXTURE_LENGTH)
+        incomplete_path = self.cache.driver.get_image_filepath(0,
+                                                               'incomplete')
+        with open(incomplete_path, 'wb') as incomplete_file:
+            incomplete_file.write(FIXTURE_DATA[:10])
+
+        entry = self.cache.driver.get_queue_entry(0)
+        self.assertEqual('fetching', entry['state'])
+        self.assertEqual(FIXTURE_LENGTH, entry['size'])
+        self.assertEqual(10, entry['bytes_fetched'])
+        self.assertEqual(['0', '1'], self.cache.get_queued_images())
+
+    @skip_if_disabled
+    def test_inventory(self):
+        """
+        Test that the inventory follows images being added to and removed
+        from the cache, and returns just the changes since a generation
+        while they are still known
+        """
+        inventory = self.cache.get_inventory()
+        self.assertEqual([], inventory['images'])
+        start = inventory['generation']
+
+        for image_id in ('1', '2', '3'):
+            self.cache.cache_image_iter(image_id, iter([FIXTURE_DATA]))
+        inventory = self.cache.get_inventory()
+        self.assertEqual(['1', '2', '3'], inventory['images'])
+        self.assertEqual(start + 3, inventory['generation'])
+
+        self.cache.delete_cached_image('1')
+        self.cache.invalidate_cached_image('3')
+        self.cache.cache_image_iter('1', iter([FIXTURE_DATA]))
+        delta = self.cache.get_inventory(since=start + 3)
+        self.assertEqual(start + 6, delta['generation'])
+        self.assertEqual(['1'], delta['added'])
+        self.assertEqual(['3'], delta['removed'])
+        self.assertEqual(['1', '2'], self.cache.get_inventory()['images'])
+
+        bloom_filter = self.cache.get_inventory(
+                bloom_filter=True)['bloom_filter']
+        bloom = inventory_module.BloomFilter(bloom_filter['num_bits'],
+                                             bloom_filter['num_hashes'])
+        bloom.bits = bytearray(base64.b64decode(bloom_filter['bits']))
+        self.assertTrue('1' in bloom)
+        self.assertTrue('2' in bloom)
+
+        # Once the changes are trimmed, the whole inventory is returned
+        self.cache.driver.trim_changes(1)
+        inventory = self.cache.get_inventory(since=start + 3)
+        self.assertEqual(['1', '2'], inventory['images'])
+        self.assertEqual(start + 6, inventory['generation'])
+        self.assertEqual({'generation': start + 6, 'since': start + 6,
+                          'added': [], 'removed': []},
+                         self.cache.get_inventory(since=start + 6))
+
 
 class TestImageCacheXattr(unittest.TestCase,
                           ImageCacheTestCase):
@@ -368,3 +747,451 @@ class TestImageCacheNoDep(unittest.TestCase):
 
         caching_iter = cache.get_caching_iter('dummy_id', iter(data))
         self.assertEqual(list(caching_iter), data)
+
+
+class TestImageCacheWriter(unittest.TestCase):
+
+    """Tests writing tee'd images into the cache in the background"""
+
+    def setUp(self):
+        self.cache_dir = os.path.join("/", "tmp", "test.cache.%d" %
+                                      random.randint(0, 1000000))
+        self.conf = test_utils.TestConfigOpts({
+                'image_cache_dir': self.cache_dir,
+                'image_cache_driver': 'sqlite',
+                'image_cache_write_buffer_size': 8})
+        self.cache = image_cache.ImageCache(self.conf)
+        self.stubs = stubout.StubOutForTesting()
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def test_write_completes_after_response(self):
+        data = ['abc', 'def', 'gh']
+        caching_iter = self.cache.get_caching_iter('one', iter(data))
+        self.assertEqual(data, list(caching_iter))
+        self.cache.writers.wait()
+
+        self.assertTrue(self.cache.is_cached('one'))
+        with self.cache.open_for_read('one') as cache_file:
+            self.assertEqual('abcdefgh', cache_file.read())
+        stats = self.cache.get_stats()['writes']
+        self.assertEqual(1, stats['started'])
+        self.assertEqual(1, stats['completed'])
+        self.assertEqual(0, stats['active'])
+
+    def test_write_abandoned_when_buffer_overflows(self):
+        def slow_write(func, *args):
+            eventlet.sleep(0.01)
+            return func(*args)
+
+        self.stubs.Set(writer.tpool, 'execute', slow_write)
+        data = ['abcd', 'efgh', 'ijkl', 'mnop']
+        caching_iter = self.cache.get_caching_iter('one', iter(data))
+        self.assertEqual(data, list(caching_iter))
+        self.cache.writers.wait()
+
+        self.assertFalse(self.cache.is_cached('one'))
+        stats = self.cache.get_stats()['writes']
+        self.assertEqual(1, stats['abandoned'])
+        self.assertEqual(0, stats['completed'])
+
+    def test_write_incomplete_when_download_stops(self):
+        caching_iter = self.cache.get_caching_iter('one', iter(['ab', 'cd']))
+        caching_iter.next()
+        caching_iter.close()
+        self.cache.writers.wait()
+
+        self.assertFalse(self.cache.is_cached('one'))
+        self.assertEqual(1, self.cache.get_stats()['writes']['incomplete'])
+
+    def test_write_with_bad_checksum_not_cached(self):
+        image_meta = {'checksum': hashlib.md5('abcd').hexdigest()}
+        caching_iter = self.cache.get_caching_iter('one', iter(['ab', 'cx']),
+                                                   image_meta)
+        self.assertEqual(['ab', 'cx'], list(caching_iter))
+        self.cache.writers.wait()
+
+        self.assertFalse(self.cache.is_cached('one'))
+        self.assertEqual(1, self.cache.get_stats()['writes']['corrupt'])
+
+
+class TestImageCacheSpace(unittest.TestCase):
+
+    """Tests watermark pruning and space reservation in the API server"""
+
+    def setUp(self):
+        self.cache_dir = os.path.join("/", "tmp", "test.cache.%d" %
+                                      random.randint(0, 1000000))
+        self.conf = test_utils.TestConfigOpts({
+                'image_cache_dir': self.cache_dir,
+                'image_cache_driver': 'sqlite',
+                'image_cache_max_size': 100,
+                'image_cache_auto_prune': True,
+                'image_cache_high_watermark': 80,
+                'image_cache_low_watermark': 50,
+                'image_cache_prune_rate_limit': 0,
+                'image_cache_hit_flush_count': 1})
+        self.cache = image_cache.ImageCache(self.conf)
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def _cache_image(self, image_id, size):
+        return self.cache.cache_image_iter(image_id, iter(['x' * size]),
+                                           {'size': size})
+
+    def _wait_for_prune(self):
+        while self.cache.space.pruning:
+            eventlet.sleep(0)
+
+    def test_pruned_past_high_watermark(self):
+        for image_id in ('one', 'two', 'three'):
+            self._cache_image(image_id, 25)
+        self._wait_for_prune()
+        self.assertEqual(75, self.cache.get_cache_size())
+        self.assertEqual(0, self.cache.get_stats()['space']['prunes'])
+
+        self._cache_image('four', 25)
+        self._wait_for_prune()
+        self.assertTrue(self.cache.get_cache_size() <= 50)
+        stats = self.cache.get_stats()['space']
+        self.assertEqual(1, stats['prunes'])
+        self.assertEqual(2, stats['pruned_images'])
+        self.assertEqual(50, stats['pruned_bytes'])
+        self.assertEqual(0, stats['reserved'])
+
+    def test_pruning_keeps_image_just_cached(self):
+        """
+        Test that an image just committed to the cache counts as recently
+        used, so the prune it triggers removes older images instead
+        """
+        self._cache_image('old', 40)
+        with self.cache.open_for_read('old') as cache_file:
+            cache_file.read()
+
+        self._cache_image('new', 45)
+        self._wait_for_prune()
+        self.assertTrue(self.cache.is_cached('new'))
+        self.assertFalse(self.cache.is_cached('old'))
+
+    def test_image_without_room_not_cached(self):
+        self.cache.space.high_watermark = 100
+        for image_id in ('one', 'two', 'three'):
+            self._cache_image(image_id, 25)
+
+        data = ['x' * 15, 'x' * 15]
+        caching_iter = self.cache.get_caching_iter('four', iter(data),
+                                                   {'size': 30})
+        self.assertEqual(data, list(caching_iter))
+        self.cache.writers.wait()
+        self.assertFalse(self.cache.is_cached('four'))
+        self._wait_for_prune()
+        self.assertTrue(self.cache.get_cache_size() <= 50)
+
+        # An image larger than the whole cache prunes nothing
+        self.assertRaises(exception.StorageFull, self._cache_image,
+                          'five', 101)
+        self._wait_for_prune()
+        stats = self.cache.get_stats()['space']
+        self.assertEqual(2, stats['refused'])
+        self.assertEqual(1, stats['prunes'])
+
+    def test_refused_image_cached_next_time(self):
+        """
+        Test that refusing an image prunes the cache to make room for it,
+        even when the cache is between its watermarks
+        """
+        self.cache.space.high_watermark = 95
+        self.cache.space.low_watermark = 85
+        self._cache_image('one', 45)
+        self._cache_image('two', 45)
+        self._wait_for_prune()
+        self.assertEqual(0, self.cache.get_stats()['space']['prunes'])
+
+        self.assertRaises(exception.StorageFull, self._cache_image,
+                          'three', 20)
+        self._wait_for_prune()
+        self.assertTrue(self._cache_image('three', 20))
+        self.assertTrue(self.cache.is_cached('three'))
+        self.assertTrue(self.cache.get_cache_size() <= 100)
+        stats = self.cache.get_stats()['space']
+        self.assertEqual(1, stats['refused'])
+        self.assertEqual(1, stats['prunes'])
+        self.assertEqual(1, stats['pruned_images'])
+
+    def test_writes_in_progress_hold_space(self):
+        caching_iter = self.cache.get_caching_iter('one', iter(['x' * 60]),
+                                                   {'size': 60})
+        caching_iter.next()
+        self.assertEqual(60, self.cache.get_stats()['space']['reserved'])
+        self.assertRaises(exception.StorageFull, self._cache_image,
+                          'two', 50)
+
+        self.assertRaises(StopIteration, caching_iter.next)
+        self.cache.writers.wait()
+        self.assertTrue(self.cache.is_cached('one'))
+        self.assertEqual(0, self.cache.get_stats()['space']['reserved'])
+
+    def test_disabled_by_default(self):
+        conf = test_utils.TestConfigOpts({
+                'image_cache_dir': self.cache_dir,
+                'image_cache_driver': 'sqlite',
+                'image_cache_max_size': 10})
+        cache = image_cache.ImageCache(conf)
+        self.assertTrue(cache.cache_image_iter('one', iter(['x' * 20]),
+                                               {'size': 20}))
+        self.assertFalse(cache.space.pruning)
+        self.assertEqual(20, cache.get_cache_size())
+
+
+class TestImageCacheEvictionPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = os.path.join("/", "tmp", "test.cache.%d" %
+                                      random.randint(0, 1000000))
+        utils.safe_mkdirs(self.cache_dir)
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def _make_cache(self, policy):
+        conf = test_utils.TestConfigOpts({
+                'image_cache_dir': self.cache_dir,
+                'image_cache_driver': 'sqlite',
+                'image_cache_eviction_policy': policy})
+        return image_cache.ImageCache(conf)
+
+    def test_configured_policy_is_loaded(self):
+        cache = self._make_cache('arc')
+        self.assertEqual('glance.image_cache.policies.arc',
+                         cache.policy.__module__)
+
+    def test_unknown_policy_defaults_to_lru(self):
+        cache = self._make_cache('nonexistent')
+        self.assertEqual('glance.image_cache.policies.lru',
+                         cache.policy.__module__)
+
+
+class TestImageCacheAdmission(unittest.TestCase):
+
+    """Tests frequency-based admission of images into the cache"""
+
+    def setUp(self):
+        self.cache_dir = os.path.join("/", "tmp", "test.cache.%d" %
+                                      random.randint(0, 1000000))
+        self.conf = test_utils.TestConfigOpts({
+                'image_cache_dir': self.cache_dir,
+                'image_cache_driver': 'sqlite',
+                'image_cache_admission_threshold': 3,
+                'image_cache_admission_window': 100})
+        self.cache = image_cache.ImageCache(self.conf)
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def _download(self, image_id):
+        caching_iter = self.cache.get_caching_iter(image_id,
+                                                   iter([FIXTURE_DATA]))
+        self.assertEqual(FIXTURE_DATA, ''.join(caching_iter))
+        self.cache.writers.wait()
+
+    def test_image_cached_after_threshold(self):
+        self._download('one')
+        self._download('one')
+        self.assertFalse(self.cache.is_cached('one'))
+        self._download('one')
+        self.assertTrue(self.cache.is_cached('one'))
+
+        stats = self.cache.get_stats()['admission']
+        self.assertEqual(3, stats['requests'])
+        self.assertEqual(1, stats['admitted'])
+        self.assertEqual(2, stats['rejected'])
+        self.assertEqual(3, stats['threshold'])
+
+    def test_queued_image_always_admitted(self):
+        self.assertTrue(self.cache.queue_image('queued'))
+        self._download('queued')
+        self.assertTrue(self.cache.is_cached('queued'))
+        stats = self.cache.get_stats()['admission']
+        self.assertEqual(1, stats['admitted_queued'])
+
+    def test_counts_decay_each_window(self):
+        admission_filter = self.cache.admission
+        self.assertFalse(admission_filter.admit('one'))
+        self.assertFalse(admission_filter.admit('one'))
+        for x in xrange(100):
+            admission_filter.admit('other%d' % x)
+        self.assertFalse(admission_filter.admit('one'))
+        self.assertEqual(1, admission_filter.get_stats()['resets'])
+
+    def test_filter_shared_by_caches(self):
+        other_cache = image_cache.ImageCache(self.conf)
+        self.assertTrue(other_cache.admission is self.cache.admission)
+
+    def test_threshold_of_one_admits_everything(self):
+        admission_filter = admission.AdmissionFilter(cfg.ConfigOpts())
+        self.assertTrue(admission_filter.admit('one'))
+        self.assertEqual(1, admission_filter.get_stats()['admitted'])
+
+
+class TestCountMinSketch(unittest.TestCase):
+
+    def test_counts(self):
+        sketch = admission.CountMinSketch(64)
+        for x in xrange(5):
+            self.assertEqual(x + 1, sketch.add('one'))
+        sketch.add('two')
+        self.assertEqual(5, sketch.estimate('one'))
+        self.assertEqual(1, sketch.estimate('two'))
+        self.assertEqual(0, sketch.estimate('three'))
+
+    def test_counts_saturate(self):
+        sketch = admission.CountMinSketch(64)
+        for x in xrange(admission.MAX_COUNT + 5):
+            sketch.add('one')
+        self.assertEqual(admission.MAX_COUNT, sketch.estimate('one'))
+
+    def test_halve(self):
+        sketch = admission.CountMinSketch(64)
+        for x in xrange(5):
+            sketch.add('one')
+        sketch.halve()
+        self.assertEqual(2, sketch.estimate('one'))
+
+
+class TestImageCacheCoalescing(unittest.TestCase):
+
+    """Tests shared fetches of images into the cache"""
+
+    def setUp(self):
+        self.cache_dir = os.path.join("/", "tmp", "test.cache.%d" %
+                                      random.randint(0, 1000000))
+        self.conf = test_utils.TestConfigOpts({
+                'image_cache_dir': self.cache_dir,
+                'image_cache_driver': 'sqlite',
+                'image_cache_coalesce_fetches': True,
+                'image_cache_max_size': 1024 * 5,
+                'registry_host': '0.0.0.0',
+                'registry_port': 9191})
+        self.cache = image_cache.ImageCache(self.conf)
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def test_concurrent_requests_share_one_fetch(self):
+        data = ['a' * 10, 'b' * 10, 'c' * 10]
+        fetched = []
+
+        def backend_iter():
+            for chunk in data:
+                fetched.append(chunk)
+                yield chunk
+
+        first = self.cache.get_caching_iter('dummy_id', backend_iter())
+        self.assertTrue(self.cache.is_being_fetched('dummy_id'))
+        second = self.cache.get_caching_iter('dummy_id', backend_iter())
+        third = self.cache.join_fetch('dummy_id')
+
+        self.assertEqual(''.join(first), ''.join(data))
+        self.assertEqual(''.join(second), ''.join(data))
+        self.assertEqual(''.join(third), ''.join(data))
+        self.assertEqual(fetched, data)
+        self.assertFalse(self.cache.is_being_fetched('dummy_id'))
+        self.assertTrue(self.cache.is_cached('dummy_id'))
+
+    def test_reader_opens_file_committed_before_finish(self):
+        """
+        Test that a reader opening the image file after the writer has
+        moved it to its final location, but before the fetch is marked
+        finished, reads it from there
+        """
+        utils.safe_mkdirs(self.cache_dir)
+        final_path = os.path.join(self.cache_dir, 'dummy_id')
+        with open(final_path, 'wb') as cache_file:
+            cache_file.write('abc')
+        fetch = coalesce.SharedFetch(
+                'dummy_id',
+                os.path.join(self.cache_dir, 'incomplete', 'dummy_id'),
+                final_path)
+        fetch.notify(3)
+        reader = fetch.reader()
+        self.assertEqual('abc', reader.next())
+        fetch.finish()
+        self.assertEqual([], list(reader))
+
+    def test_reader_joining_after_commit(self):
+        fetch_iter = self.cache.get_caching_iter('dummy_id', iter(['abc']))
+        late_iter = self.cache.join_fetch('dummy_id')
+        self.assertEqual(''.join(fetch_iter), 'abc')
+        self.assertEqual(''.join(late_iter), 'abc')
+
+    def test_failed_fetch_fails_all_readers(self):
+
+        def backend_iter():
+            yield 'abc'
+            raise IOError
+
+        first = self.cache.get_caching_iter('dummy_id', backend_iter())
+        second = self.cache.join_fetch('dummy_id')
+
+        self.assertRaises(IOError, list, first)
+        self.assertRaises(IOError, list, second)
+        self.assertFalse(self.cache.is_being_fetched('dummy_id'))
+        self.assertFalse(self.cache.is_cached('dummy_id'))
+
+
+class TestSqliteConnectionPool(unittest.TestCase):
+
+    """Tests the sqlite cache driver's connection pooling"""
+
+    def setUp(self):
+        self.cache_dir = os.path.join("/", "tmp", "test.cache.%d" %
+                                      random.randint(0, 1000000))
+        self.conf = test_utils.TestConfigOpts({
+                'image_cache_dir': self.cache_dir,
+                'image_cache_driver': 'sqlite',
+                'image_cache_sqlite_pool_size': 1,
+                'image_cache_sqlite_busy_strategy': 'backoff',
+                'registry_host': '0.0.0.0',
+                'registry_port': 9191})
+        self.cache = image_cache.ImageCache(self.conf)
+        self.driver = self.cache.driver
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def test_connections_are_reused(self):
+        with self.driver.get_db() as db:
+            first = db
+        with self.driver.get_db() as db:
+            self.assertTrue(db is first)
+            self.assertEqual('backoff', db.busy_strategy)
+
+    def test_overflow_connections_are_closed(self):
+        with self.driver.get_db() as db1:
+            with self.driver.get_db() as db2:
+                self.assertFalse(db1 is db2)
+        self.assertEqual(1, len(self.driver.pool.idle))
+
+    def test_uncommitted_changes_are_rolled_back(self):
+        with self.driver.get_db() as db:
+            db.execute("""INSERT INTO cached_images (image_id)
+                       VALUES ('dummy_id')""")
+        with self.driver.get_db() as db:
+            cur = db.execute("""SELECT COUNT(*) FROM cached_images""")
+            self.assertEqual(0, cur.fetchone()[0])
+
+    def test_wal_files_are_not_cache_files(self):
+        self.assertTrue(self.cache.cache_image_file(
+                '1', StringIO.StringIO(FIXTURE_DATA)))
+        files = list(self.driver.get_cache_files(self.cache_dir))
+        self.assertEqual([os.path.join(self.cache_dir, '1')], files)
+        self.assertEqual(FIXTURE_LENGTH, self.cache.get_cache_size())
@@ -0,0 +1,136 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests sharing image caches between API servers"""
+
+import unittest
+
+import eventlet
+import eventlet.wsgi
+
+from glance.image_cache import peers
+from glance.tests import utils as test_utils
+
+
+class NullLog(object):
+
+    def write(self, data):
+        pass
+
+
+class TestHashRing(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ['image-%d' % i for i in xrange(3000)]
+
+    def _assign(self, ring):
+        return dict((key, ring.get_node(key)) for key in self.keys)
+
+    def test_keys_spread_over_nodes(self):
+        ring = peers.HashRing(['a:9292', 'b:9292', 'c:9292'])
+        owners = self._assign(ring).values()
+        for node in ring.nodes:
+            self.assertTrue(owners.count(node) > 600)
+
+    def test_removing_node_only_moves_its_keys(self):
+        before = self._assign(peers.HashRing(['a:9292', 'b:9292',
+                                              'c:9292']))
+        after = self._assign(peers.HashRing(['a:9292', 'c:9292']))
+        for key in self.keys:
+            if before[key] != 'b:9292':
+                self.assertEqual(before[key], after[key])
+
+    def test_empty_ring(self):
+        self.assertEqual(None, peers.HashRing([]).get_node('image'))
+
+
+class TestPeerCache(unittest.TestCase):
+
+    def _make_peers(self, **options):
+        conf = test_utils.TestConfigOpts(options)
+        return peers.PeerCache(conf)
+
+    def test_disabled_by_default(self):
+        peer_cache = self._make_peers()
+        self.assertFalse(peer_cache.enabled)
+        self.assertEqual(None, peer_cache.get_owner('image'))
+
+    def test_disabled_without_self(self):
+        peer_cache = self._make_peers(image_cache_peers='a:9292,b:9292')
+        self.assertFalse(peer_cache.enabled)
+
+    def test_own_images_have_no_owner(self):
+        peer_cache = self._make_peers(image_cache_peers='a:9292,b:9292',
+                                      image_cache_peer_self='a:9292')
+        ring = peers.HashRing(['a:9292', 'b:9292'])
+        for i in xrange(20):
+            image_id = 'image-%d' % i
+            if ring.get_node(image_id) == 'a:9292':
+                self.assertEqual(None, peer_cache.get_owner(image_id))
+            else:
+                self.assertEqual('b:9292', peer_cache.get_owner(image_id))
+
+
+class TestPeerFetch(unittest.TestCase):
+
+    """Tests fetching images from a peer listening on a local port"""
+
+    def setUp(self):
+        self.requests = []
+        self.status = '200 OK'
+        sock = eventlet.listen(('127.0.0.1', 0))
+        self.peer = '127.0.0.1:%d' % sock.getsockname()[1]
+        self.server = eventlet.spawn(eventlet.wsgi.server, sock, self.app,
+                                     log=NullLog())
+        # Let the server start, so it can be killed again
+        eventlet.sleep(0)
+        conf = test_utils.TestConfigOpts({
+                'image_cache_peers': self.peer + ',127.0.0.1:1',
+                'image_cache_peer_self': '127.0.0.1:1'})
+        self.peer_cache = peers.PeerCache(conf)
+
+    def tearDown(self):
+        self.server.kill()
+
+    def app(self, environ, start_response):
+        self.requests.append(environ)
+        start_response(self.status, [('Content-Length', '6'),
+                                     ('x-image-meta-name', 'fake')])
+        return ['abc', 'def']
+
+    def test_fetch(self):
+        status, headers, body = self.peer_cache.fetch(
+                self.peer, '/v1/images/image',
+                {'X-Auth-Token': 'token', 'Cookie': 'secret'})
+        self.assertEqual(200, status)
+        self.assertEqual('fake', dict(headers)['x-image-meta-name'])
+        self.assertEqual('abcdef', ''.join(body))
+
+        environ = self.requests[0]
+        self.assertEqual('/v1/images/image', environ['PATH_INFO'])
+        self.assertEqual('token', environ['HTTP_X_AUTH_TOKEN'])
+        self.assertEqual('127.0.0.1:1', environ['HTTP_X_IMAGE_CACHE_PEER'])
+        self.assertFalse('HTTP_COOKIE' in environ)
+
+    def test_fetch_error_status(self):
+        self.status = '404 Not Found'
+        self.assertRaises(peers.PeerFetchError, self.peer_cache.fetch,
+                          self.peer, '/v1/images/image', {})
+
+    def test_fetch_unreachable_peer(self):
+        self.assertRaises(peers.PeerFetchError, self.peer_cache.fetch,
+                          '127.0.0.1:1', '/v1/images/image', {})
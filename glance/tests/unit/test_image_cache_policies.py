@@ -0,0 +1,227 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from glance.common import exception
+from glance import image_cache
+from glance.image_cache import simulator
+from glance.image_cache.policies import arc
+from glance.image_cache.policies import gdsf
+from glance.image_cache.policies import lfu
+from glance.image_cache.policies import lru
+from glance.openstack.common import cfg
+
+KB = 1024
+
+
+def make_conf(max_size=10 * KB, **overrides):
+    conf = cfg.ConfigOpts()
+    conf.register_opts(image_cache.ImageCache.opts)
+    conf.register_opts(gdsf.Policy.opts)
+    conf.set_override('image_cache_max_size', max_size)
+    for name, value in overrides.items():
+        conf.set_override(name, value)
+    return conf
+
+
+def evict_all(policy):
+    victims = []
+    while True:
+        victim = policy.evict()
+        if victim is None:
+            return victims
+        victims.append(victim[0])
+
+
+class PolicyTestCase(object):
+
+    """Behaviour every eviction policy must share"""
+
+    def test_evict_empty(self):
+        self.assertEqual(None, self.policy.evict())
+
+    def test_evict_returns_size(self):
+        self.policy.insert('a', 3 * KB)
+        self.assertEqual(('a', 3 * KB), self.policy.evict())
+        self.assertEqual(None, self.policy.evict())
+
+    def test_remove(self):
+        self.policy.insert('a', KB)
+        self.policy.insert('b', KB)
+        self.policy.remove('a')
+        self.policy.remove('nonexistent')
+        self.assertEqual(['b'], evict_all(self.policy))
+
+    def test_load_replaces_entries(self):
+        self.policy.insert('a', KB)
+        self.policy.load([('b', KB, 0, 1.0), ('c', KB, 0, 2.0)])
+        self.assertEqual(set(['b', 'c']), set(evict_all(self.policy)))
+
+    def test_load_breaks_ties_by_last_accessed(self):
+        self.policy.load([('c', KB, 1, 3.0), ('a', KB, 1, 1.0),
+                          ('b', KB, 1, 2.0)])
+        self.assertEqual(['a', 'b', 'c'], evict_all(self.policy))
+
+
+class TestLRUPolicy(unittest.TestCase, PolicyTestCase):
+
+    def setUp(self):
+        self.policy = lru.Policy(make_conf())
+
+    def test_evicts_least_recently_accessed(self):
+        for image_id in ('a', 'b', 'c'):
+            self.policy.insert(image_id, KB)
+        self.policy.access('a')
+        self.assertEqual(['b', 'c', 'a'], evict_all(self.policy))
+
+
+class TestLFUPolicy(unittest.TestCase, PolicyTestCase):
+
+    def setUp(self):
+        self.policy = lfu.Policy(make_conf())
+
+    def test_evicts_least_frequently_accessed(self):
+        for image_id in ('a', 'b', 'c'):
+            self.policy.insert(image_id, KB)
+        for image_id in ('a', 'a', 'b'):
+            self.policy.access(image_id)
+        self.assertEqual(['c', 'b', 'a'], evict_all(self.policy))
+
+    def test_load_uses_hits(self):
+        self.policy.load([('a', KB, 5, 1.0), ('b', KB, 1, 2.0)])
+        self.assertEqual(['b', 'a'], evict_all(self.policy))
+
+
+class TestGDSFPolicy(unittest.TestCase, PolicyTestCase):
+
+    def setUp(self):
+        self.policy = gdsf.Policy(make_conf())
+
+    def test_evicts_large_images_first(self):
+        self.policy.insert('big', 8 * KB)
+        self.policy.insert('small', KB)
+        self.assertEqual(['big', 'small'], evict_all(self.policy))
+
+    def test_frequency_outweighs_size(self):
+        self.policy.insert('big', 2 * KB)
+        self.policy.insert('small', KB)
+        for x in xrange(4):
+            self.policy.access('big')
+        self.assertEqual(['small', 'big'], evict_all(self.policy))
+
+    def test_evictions_age_remaining_images(self):
+        self.policy.insert('old', KB)
+        for x in xrange(3):
+            self.policy.access('old')
+        self.policy.insert('victim', KB)
+        self.assertEqual(('victim', KB), self.policy.evict())
+        # New images start from the priority of the last eviction, so
+        # enough of them eventually push out an image that is no longer
+        # being read
+        victims = []
+        for x in xrange(5):
+            self.policy.insert('new%d' % x, KB)
+            self.policy.access('new%d' % x)
+            victims.append(self.policy.evict()[0])
+        self.assertTrue('old' in victims)
+
+    def test_bytes_cost_ignores_size(self):
+        policy = gdsf.Policy(make_conf(image_cache_gdsf_cost='bytes'))
+        policy.insert('big', 8 * KB)
+        policy.access('big')
+        policy.insert('small', KB)
+        self.assertEqual(['small', 'big'], evict_all(policy))
+
+    def test_unknown_cost_defaults_to_uniform(self):
+        policy = gdsf.Policy(make_conf(image_cache_gdsf_cost='bogus'))
+        self.assertEqual('uniform', policy.cost)
+
+
+class TestARCPolicy(unittest.TestCase, PolicyTestCase):
+
+    def setUp(self):
+        self.policy = arc.Policy(make_conf(max_size=4 * KB))
+
+    def test_frequently_read_images_survive_a_scan(self):
+        for image_id in ('hot1', 'hot2'):
+            self.policy.insert(image_id, KB)
+            self.policy.access(image_id)
+        # A scan of images read only once churns T1 and leaves T2 alone
+        for x in xrange(10):
+            self.policy.insert('scan%d' % x, KB)
+            self.assertTrue(self.policy.evict()[0].startswith('scan'))
+        self.assertEqual(set(['hot1', 'hot2']), set(self.policy.t2))
+
+    def test_ghost_hit_adapts_target(self):
+        self.policy.insert('a', KB)
+        self.assertEqual(('a', KB), self.policy.evict())
+        self.assertTrue('a' in self.policy.b1)
+        self.assertEqual(0, self.policy.target)
+        self.policy.insert('a', KB)
+        self.assertTrue(self.policy.target > 0)
+        self.assertTrue('a' in self.policy.t2)
+        self.assertFalse('a' in self.policy.b1)
+
+    def test_ghost_lists_are_bounded(self):
+        for x in xrange(100):
+            self.policy.insert(x, KB)
+            self.policy.evict()
+        self.assertTrue(self.policy.b1.size <= 4 * KB)
+        self.assertEqual(self.policy.b1.size, KB * len(self.policy.b1))
+
+    def test_load_places_reread_images_in_t2(self):
+        self.policy.load([('a', KB, 0, 1.0), ('b', KB, 3, 2.0)])
+        self.assertEqual(['a'], list(self.policy.t1))
+        self.assertEqual(['b'], list(self.policy.t2))
+
+
+class TestSimulator(unittest.TestCase):
+
+    def test_parse_trace(self):
+        lines = ["# timestamp image_id size\n",
+                 "\n",
+                 "1.5 abc 1024\n",
+                 "2 def 2048"]
+        self.assertEqual([(1.5, 'abc', 1024), (2.0, 'def', 2048)],
+                         list(simulator.parse_trace(lines)))
+
+    def test_parse_trace_malformed(self):
+        lines = ["1 abc 1024", "2 def"]
+        self.assertRaises(exception.Invalid, list,
+                          simulator.parse_trace(lines))
+
+    def test_simulate(self):
+        trace = [(1, 'a', 2 * KB), (2, 'b', 2 * KB), (3, 'a', 2 * KB),
+                 (4, 'c', 2 * KB), (5, 'b', 2 * KB), (6, 'huge', 8 * KB)]
+        policy = lru.Policy(make_conf(max_size=4 * KB))
+        stats = simulator.simulate(policy, trace, 4 * KB)
+        self.assertEqual(6, stats['requests'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(18 * KB, stats['bytes_requested'])
+        self.assertEqual(16 * KB, stats['bytes_from_backend'])
+        self.assertAlmostEqual(1 / 6.0, stats['hit_ratio'])
+
+    def test_simulate_every_policy(self):
+        image_ids = [min(x % 10, x % 3) for x in xrange(200)]
+        trace = [(x, 'img%d' % image_id, KB * (1 + image_id % 2))
+                 for x, image_id in enumerate(image_ids)]
+        for name in simulator.POLICIES:
+            policy = simulator.load_policy(name, make_conf(max_size=5 * KB))
+            stats = simulator.simulate(policy, trace, 5 * KB)
+            self.assertEqual(200, stats['requests'])
+            self.assertTrue(0 < stats['hits'] < 200, name)
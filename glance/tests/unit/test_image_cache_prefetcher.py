@@ -0,0 +1,295 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import unittest
+
+import eventlet
+
+from glance.common import utils
+from glance.image_cache import prefetch_queue
+from glance.image_cache import prefetcher
+from glance.tests.unit import base
+
+
+def _queued_image(image_id, priority=0, requests=1, size=0,
+                  location='file:///tmp/image'):
+    entry = {'image_id': image_id, 'priority': priority,
+             'requests': requests, 'attempts': 0}
+    return prefetcher.QueuedImage(entry, {'size': size,
+                                          'location': location})
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_priority_order(self):
+        images = [_queued_image('small', size=10),
+                  _queued_image('big', size=1000),
+                  _queued_image('popular', requests=3, size=1000),
+                  _queued_image('urgent', priority=5, size=1000)]
+        scheduler = prefetcher.Scheduler(images, 1, {})
+        order = []
+        while True:
+            image = scheduler.next()
+            if image is None:
+                break
+            order.append(image.image_id)
+            scheduler.done(image)
+        self.assertEqual(['urgent', 'popular', 'small', 'big'], order)
+
+    def test_backend_limits(self):
+        images = [_queued_image('swift%d' % x, priority=1,
+                                location='swift+https://host/c/%d' % x)
+                  for x in xrange(3)]
+        images.append(_queued_image('file0'))
+        scheduler = prefetcher.Scheduler(images, 4, {'swift': 1})
+
+        first = scheduler.next()
+        self.assertEqual('swift0', first.image_id)
+        # The other swift images have to wait, the file one does not
+        self.assertEqual('file0', scheduler.next().image_id)
+
+        waiting = eventlet.spawn(scheduler.next)
+        eventlet.sleep(0)
+        self.assertFalse(waiting.dead)
+        scheduler.done(first)
+        self.assertEqual('swift1', waiting.wait().image_id)
+
+    def test_get_backend(self):
+        self.assertEqual('swift',
+                         prefetcher.get_backend('swift+https://a/b/c'))
+        self.assertEqual('s3', prefetcher.get_backend('s3://a/b/c'))
+        self.assertEqual('file', prefetcher.get_backend('/var/lib/image'))
+
+    def test_parse_backend_limits(self):
+        self.assertEqual({'swift': 2, 's3': 4},
+                         prefetcher.parse_backend_limits(['swift:2',
+                                                          ' s3:4',
+                                                          'bogus']))
+
+    def test_parse_backend_limits_below_one(self):
+        self.assertEqual({'s3': 1},
+                         prefetcher.parse_backend_limits(['swift:0',
+                                                          'file:-1',
+                                                          's3:1']))
+
+
+class TestThrottle(unittest.TestCase):
+
+    def test_throttled_rate(self):
+        now = [1000.0]
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        throttle = prefetcher.Throttle(100)
+        orig_time = prefetcher.time.time
+        orig_sleep = prefetcher.eventlet.sleep
+        prefetcher.time.time = lambda: now[0]
+        prefetcher.eventlet.sleep = fake_sleep
+        try:
+            data = list(throttle.throttled_iter(['x' * 50] * 4))
+        finally:
+            prefetcher.time.time = orig_time
+            prefetcher.eventlet.sleep = orig_sleep
+
+        self.assertEqual(4, len(data))
+        self.assertEqual(1002.0, now[0])
+
+    def test_no_limit(self):
+        throttle = prefetcher.Throttle(0)
+        self.assertEqual(['abc'], list(throttle.throttled_iter(['abc'])))
+
+
+class PrefetcherTestCase(base.IsolatedUnitTest):
+
+    def setUp(self):
+        super(PrefetcherTestCase, self).setUp()
+        self.conf.image_cache_dir = os.path.join(self.test_dir, 'cache')
+        self.conf.image_cache_prefetch_workers = 2
+        self.prefetcher = prefetcher.Prefetcher(self.conf)
+        self.cache = self.prefetcher.cache
+
+        def fake_get_image_meta(image_id):
+            if image_id == self.missing:
+                return None
+            return {'id': image_id, 'size': 3, 'status': 'active',
+                    'location': 'file:///tmp/%s' % image_id}
+
+        def fake_get_from_backend(location):
+            if self.broken and location.endswith(self.broken):
+                raise IOError()
+            return iter(['abc']), 3
+
+        self.stubs.Set(self.prefetcher, 'get_image_meta',
+                       fake_get_image_meta)
+        self.stubs.Set(prefetcher, 'get_from_backend', fake_get_from_backend)
+        self.missing = utils.generate_uuid()
+        self.broken = utils.generate_uuid()
+
+
+class TestPrefetcher(PrefetcherTestCase):
+
+    def test_run(self):
+        image_ids = [utils.generate_uuid() for x in xrange(3)]
+        for image_id in image_ids:
+            self.assertTrue(self.cache.queue_image(image_id))
+        self.assertTrue(self.prefetcher.run())
+
+        for image_id in image_ids:
+            self.assertTrue(self.cache.is_cached(image_id))
+        self.assertEqual([], self.cache.get_queued_images())
+
+    def test_failed_fetch_recorded(self):
+        ok = utils.generate_uuid()
+        for image_id in (ok, self.missing, self.broken):
+            self.assertTrue(self.cache.queue_image(image_id))
+        self.assertFalse(self.prefetcher.run())
+
+        self.assertTrue(self.cache.is_cached(ok))
+        entries = dict((entry['image_id'], entry)
+                       for entry in self.cache.get_queue_entries())
+        self.assertEqual(sorted([self.missing, self.broken]),
+                         sorted(entries.keys()))
+        self.assertEqual('failed', entries[self.broken]['state'])
+        self.assertEqual(1, entries[self.broken]['attempts'])
+        self.assertEqual('queued', entries[self.missing]['state'])
+
+
+class TestPrefetchQueue(base.IsolatedUnitTest):
+
+    def setUp(self):
+        super(TestPrefetchQueue, self).setUp()
+        self.db_path = os.path.join(self.test_dir, 'index.db')
+        self.queue = prefetch_queue.PrefetchQueue(self.db_path)
+
+    def _add(self, image_id, priority=0, requests=1, size=0, queued_at=0):
+        entry = {'image_id': image_id, 'priority': priority,
+                 'requests': requests, 'attempts': 0,
+                 'queued_at': queued_at}
+        self.queue.add(entry, size, 'file')
+
+    def test_ready_order(self):
+        self._add('small', size=10)
+        self._add('big', size=1000)
+        self._add('popular', requests=2, size=1000)
+        self._add('urgent', priority=1, size=1000)
+        self._add('later', priority=2)
+        self.queue.update('later', retry_at=100)
+
+        self.assertEqual(['urgent', 'popular', 'small', 'big'],
+                         [e['image_id'] for e in self.queue.get_ready(50)])
+        self.assertEqual('later', self.queue.get_ready(100)[0]['image_id'])
+
+    def test_persistent(self):
+        self._add('image')
+        self.queue.update('image', attempts=2, retry_at=100)
+        self.queue.close()
+
+        queue = prefetch_queue.PrefetchQueue(self.db_path)
+        entry = queue.get_entry('image')
+        self.assertEqual(2, entry['attempts'])
+        self.assertEqual(100, entry['retry_at'])
+        queue.delete('image')
+        self.assertEqual({}, queue.get_entries())
+
+    def test_update_unknown_field(self):
+        self._add('image')
+        self.assertRaises(ValueError, self.queue.update, 'image', bogus=1)
+
+
+class TestPrefetcherDaemon(PrefetcherTestCase):
+
+    def setUp(self):
+        super(TestPrefetcherDaemon, self).setUp()
+        self.now = 1000.0
+        self.stubs.Set(prefetcher.time, 'time', lambda: self.now)
+        self.prefetcher.start_daemon()
+
+    def _poll(self):
+        self.prefetcher.poll()
+        self.prefetcher.pool.waitall()
+
+    def test_picks_up_queued_images(self):
+        self._poll()
+        image_id = utils.generate_uuid()
+        self.assertTrue(self.cache.queue_image(image_id))
+        self._poll()
+
+        self.assertTrue(self.cache.is_cached(image_id))
+        self.assertEqual([], self.cache.get_queued_images())
+        self.assertEqual({}, self.prefetcher.queue.get_entries())
+
+    def test_retry_with_backoff(self):
+        self.conf.image_cache_prefetch_retry_interval = 10
+        self.assertTrue(self.cache.queue_image(self.broken))
+        self.assertTrue(self.cache.queue_image(self.missing))
+        self._poll()
+
+        queue = self.prefetcher.queue
+        self.assertEqual(1, queue.get_entry(self.missing)['attempts'])
+        self.assertEqual(1010, queue.get_entry(self.missing)['retry_at'])
+        self.assertEqual(1, queue.get_entry(self.broken)['attempts'])
+
+        # Nothing is due yet
+        self._poll()
+        self.assertEqual(1, queue.get_entry(self.broken)['attempts'])
+
+        self.now = 1010
+        self._poll()
+        self.assertEqual(2, queue.get_entry(self.broken)['attempts'])
+        self.assertEqual(1030, queue.get_entry(self.broken)['retry_at'])
+        entry = self.cache.get_queue_entries()[0]
+        self.assertEqual('failed', entry['state'])
+        self.assertEqual(2, entry['attempts'])
+
+        # The image is fetched once the store comes back
+        image_id, self.broken = self.broken, None
+        self.now = 1030
+        self._poll()
+        self.assertEqual(None, queue.get_entry(image_id))
+        self.assertTrue(self.cache.is_cached(image_id))
+
+    def test_survives_restart(self):
+        self.conf.image_cache_prefetch_retry_interval = 10
+        self.assertTrue(self.cache.queue_image(self.broken))
+        self._poll()
+
+        self.prefetcher.queue.close()
+        self.prefetcher = prefetcher.Prefetcher(self.conf)
+        self.prefetcher.start_daemon()
+        self.stubs.Set(self.prefetcher, 'get_image_meta',
+                       lambda image_id: None)
+        self._poll()
+
+        # The retry is not due yet, so no new attempt was made
+        entry = self.prefetcher.queue.get_entry(self.broken)
+        self.assertEqual(1, entry['attempts'])
+        self.assertEqual(1010, entry['retry_at'])
+
+    def test_dequeued_images_dropped(self):
+        self.conf.image_cache_prefetch_retry_interval = 10
+        self.assertTrue(self.cache.queue_image(self.broken))
+        self._poll()
+        self.cache.delete_queued_image(self.broken)
+
+        self.now = 1010
+        self._poll()
+        self.assertEqual({}, self.prefetcher.queue.get_entries())
@@ -0,0 +1,67 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import hashlib
+import os
+
+from glance.image_cache import verifier
+from glance.tests.unit import base
+
+
+class TestVerifier(base.IsolatedUnitTest):
+
+    def setUp(self):
+        super(TestVerifier, self).setUp()
+        self.conf.image_cache_dir = os.path.join(self.test_dir, 'cache')
+        self.conf.image_cache_verify_rate_limit = 0
+        self.verifier = verifier.Verifier(self.conf)
+        self.cache = self.verifier.cache
+        for image_id in ('good', 'bad'):
+            image_meta = {'checksum': hashlib.md5(image_id).hexdigest()}
+            self.cache.cache_image_iter(image_id, iter([image_id]),
+                                        image_meta)
+
+    def _corrupt(self, image_id):
+        path = self.cache.driver.get_image_filepath(image_id)
+        with open(path, 'r+b') as image_file:
+            image_file.write('x')
+
+    def test_corrupt_image_invalidated(self):
+        self._corrupt('bad')
+        self.assertFalse(self.verifier.run())
+
+        self.assertTrue(self.cache.is_cached('good'))
+        self.assertFalse(self.cache.is_cached('bad'))
+        invalid_path = self.cache.driver.get_image_filepath('bad', 'invalid')
+        self.assertTrue(os.path.exists(invalid_path))
+
+    def test_recently_verified_images_skipped(self):
+        self.assertTrue(self.verifier.run())
+        self._corrupt('bad')
+        self.assertTrue(self.verifier.run())
+        self.assertTrue(self.cache.is_cached('bad'))
+
+        self.conf.image_cache_verify_interval = -1
+        self.assertFalse(self.verifier.run())
+        self.assertFalse(self.cache.is_cached('bad'))
+
+    def test_missing_checksum_recorded(self):
+        self.cache.driver.set_checksum('good', None)
+        self.assertTrue(self.verifier.run())
+        self.assertEqual(hashlib.md5('good').hexdigest(),
+                         self.cache.driver.get_checksum('good'))
@@ -0,0 +1,98 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+
+from glance.common import utils
+from glance.image_cache import ImageCache
+from glance.image_cache import warmer
+from glance.tests.unit import base
+
+
+class TestActivationWarmer(base.IsolatedUnitTest):
+
+    def setUp(self):
+        super(TestActivationWarmer, self).setUp()
+        self.conf.image_cache_dir = os.path.join(self.test_dir, 'cache')
+        self.conf.image_cache_warm_properties = ['is_public=true',
+                                                 'os_type=Linux', 'bogus']
+        self.conf.image_cache_warm_max_size = 100
+        self.warmer = warmer.ActivationWarmer(self.conf)
+
+    def _image_meta(self, **values):
+        image_meta = {'id': utils.generate_uuid(), 'is_public': True,
+                      'size': 100, 'properties': {'os_type': 'linux'}}
+        image_meta.update(values)
+        return image_meta
+
+    def test_matches(self):
+        self.assertTrue(self.warmer.matches(self._image_meta()))
+        self.assertFalse(self.warmer.matches(self._image_meta(size=101)))
+        self.assertFalse(self.warmer.matches(
+                self._image_meta(is_public=False)))
+        self.assertFalse(self.warmer.matches(self._image_meta(properties={})))
+
+    def test_disabled(self):
+        self.warmer.image_activated(self._image_meta())
+        self.assertEqual(None, self.warmer.cache)
+
+    def test_image_activated(self):
+        self.warmer.enabled = True
+        image_meta = self._image_meta()
+        self.warmer.image_activated(image_meta)
+        self.warmer.image_activated(self._image_meta(size=1000))
+        self.assertEqual([image_meta['id']],
+                         self.warmer.cache.get_queued_images())
+
+
+class TestTrendWarmer(base.IsolatedUnitTest):
+
+    def setUp(self):
+        super(TestTrendWarmer, self).setUp()
+        self.conf.image_cache_dir = os.path.join(self.test_dir, 'cache')
+        self.conf.image_cache_warm_min_hits = 4
+        self.conf.image_cache_hit_flush_count = 1
+        self.cache = ImageCache(self.conf)
+        self.warmer = warmer.TrendWarmer(self.conf, self.cache)
+        self.image_ids = [utils.generate_uuid() for x in xrange(2)]
+        for image_id in self.image_ids:
+            self.cache.cache_image_iter(image_id, iter(['abc']))
+
+    def _hit(self, image_id, hits):
+        for x in xrange(hits):
+            self.cache.driver.record_hit(image_id)
+
+    def test_evicted_trending_image_queued(self):
+        trending, steady = self.image_ids
+        self.assertEqual([], self.warmer.run())
+        for x in xrange(3):
+            self._hit(trending, 1)
+            self._hit(steady, 5)
+            self.warmer.run()
+
+        self._hit(trending, 10)
+        self._hit(steady, 5)
+        self.assertEqual([], self.warmer.run())
+
+        for image_id in self.image_ids:
+            self.cache.delete_cached_image(image_id)
+        self.assertEqual([trending], self.warmer.run())
+        self.assertEqual([trending], self.cache.get_queued_images())
+
+        # The history of images no longer cached is dropped
+        self.assertEqual([], self.warmer.run())
@@ -22,6 +22,7 @@ import hashlib
 import unittest
 
 import stubout
+import boto.exception
 import boto.s3.connection
 
 from glance.common import exception
@@ -35,6 +36,8 @@ from glance.tests import utils as test_utils
 FAKE_UUID = utils.generate_uuid()
 
 FIVE_KB = (5 * 1024)
+MULTIPART_UPLOADS = []
+FAIL_PART_NUM = None
 S3_CONF = {'verbose': True,
            'debug': True,
            's3_store_access_key': 'user',
@@ -89,6 +92,41 @@ def stub_out_s3(stubs):
         def get_file(self):
             return self.data
 
+        def get_contents_as_string(self, headers=None):
+            data = self.bucket.keys[self.name].data.getvalue()
+            byte_range = (headers or {}).get('Range')
+            if byte_range:
+                first, last = byte_range[len('bytes='):].split('-')
+                data = data[int(first):int(last) + 1]
+            return data
+
+    class FakeMultiPartUpload:
+        """
+        Acts like a ``boto.s3.multipart.MultiPartUpload``
+        """
+        def __init__(self, bucket, key_name):
+            self.bucket = bucket
+            self.key_name = key_name
+            self.parts = {}
+            self.completed = False
+            self.cancelled = False
+            MULTIPART_UPLOADS.append(self)
+
+        def upload_part_from_file(self, fp, part_num, **kwargs):
+            if part_num == FAIL_PART_NUM:
+                raise boto.exception.S3ResponseError(500, 'Internal Error')
+            self.parts[part_num] = fp.read()
+
+        def complete_upload(self):
+            data = ''.join([self.parts[part_num]
+                            for part_num in sorted(self.parts)])
+            key = self.bucket.new_key(self.key_name)
+            key.set_contents_from_file(StringIO.StringIO(data))
+            self.completed = True
+
+        def cancel_upload(self):
+            self.cancelled = True
+
     class FakeBucket:
         """
         Acts like a ``boto.s3.bucket.Bucket``
@@ -117,6 +155,9 @@ def stub_out_s3(stubs):
             self.keys[key_name] = new_key
             return new_key
 
+        def initiate_multipart_upload(self, key_name, **kwargs):
+            return FakeMultiPartUpload(self, key_name)
+
     fixture_buckets = {'glance': FakeBucket('glance')}
     b = fixture_buckets['glance']
     k = b.new_key(FAKE_UUID)
@@ -182,6 +223,23 @@ class TestStore(unittest.TestCase):
             data += chunk
         self.assertEqual(expected_data, data)
 
+    def test_get_ranges_concurrently(self):
+        """Test a retrieval of an image in byte ranges fetched at once"""
+        conf = S3_CONF.copy()
+        conf['s3_store_download_concurrency'] = 3
+        self.store = Store(test_utils.TestConfigOpts(conf))
+        self.store.download_range_size = 1000
+        contents = ''.join([chr(ord('a') + i) * 1024 for i in range(5)])
+        location, size, checksum = self.store.add(
+                utils.generate_uuid(), StringIO.StringIO(contents),
+                len(contents))
+        (image_s3, image_size) = self.store.get(
+                get_location_from_uri(location))
+
+        self.assertEqual(image_size, FIVE_KB)
+        self.assertEqual(FIVE_KB, len(image_s3))
+        self.assertEqual(contents, ''.join(image_s3))
+
     def test_get_non_existing(self):
         """
         Test that trying to retrieve a s3 that doesn't exist
@@ -227,6 +285,49 @@ class TestStore(unittest.TestCase):
         self.assertEquals(expected_s3_contents, new_image_contents.getvalue())
         self.assertEquals(expected_s3_size, new_image_s3_size)
 
+    def _add_in_parts(self, image_size):
+        conf = S3_CONF.copy()
+        conf['s3_store_multipart_concurrency'] = 3
+        self.store = Store(test_utils.TestConfigOpts(conf))
+        self.store.multipart_part_size = 1000
+        del MULTIPART_UPLOADS[:]
+        contents = ''.join([chr(ord('a') + i) * 1024 for i in range(5)])
+        return self.store.add(utils.generate_uuid(),
+                              StringIO.StringIO(contents), image_size)
+
+    def test_add_in_parts(self):
+        """Test that we can add an image as a multipart upload"""
+        location, size, checksum = self._add_in_parts(FIVE_KB)
+        contents = ''.join([chr(ord('a') + i) * 1024 for i in range(5)])
+        self.assertEquals(FIVE_KB, size)
+        self.assertEquals(hashlib.md5(contents).hexdigest(), checksum)
+
+        self.assertEquals(1, len(MULTIPART_UPLOADS))
+        self.assertEquals(range(1, 7), sorted(MULTIPART_UPLOADS[0].parts))
+        self.assertTrue(MULTIPART_UPLOADS[0].completed)
+
+        (new_image_s3, new_image_size) = self.store.get(
+                get_location_from_uri(location))
+        self.assertEquals(contents, ''.join(new_image_s3))
+
+    def test_add_in_parts_unknown_size(self):
+        """Test that we can add an image of unknown size in parts"""
+        location, size, checksum = self._add_in_parts(0)
+        self.assertEquals(FIVE_KB, size)
+        self.assertTrue(MULTIPART_UPLOADS[0].completed)
+
+    def test_add_in_parts_aborted_on_failure(self):
+        """Test that a failed part aborts the multipart upload"""
+        global FAIL_PART_NUM
+        FAIL_PART_NUM = 3
+        try:
+            self.assertRaises(boto.exception.S3ResponseError,
+                              self._add_in_parts, FIVE_KB)
+        finally:
+            FAIL_PART_NUM = None
+        self.assertTrue(MULTIPART_UPLOADS[0].cancelled)
+        self.assertFalse(MULTIPART_UPLOADS[0].completed)
+
     def test_add_host_variations(self):
         """
         Test that having http(s):// in the s3serviceurl in config
@@ -15,12 +15,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import tempfile
 import unittest
+
+import eventlet
+from eventlet.green import httplib
+from eventlet.green import socket
+import eventlet.wsgi
 import webob
 
 from glance.common import wsgi
 from glance.common import utils
 from glance.common import exception
+from glance.tests import utils as test_utils
 
 
 class RequestTest(unittest.TestCase):
@@ -234,3 +241,71 @@ class TestHelpers(unittest.TestCase):
                 self.assertEqual(v, result[k])
             else:
                 self.assertFalse(k in result)
+
+
+class FileWrapperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = ''.join(chr(x % 251) for x in xrange(300000))
+        self.image_file = tempfile.TemporaryFile()
+        self.image_file.write(self.data)
+        self.image_file.seek(0)
+
+    def tearDown(self):
+        self.image_file.close()
+
+    def test_reads_blocks_without_socket(self):
+        chunks = list(wsgi.FileWrapper(self.image_file, 65536))
+        self.assertEqual(self.data, ''.join(chunks))
+        self.assertEqual([65536] * 4 + [300000 - 4 * 65536],
+                         [len(chunk) for chunk in chunks])
+
+    @test_utils.skip_unless(wsgi.SENDFILE_SUPPORTED,
+                            "sendfile module not available")
+    def test_sends_rest_of_file_with_sendfile(self):
+        server_sock, client_sock = socket.socketpair()
+
+        def read_all():
+            received = []
+            while True:
+                data = client_sock.recv(65536)
+                if not data:
+                    return ''.join(received)
+                received.append(data)
+
+        reader = eventlet.spawn(read_all)
+        wrapper = wsgi.FileWrapper(self.image_file, 65536, sock=server_sock)
+        chunks = []
+        for chunk in wrapper:
+            if not isinstance(chunk, wsgi.SentChunk):
+                # Stand in for the server writing the chunk out
+                server_sock.sendall(chunk)
+            chunks.append(chunk)
+        server_sock.close()
+
+        self.assertEqual(self.data, reader.wait())
+        self.assertEqual(self.data[:65536], chunks[0])
+        self.assertTrue(all(isinstance(chunk, wsgi.SentChunk)
+                            for chunk in chunks[1:]))
+        self.assertEqual(len(self.data), sum(len(chunk) for chunk in chunks))
+
+    def test_served_by_eventlet(self):
+        def app(environ, start_response):
+            start_response('200 OK',
+                           [('Content-Length', str(len(self.data)))])
+            return environ['wsgi.file_wrapper'](self.image_file, 65536)
+
+        listener = eventlet.listen(('127.0.0.1', 0))
+        server = eventlet.spawn(eventlet.wsgi.server, listener, app,
+                                protocol=wsgi.HttpProtocol,
+                                log=open('/dev/null', 'w'))
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1',
+                                          listener.getsockname()[1])
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            self.assertEqual(200, response.status)
+            self.assertEqual(self.data, response.read())
+        finally:
+            server.kill()
+            listener.close()
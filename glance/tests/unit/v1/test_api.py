@@ -19,16 +19,22 @@ import datetime
 import hashlib
 import httplib
 import json
+import os
 import unittest
 
+import eventlet
 import stubout
 import webob
 
 from sqlalchemy import exc
+from glance.api.middleware import cache as cache_middleware
 from glance.api.v1 import images
 from glance.api.v1 import router
 from glance.common import context
+from glance.common import exception
 from glance.common import utils
+from glance import image_cache
+from glance.image_cache import peers
 from glance.registry.api import v1 as rserver
 from glance.registry.db import api as db_api
 from glance.registry.db import models as db_models
@@ -2189,6 +2195,33 @@ class TestGlanceAPI(base.IsolatedUnitTest):
         res = req.get_response(self.api)
         self.assertEquals(res.status_int, httplib.BAD_REQUEST)
 
+    def test_add_image_warms_cache(self):
+        """Tests that newly active images matching the rules are queued"""
+        self.conf.image_cache_dir = os.path.join(self.test_dir, 'cache')
+        self.conf.image_cache_warm_on_activation = True
+        self.conf.image_cache_warm_properties = ['disk_format=vhd',
+                                                 'os_type=linux']
+        self.api = context.UnauthenticatedContextMiddleware(
+                router.API(self.conf), self.conf)
+
+        image_ids = []
+        for os_type in ('linux', 'windows'):
+            req = webob.Request.blank("/images")
+            req.method = 'POST'
+            req.headers['x-image-meta-store'] = 'file'
+            req.headers['x-image-meta-disk-format'] = 'vhd'
+            req.headers['x-image-meta-container-format'] = 'ovf'
+            req.headers['x-image-meta-name'] = 'fake image'
+            req.headers['x-image-meta-property-os_type'] = os_type
+            req.headers['Content-Type'] = 'application/octet-stream'
+            req.body = "chunk00000remainder"
+            res = req.get_response(self.api)
+            self.assertEquals(res.status_int, httplib.CREATED)
+            image_ids.append(json.loads(res.body)['image']['id'])
+
+        cache = image_cache.ImageCache(self.conf)
+        self.assertEqual(image_ids[:1], cache.get_queued_images())
+
     def test_add_image_unauthorized(self):
         rules = {"add_image": [["false:false"]]}
         self.set_policy_rules(rules)
@@ -2796,6 +2829,14 @@ class TestGlanceAPI(base.IsolatedUnitTest):
         self.assertEqual(res.content_type, 'application/octet-stream')
         self.assertEqual('chunk00000remainder', res.body)
 
+    def test_show_image_range(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=5-9'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 206)
+        self.assertEqual('bytes 5-9/19', res.headers['Content-Range'])
+        self.assertEqual('00000', res.body)
+
     def test_show_non_exists_image(self):
         req = webob.Request.blank("/images/%s" % _gen_uuid())
         res = req.get_response(self.api)
@@ -3039,6 +3080,65 @@ class TestImageSerializer(base.IsolatedUnitTest):
 
         self.assertEqual(response.body, 'chunk67891123456789')
 
+    def test_show_range(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=3-7'
+        req.context = self.context
+        response = webob.Response(request=req)
+
+        self.serializer.show(response, self.FIXTURE)
+        self.assertEqual(206, response.status_int)
+        self.assertEqual('bytes 3-7/19', response.headers['Content-Range'])
+        self.assertEqual('bytes', response.headers['Accept-Ranges'])
+        self.assertEqual('5', response.headers['Content-Length'])
+        self.assertEqual('nk678', response.body)
+
+    def test_show_multiple_ranges(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=-2,0-1'
+        req.context = self.context
+        response = webob.Response(request=req)
+
+        self.serializer.show(response, self.FIXTURE)
+        self.assertEqual(206, response.status_int)
+        content_type = response.headers['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/byteranges; '))
+        body = response.body
+        self.assertEqual(str(len(body)), response.headers['Content-Length'])
+        self.assertTrue('Content-Range: bytes 0-1/19\r\n\r\nch\r\n' in body)
+        self.assertTrue('Content-Range: bytes 17-18/19\r\n\r\n89\r\n'
+                        in body)
+
+    def test_show_range_not_satisfiable(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=19-'
+        req.context = self.context
+        response = webob.Response(request=req)
+
+        self.serializer.show(response, self.FIXTURE)
+        self.assertEqual(416, response.status_int)
+        self.assertEqual('bytes */19', response.headers['Content-Range'])
+        self.assertEqual('', response.body)
+
+    def test_show_range_if_range_mismatch(self):
+        self.FIXTURE['image_meta']['checksum'] = 'abc'
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=3-7'
+        req.headers['If-Range'] = '"def"'
+        req.context = self.context
+        response = webob.Response(request=req)
+
+        self.serializer.show(response, self.FIXTURE)
+        self.assertEqual(200, response.status_int)
+        self.assertEqual(response.body, 'chunk67891123456789')
+
+        req.headers['If-Range'] = '"abc"'
+        self.FIXTURE['image_iterator'] = iter(['chunk67891123456789'])
+        response = webob.Response(request=req)
+        self.serializer.show(response, self.FIXTURE)
+        self.assertEqual(206, response.status_int)
+        self.assertEqual('nk678', response.body)
+
     def test_show_notify(self):
         """Make sure an eventlet posthook for notify_image_sent is added."""
         req = webob.Request.blank("/images/%s" % UUID2)
@@ -3151,3 +3251,249 @@ class TestContextMiddleware(base.IsolatedUnitTest):
         req = self._build_request()
         self._build_middleware(admin_role='role1').process_request(req)
         self.assertTrue(req.context.is_admin)
+
+
+class TestCacheFilterMetadataSnapshot(base.IsolatedUnitTest):
+
+    """Tests serving cache hits from image metadata snapshots"""
+
+    def setUp(self):
+        super(TestCacheFilterMetadataSnapshot, self).setUp()
+        self.conf.image_cache_dir = os.path.join(self.test_dir, 'cache')
+        self.conf.image_cache_metadata_ttl = 60
+        self.filter = cache_middleware.CacheFilter(None, self.conf)
+        self.cache = self.filter.cache
+        self.image_id = _gen_uuid()
+        self.image_meta = {'id': self.image_id,
+                           'name': 'fake image',
+                           'status': 'active',
+                           'deleted': False,
+                           'is_public': False,
+                           'owner': 'tenant1',
+                           'size': 3,
+                           'checksum': None,
+                           'properties': {}}
+        self.cache.cache_image_iter(self.image_id, iter(['abc']))
+        self.registry_calls = 0
+
+        def fake_get_image_metadata(context, image_id):
+            self.registry_calls += 1
+            return dict(self.image_meta)
+
+        self.stubs.Set(cache_middleware.registry, 'get_image_metadata',
+                       fake_get_image_metadata)
+
+    def _request(self, tenant='tenant1', method='GET'):
+        req = webob.Request.blank("/images/%s" % self.image_id)
+        req.method = method
+        req.context = context.RequestContext(tenant=tenant)
+        return req
+
+    def test_hit_served_from_snapshot(self):
+        self.cache.save_metadata_snapshot(self.image_id, self.image_meta)
+        res = self.filter.process_request(self._request())
+        self.assertEqual(200, res.status_int)
+        self.assertEqual('abc', res.body)
+        self.assertEqual('fake image', res.headers['x-image-meta-name'])
+        self.assertEqual(0, self.registry_calls)
+
+    def test_hit_without_snapshot_saves_one(self):
+        res = self.filter.process_request(self._request())
+        self.assertEqual('abc', res.body)
+        self.assertEqual(1, self.registry_calls)
+
+        image_meta, age = self.cache.get_metadata_snapshot(self.image_id)
+        self.assertEqual('fake image', image_meta['name'])
+
+    def test_expired_snapshot_not_used(self):
+        self.cache.save_metadata_snapshot(self.image_id, self.image_meta)
+        self.stubs.Set(self.cache, 'get_metadata_snapshot',
+                       lambda image_id: (self.image_meta, 60))
+        self.filter.process_request(self._request())
+        self.assertEqual(1, self.registry_calls)
+
+    def test_aging_snapshot_revalidated(self):
+        self.image_meta['name'] = 'renamed'
+        self.stubs.Set(self.cache, 'get_metadata_snapshot',
+                       lambda image_id: (dict(self.image_meta,
+                                              name='fake image'), 40))
+        res = self.filter.process_request(self._request())
+        self.assertEqual('fake image', res.headers['x-image-meta-name'])
+        eventlet.sleep(0)
+
+        self.assertEqual(1, self.registry_calls)
+        image_meta, saved_at = self.cache.driver.get_metadata_snapshot(
+                self.image_id)
+        self.assertEqual('renamed', image_meta['name'])
+
+    def test_snapshot_of_invisible_image_not_used(self):
+        self.cache.save_metadata_snapshot(self.image_id, self.image_meta)
+        self.filter.process_request(self._request(tenant='tenant2'))
+        self.assertEqual(1, self.registry_calls)
+
+    def test_update_and_delete_remove_snapshot(self):
+        for method in ('PUT', 'DELETE'):
+            self.cache.save_metadata_snapshot(self.image_id, self.image_meta)
+            resp = webob.Response(request=self._request(method=method))
+            self.filter.process_response(resp)
+            self.assertEqual(None,
+                             self.cache.get_metadata_snapshot(self.image_id))
+
+    def test_snapshot_saved_when_image_cached(self):
+        self.cache.delete_cached_image(self.image_id)
+        resp = webob.Response(request=self._request())
+        resp.app_iter = iter(['abc'])
+        resp.headers.update(utils.image_meta_to_http_headers(self.image_meta))
+        resp = self.filter.process_response(resp)
+        self.assertEqual('abc', ''.join(resp.app_iter))
+        self.cache.writers.wait()
+
+        self.assertTrue(self.cache.is_cached(self.image_id))
+        image_meta, age = self.cache.get_metadata_snapshot(self.image_id)
+        self.assertEqual('fake image', image_meta['name'])
+        self.assertEqual(3, image_meta['size'])
+
+
+class TestCacheFilterV2(base.IsolatedUnitTest):
+
+    """Tests caching image data downloaded through the v2 API"""
+
+    def setUp(self):
+        super(TestCacheFilterV2, self).setUp()
+        self.conf.image_cache_dir = os.path.join(self.test_dir, 'cache')
+        self.filter = cache_middleware.CacheFilter(None, self.conf)
+        self.cache = self.filter.cache
+        self.image_id = _gen_uuid()
+        self.image_meta = {'id': self.image_id,
+                           'name': 'fake image',
+                           'status': 'active',
+                           'deleted': False,
+                           'is_public': True,
+                           'owner': 'tenant1',
+                           'size': 3,
+                           'checksum': None,
+                           'properties': {}}
+        self.stubs.Set(cache_middleware.registry, 'get_image_metadata',
+                       lambda context, image_id: dict(self.image_meta))
+
+    def _request(self, path, method='GET'):
+        req = webob.Request.blank(path % self.image_id)
+        req.method = method
+        req.context = context.RequestContext(tenant='tenant1')
+        return req
+
+    def test_hit_served_with_v2_headers(self):
+        self.cache.cache_image_iter(self.image_id, iter(['abc']))
+        res = self.filter.process_request(
+                self._request('/v2/images/%s/file'))
+        self.assertEqual(200, res.status_int)
+        self.assertEqual('abc', res.body)
+        self.assertEqual('application/octet-stream', res.content_type)
+        self.assertFalse('x-image-meta-name' in res.headers)
+
+    def test_joining_fetch_enforces_policy(self):
+        self.conf.image_cache_coalesce_fetches = True
+        caching_iter = self.cache.get_caching_iter(
+                self.image_id, iter(['a', 'b', 'c']), dict(self.image_meta))
+        self.assertEqual('a', caching_iter.next())
+        self.assertTrue(self.cache.is_being_fetched(self.image_id))
+
+        def fake_enforce(context, action, target):
+            raise exception.Forbidden()
+
+        self.stubs.Set(self.filter.policy, 'enforce', fake_enforce)
+        res = self.filter.process_request(
+                self._request('/v2/images/%s/file'))
+        self.assertEqual(403, res.status_int)
+        self.assertEqual('bc', ''.join(caching_iter))
+
+    def test_miss_cached_from_response(self):
+        req = self._request('/v2/images/%s/file')
+        self.assertEqual(None, self.filter.process_request(req))
+
+        resp = webob.Response(request=req)
+        resp.app_iter = iter(['abc'])
+        resp = self.filter.process_response(resp)
+        self.assertEqual('abc', ''.join(resp.app_iter))
+        self.cache.writers.wait()
+        self.assertTrue(self.cache.is_cached(self.image_id))
+
+    def test_delete_removes_cached_image(self):
+        self.cache.cache_image_iter(self.image_id, iter(['abc']))
+        req = self._request('/v2/images/%s', method='DELETE')
+        resp = webob.Response(request=req, status=204)
+        self.filter.process_response(resp)
+        self.assertFalse(self.cache.is_cached(self.image_id))
+
+    def test_metadata_requests_not_treated_as_data(self):
+        self.cache.cache_image_iter(self.image_id, iter(['abc']))
+        req = self._request('/v2/images/%s')
+        self.assertEqual(None, self.filter.process_request(req))
+
+        self.cache.delete_cached_image(self.image_id)
+        resp = webob.Response(request=req)
+        resp.app_iter = iter(['{}'])
+        self.filter.process_response(resp)
+        self.assertFalse(self.cache.is_cached(self.image_id))
+        self.assertFalse(self.cache.is_being_fetched(self.image_id))
+
+
+class TestCacheFilterPeers(base.IsolatedUnitTest):
+
+    """Tests serving images owned by another API server from its cache"""
+
+    def setUp(self):
+        super(TestCacheFilterPeers, self).setUp()
+        self.conf.image_cache_dir = os.path.join(self.test_dir, 'cache')
+        self.conf.image_cache_peers = ['a:9292', 'b:9292']
+        self.conf.image_cache_peer_self = 'a:9292'
+        self.filter = cache_middleware.CacheFilter(None, self.conf)
+        self.fetches = []
+
+        def fake_fetch(peer, path, headers):
+            self.fetches.append((peer, path))
+            if self.peer_error:
+                raise peers.PeerFetchError('peer down')
+            return 200, [('x-image-meta-name', 'fake')], iter(['abc'])
+
+        self.peer_error = False
+        self.stubs.Set(self.filter.peers, 'fetch', fake_fetch)
+
+    def _image_owned_by(self, peer):
+        while True:
+            image_id = _gen_uuid()
+            if self.filter.peers.ring.get_node(image_id) == peer:
+                return image_id
+
+    def _request(self, image_id):
+        req = webob.Request.blank("/v1/images/%s" % image_id)
+        req.context = context.RequestContext()
+        return req
+
+    def test_image_fetched_from_owner(self):
+        image_id = self._image_owned_by('b:9292')
+        res = self.filter.process_request(self._request(image_id))
+        self.assertEqual(200, res.status_int)
+        self.assertEqual('abc', res.body)
+        self.assertEqual('fake', res.headers['x-image-meta-name'])
+        self.assertEqual([('b:9292', '/v1/images/%s' % image_id)],
+                         self.fetches)
+
+    def test_own_image_left_to_backend(self):
+        image_id = self._image_owned_by('a:9292')
+        self.assertEqual(None,
+                         self.filter.process_request(self._request(image_id)))
+        self.assertEqual([], self.fetches)
+
+    def test_peer_request_left_to_backend(self):
+        req = self._request(self._image_owned_by('b:9292'))
+        req.headers[peers.PEER_HEADER] = 'b:9292'
+        self.assertEqual(None, self.filter.process_request(req))
+        self.assertEqual([], self.fetches)
+
+    def test_peer_failure_falls_back_to_backend(self):
+        self.peer_error = True
+        image_id = self._image_owned_by('b:9292')
+        self.assertEqual(None,
+                         self.filter.process_request(self._request(image_id)))
+        self.assertEqual(1, len(self.fetches))
@@ -59,6 +59,7 @@ setuptools.setup(
              'bin/glance-cache-pruner',
              'bin/glance-cache-manage',
              'bin/glance-cache-cleaner',
+             'bin/glance-cache-verifier',
              'bin/glance-control',
              'bin/glance-manage',
              'bin/glance-registry',
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Micro-benchmarks for the Glance image cache.
+
+Usage: benchmark_image_cache.py [options] <benchmark>
+
+Available benchmarks:
+
+  hits    Latency of cache hits from many concurrent readers, with the
+          sqlite driver's connection pool disabled and enabled
+
+  prune   Time taken to prune half of a large cache, for each driver
+
+  layout  Time taken to look up and list the files of a large cache with
+          a flat and a sharded cache directory, and to migrate between them
+
+  serve   Throughput and server CPU time of serving a large cached image
+          with chunked reads and with wsgi.file_wrapper/sendfile(2)
+"""
+
+import gettext
+import optparse
+import os
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+
+import eventlet
+from eventlet.green import socket
+import eventlet.wsgi
+import webob
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+gettext.install('glance', unicode=1)
+
+from glance.api.v1 import images
+from glance.common import utils
+from glance.common import wsgi
+from glance import image_cache
+from glance.image_cache.drivers import sqlite
+from glance.openstack.common import cfg
+
+
+def make_cache(cache_dir, driver='sqlite', **overrides):
+    conf = cfg.ConfigOpts()
+    conf.register_opts(image_cache.ImageCache.opts)
+    conf.register_opts(sqlite.Driver.opts)
+    conf.set_override('image_cache_dir', cache_dir)
+    conf.set_override('image_cache_driver', driver)
+    for name, value in overrides.items():
+        conf.set_override(name, value)
+    return image_cache.ImageCache(conf)
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(len(samples) * pct / 100.0))
+    return samples[index]
+
+
+def report(label, samples, elapsed):
+    print ("%-24s hits=%-7d hits/s=%-9.1f mean=%.2fms p50=%.2fms "
+           "p99=%.2fms max=%.2fms" %
+           (label, len(samples), len(samples) / elapsed,
+            1000 * sum(samples) / len(samples),
+            1000 * percentile(samples, 50),
+            1000 * percentile(samples, 99),
+            1000 * max(samples)))
+
+
+def bench_hits(options):
+    image_data = '*' * options.image_size
+    for pool_size in (0, options.pool_size):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = make_cache(cache_dir,
+                               image_cache_sqlite_pool_size=pool_size)
+            for image_id in xrange(options.images):
+                cache.cache_image_file(str(image_id),
+                                       StringIO.StringIO(image_data))
+
+            samples = []
+
+            def reader():
+                for x in xrange(options.rounds):
+                    image_id = str(random.randrange(options.images))
+                    start = time.time()
+                    with cache.open_for_read(image_id) as cache_file:
+                        cache_file.read()
+                    samples.append(time.time() - start)
+                    eventlet.sleep(0)
+
+            pool = eventlet.GreenPool(options.readers)
+            start = time.time()
+            for x in xrange(options.readers):
+                pool.spawn_n(reader)
+            pool.waitall()
+            report("pool_size=%d" % pool_size, samples, time.time() - start)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+def populate(cache, num_images, image_size):
+    """
+    Fills the cache with images behind the driver's back, which is a lot
+    quicker than caching them one by one.
+    """
+    driver = cache.driver
+    image_data = '*' * image_size
+    now = time.time()
+    rows = []
+    image_ids = []
+    for x in xrange(num_images):
+        image_id = utils.generate_uuid()
+        image_ids.append(image_id)
+        path = driver.get_image_filepath(image_id)
+        with open(path, 'wb') as image_file:
+            image_file.write(image_data)
+        last_accessed = now - num_images + random.randrange(num_images)
+        os.utime(path, (last_accessed, now))
+        rows.append((image_id, last_accessed, now, image_size))
+
+    if isinstance(driver, sqlite.Driver):
+        with driver.get_db() as db:
+            db.executemany("""INSERT INTO cached_images
+                           (image_id, last_accessed, last_modified, size)
+                           VALUES (?, ?, ?, ?)""", rows)
+            db.commit()
+    return image_ids
+
+
+def bench_prune(options):
+    for driver in ('sqlite', 'xattr'):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            max_size = options.entries * options.entry_size / 2
+            cache = make_cache(cache_dir, driver=driver,
+                               image_cache_max_size=max_size)
+            if not cache.driver.__module__.endswith(driver):
+                print "%-8s driver not available here, skipping" % driver
+                continue
+            populate(cache, options.entries, options.entry_size)
+
+            # A fresh cache, as the pruner would be
+            cache = make_cache(cache_dir, driver=driver,
+                               image_cache_max_size=max_size)
+            start = time.time()
+            num_pruned, bytes_pruned = cache.prune()
+            elapsed = time.time() - start
+            print ("%-8s entries=%-7d pruned=%-7d elapsed=%.2fs" %
+                   (driver, options.entries, num_pruned, elapsed))
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+def bench_layout(options):
+    lookups = 10000
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for levels in (0, 1, 2):
+            cache = make_cache(cache_dir, image_cache_dir_levels=levels)
+            if levels == 0:
+                image_ids = populate(cache, options.entries, 0)
+                # Half of the lookups miss
+                image_ids.extend(utils.generate_uuid()
+                                 for x in xrange(options.entries))
+            else:
+                start = time.time()
+                moved = cache.driver.migrate_layout()
+                print ("%-9s moved=%-7d elapsed=%.2fs" %
+                       ('migrate', moved, time.time() - start))
+
+            start = time.time()
+            for x in xrange(lookups):
+                cache.is_cached(random.choice(image_ids))
+            lookup_elapsed = time.time() - start
+
+            start = time.time()
+            num_files = len(list(cache.driver.get_cache_files(cache_dir)))
+            list_elapsed = time.time() - start
+            print ("%-9s entries=%-7d lookups/s=%-9.1f list=%.2fs" %
+                   ('levels=%d' % levels, num_files,
+                    lookups / lookup_elapsed, list_elapsed))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+class FakeContext(object):
+    tenant = None
+    user = None
+
+
+def bench_serve(options):
+    serializer = images.ImageSerializer(cfg.ConfigOpts())
+    image_file = tempfile.NamedTemporaryFile()
+    try:
+        # A sparse file, so the benchmark needs neither the disk space
+        # nor the time to write it
+        image_file.truncate(options.serve_size)
+        image_file.flush()
+
+        for label, use_file_wrapper in (('chunkiter', False),
+                                        ('file_wrapper', True)):
+
+            def app(environ, start_response):
+                request = webob.Request(environ)
+                request.context = FakeContext()
+                cache_file = open(image_file.name, 'rb')
+                if use_file_wrapper:
+                    chunks = environ['wsgi.file_wrapper'](cache_file, 65536)
+                else:
+                    chunks = utils.chunkiter(cache_file)
+                response = webob.Response(request=request)
+                image_meta = {'id': 'bench', 'owner': None,
+                              'size': options.serve_size, 'checksum': None}
+                serializer.show(response, {'image_iterator': chunks,
+                                           'image_meta': image_meta})
+                return response(environ, start_response)
+
+            listener = eventlet.listen(('127.0.0.1', 0))
+            server = eventlet.spawn(eventlet.wsgi.server, listener, app,
+                                    protocol=wsgi.HttpProtocol,
+                                    log=open(os.devnull, 'w'))
+            client = socket.create_connection(listener.getsockname())
+            client.sendall("GET / HTTP/1.0\r\n\r\n")
+
+            start = time.time()
+            cpu_start = sum(os.times()[:2])
+            received = 0
+            while True:
+                data = client.recv(1024 * 1024)
+                if not data:
+                    break
+                received += len(data)
+            elapsed = time.time() - start
+            # The client shares our process, so its share of the CPU time
+            # is included for both paths
+            cpu = sum(os.times()[:2]) - cpu_start
+            client.close()
+            server.kill()
+            listener.close()
+            print ("%-13s bytes=%-12d elapsed=%.2fs MB/s=%-8.1f cpu=%.2fs" %
+                   (label, received, elapsed,
+                    received / elapsed / (1024 * 1024), cpu))
+    finally:
+        image_file.close()
+
+
+BENCHMARKS = {
+    'hits': bench_hits,
+    'layout': bench_layout,
+    'prune': bench_prune,
+    'serve': bench_serve,
+}
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option('--readers', type=int, default=500,
+                      help="Number of concurrent readers")
+    parser.add_option('--rounds', type=int, default=20,
+                      help="Number of reads per reader")
+    parser.add_option('--images', type=int, default=50,
+                      help="Number of images in the cache")
+    parser.add_option('--image-size', type=int, default=64 * 1024,
+                      help="Size of each cached image in bytes")
+    parser.add_option('--pool-size', type=int, default=10,
+                      help="Size of the sqlite connection pool")
+    parser.add_option('--entries', type=int, default=50000,
+                      help="Number of entries in the cache to prune")
+    parser.add_option('--entry-size', type=int, default=1024,
+                      help="Size of each entry to prune in bytes")
+    parser.add_option('--serve-size', type=int, default=10 * 1024 ** 3,
+                      help="Size of the image to serve in bytes")
+    options, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        parser.error("Please specify one of: %s" %
+                     ', '.join(sorted(BENCHMARKS)))
+    BENCHMARKS[args[0]](options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Replays an image request trace against each image cache eviction policy
+and compares their hit ratios and the bytes they fetch from the backend.
+
+Usage: simulate_cache_policies.py [options] <trace file>
+
+The trace has one request per line in the form
+
+    <timestamp> <image_id> <size>
+
+Blank lines and lines starting with '#' are ignored. Use '-' to read the
+trace from stdin.
+"""
+
+import gettext
+import optparse
+import os
+import sys
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+gettext.install('glance', unicode=1)
+
+from glance.common import exception
+from glance import image_cache
+from glance.image_cache import simulator
+from glance.image_cache.policies import gdsf
+from glance.openstack.common import cfg
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option('--max-size', type=int,
+                      default=image_cache.DEFAULT_MAX_CACHE_SIZE,
+                      help="Size of the simulated cache in bytes")
+    parser.add_option('--policies', default=','.join(simulator.POLICIES),
+                      help="Comma-separated list of policies to compare")
+    parser.add_option('--gdsf-cost', default='uniform',
+                      help="Cost of a miss for the gdsf policy: 'uniform' "
+                           "or 'bytes'")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Please specify a trace file")
+
+    trace_file = sys.stdin if args[0] == '-' else open(args[0])
+    try:
+        trace = list(simulator.parse_trace(trace_file))
+    except exception.Invalid, e:
+        parser.error(unicode(e))
+    finally:
+        trace_file.close()
+
+    print ("%-8s %10s %10s %10s %16s %10s" %
+           ('policy', 'requests', 'hits', 'hit ratio', 'backend bytes',
+            'byte ratio'))
+    for name in options.policies.split(','):
+        conf = cfg.ConfigOpts()
+        conf.register_opts(image_cache.ImageCache.opts)
+        conf.register_opts(gdsf.Policy.opts)
+        conf.set_override('image_cache_max_size', options.max_size)
+        conf.set_override('image_cache_gdsf_cost', options.gdsf_cost)
+        policy = simulator.load_policy(name.strip(), conf)
+        stats = simulator.simulate(policy, trace, options.max_size)
+        print ("%-8s %10d %10d %10.4f %16d %10.4f" %
+               (name, stats['requests'], stats['hits'], stats['hit_ratio'],
+                stats['bytes_from_backend'], stats['byte_hit_ratio']))
+
+
+if __name__ == '__main__':
+    main()